@@ -1,6 +1,8 @@
 # correspondence/settings.py
+import json
 import os
 from pathlib import Path
+from celery.schedules import crontab
 from dotenv import load_dotenv
 
 # Загружаем переменные из .env
@@ -89,6 +91,61 @@ STATIC_ROOT = BASE_DIR / "staticfiles"  # Для collectstatic
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Отдача вложений: '' — через Django, 'x-accel-redirect' — nginx, 'x-sendfile' — Apache/lighttpd.
+# Для nginx нужен internal-location ATTACHMENT_ACCEL_PREFIX с alias на MEDIA_ROOT.
+ATTACHMENT_SENDFILE = os.getenv('ATTACHMENT_SENDFILE', '')
+ATTACHMENT_ACCEL_PREFIX = os.getenv('ATTACHMENT_ACCEL_PREFIX', '/protected-media/')
+ATTACHMENT_CHUNK_SIZE = 256 * 1024  # Байт за одно чтение при отдаче через Django
+ATTACHMENT_GC_GRACE = 3600  # Секунд, в течение которых повторно использованный blob не удаляется
+
+# Архив закрытой переписки (registry/archive.py): записи — в ArchivedIncoming, вложения — в месячные zip-пакеты.
+# ARCHIVE_ROOT вне MEDIA_ROOT: пакеты отдаются только через Django, с проверкой входа
+ARCHIVE_ROOT = os.getenv('ARCHIVE_ROOT', BASE_DIR / 'archive')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 3 * 365))  # Дата поступления и срок ответа старше — в архив
+ARCHIVE_BATCH_SIZE = 200  # Записей в одной транзакции переноса
+ARCHIVE_COMPRESSLEVEL = 6  # zlib; уже сжатые форматы (jpg, docx, zip…) хранятся без сжатия
+ARCHIVE_LEASE_SECONDS = 1800  # Аренда пакета на дописывание
+ARCHIVE_SEARCH_LIMIT = 20  # Найденных архивных записей под результатами поиска
+
+# Загрузка вложений кусками
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))  # Наибольший кусок в одном запросе
+UPLOAD_MAX_FILE_SIZE = int(os.getenv('UPLOAD_MAX_FILE_SIZE', 2 * 1024 ** 3))  # Наибольший размер файла
+UPLOAD_SESSION_TTL_HOURS = int(os.getenv('UPLOAD_SESSION_TTL_HOURS', 24))  # Через сколько брошенная загрузка удаляется
+
+# Извлечение текста и превью вложений (PDF — pypdf и pypdfium2, изображения — Pillow)
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', os.cpu_count() or 1))  # Процессов разбора; 0 — в текущем процессе
+EXTRACTION_BATCH_SIZE = 20  # Файлов за один захват очереди
+EXTRACTION_MAX_TEXT = 100_000  # Символов текста, сохраняемых для файла
+EXTRACTION_MAX_FILE_SIZE = 50 * 1024 * 1024  # Файлы больше не разбираются
+
+# Реестр: записей на странице и время жизни закэшированного итога (0 — не показывать итог)
+REGISTER_PAGE_SIZE = 10
+REGISTER_COUNT_CACHE_TTL = int(os.getenv('REGISTER_COUNT_CACHE_TTL', 60))
+
+# Кэш страниц реестра (0 — не кэшировать). Файловый кэш общий для веб-процессов и воркеров
+# Celery на одной машине; locmem подходит только для одного процесса без импорта почты.
+REGISTER_PAGE_CACHE_TTL = int(os.getenv('REGISTER_PAGE_CACHE_TTL', 300))
+REGISTER_CACHE_ALIAS = 'register'
+REGISTER_CACHE_BACKENDS = {
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'register',
+    },
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'register',
+    },
+}
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    REGISTER_CACHE_ALIAS: {
+        **REGISTER_CACHE_BACKENDS[os.getenv('REGISTER_CACHE_BACKEND', 'file')],
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+}
+
 # Тип первичного ключа по умолчанию
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -96,18 +153,110 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 GMAIL_EMAIL = os.getenv('GMAIL_EMAIL')
 GMAIL_APP_PASSWORD = os.getenv('GMAIL_APP_PASSWORD')
 
+# Почтовые ящики для импорта: JSON-список в переменной MAILBOXES с ключами
+# name, host, port, username, password, folder, ssl; по умолчанию — ящик Gmail выше
+MAILBOXES = json.loads(os.getenv('MAILBOXES', 'null')) or [{
+    'name': 'gmail',
+    'host': 'imap.gmail.com',
+    'username': GMAIL_EMAIL,
+    'password': GMAIL_APP_PASSWORD,
+}]
+EMAIL_POOL_SIZE = int(os.getenv('EMAIL_POOL_SIZE', 4))  # Соединений с одним ящиком на процесс (у Gmail предел 15 на аккаунт)
+EMAIL_CONNECT_TIMEOUT = 30  # Секунд на подключение и ожидание свободного соединения
+EMAIL_RECONNECT_MAX_DELAY = 300  # Наибольшая пауза между попытками переподключения
+EMAIL_IDLE_TIMEOUT = 600  # IDLE перезапускается не реже (RFC 2177 — не дольше 29 минут), заодно проверяется ящик
+
+# Параметры конвейера загрузки почты
+EMAIL_FETCH_BATCH_SIZE = int(os.getenv('EMAIL_FETCH_BATCH_SIZE', 50))  # Писем в одном UID FETCH
+EMAIL_SUMMARY_CONCURRENCY = int(os.getenv('EMAIL_SUMMARY_CONCURRENCY', 8))  # Одновременных запросов к модели реферирования
+EMAIL_STREAM_ATTACHMENTS = os.getenv('EMAIL_STREAM_ATTACHMENTS', '0') == '1'  # Потоковая выгрузка вложений
+EMAIL_STREAM_CHUNK_SIZE = int(os.getenv('EMAIL_STREAM_CHUNK_SIZE', 1024 * 1024))  # Байт в одном частичном FETCH
+# Импорт на нескольких воркерах: пачки UID под арендой, пауза при наложении запусков
+EMAIL_POLL_INTERVAL = int(os.getenv('EMAIL_POLL_INTERVAL', 120))  # Секунд между просмотрами ящика
+EMAIL_SHARD_SIZE = int(os.getenv('EMAIL_SHARD_SIZE', 200))  # UID в одной пачке воркера
+EMAIL_LEASE_SECONDS = 600  # Аренда ящика или пачки; продлевается после каждого UID FETCH
+EMAIL_MAX_BACKOFF = 3600  # Наибольшая пауза между просмотрами при наложении запусков
+EMAIL_BATCH_MAX_ATTEMPTS = 5  # После стольких ошибок пачка больше не берётся
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv('SUMMARY_CACHE_MAX_ENTRIES', 10000))  # Записей в кэше резюме
+
+# Краткое содержание писем (registry/summarizers.py): модели по порядку, extractive — без сети, всегда последней
+SUMMARIZER_BACKENDS = [name.strip() for name in os.getenv('SUMMARIZER_BACKENDS', 'g4f,extractive').split(',') if name.strip()]
+SUMMARIZER_TIMEOUT = float(os.getenv('SUMMARIZER_TIMEOUT', 20))  # Секунд на ответ модели
+SUMMARIZER_BATCH_SIZE = int(os.getenv('SUMMARIZER_BATCH_SIZE', 5))  # Писем в одном запросе к модели (1 — по одному)
+SUMMARIZER_BREAKER_FAILURES = 3  # Ошибок подряд, после которых модель отключается
+SUMMARIZER_BREAKER_RESET = 300  # Секунд до пробного обращения к отключённой модели
+SUMMARIZER_G4F_MODEL = os.getenv('SUMMARIZER_G4F_MODEL', 'gpt-4o-mini')
+SUMMARIZER_OPENAI_URL = os.getenv('SUMMARIZER_OPENAI_URL', '')  # Например http://127.0.0.1:8080/v1
+SUMMARIZER_OPENAI_MODEL = os.getenv('SUMMARIZER_OPENAI_MODEL', 'default')
+SUMMARIZER_OPENAI_API_KEY = os.getenv('SUMMARIZER_OPENAI_API_KEY', '')
+# Отложенное реферирование: запись создаётся сразу, резюме модели — задачами в очереди summaries
+EMAIL_DEFERRED_SUMMARIES = os.getenv('EMAIL_DEFERRED_SUMMARIES', '1') == '1'
+SUMMARY_RATE_LIMIT = os.getenv('SUMMARY_RATE_LIMIT', '30/m')  # Задач (пачек писем) на воркер, формат Celery
+SUMMARY_MAX_RETRIES = 6  # Повторов при недоступных моделях, затем остаётся предварительное резюме
+SUMMARY_RETRY_DELAY = 30  # Секунд до первого повтора, дальше пауза удваивается
+SUMMARY_RETRY_MAX_DELAY = 1800
+SUMMARY_REQUEUE_AFTER = 3 * 3600  # Запрос без ответа дольше этого ставится в очередь снова (потерянные задачи)
+
+# Метрики (/metrics/): токен для сборщика Prometheus (Authorization: Bearer), без него — только сотрудникам
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+METRICS_INGESTION_WINDOW = 3600  # Секунд, за которые суммируются запуски импорта
+INGESTION_RUN_RETENTION_DAYS = int(os.getenv('INGESTION_RUN_RETENTION_DAYS', 30))  # Сколько хранятся итоги запусков
+
+# JSON API (/api/v1/): токен интеграций (Authorization: Bearer), без него — только сотрудникам
+API_TOKEN = os.getenv('API_TOKEN', '')
+API_PAGE_SIZE = 50  # Записей на странице по умолчанию (limit=)
+API_MAX_PAGE_SIZE = 500
+API_CHANGES_LAG = 5  # Секунд, через которые изменение попадает в ленту changes/: фиксация параллельных транзакций
+API_TOMBSTONE_RETENTION_DAYS = int(os.getenv('API_TOMBSTONE_RETENTION_DAYS', 90))  # Сколько хранятся отметки об удалении
+
 # Настройки Celery
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
+CELERY_TASK_ROUTES = {
+    # Реферирование не задерживает импорт почты: свой воркер, celery -A correspondence worker -Q summaries
+    'registry.tasks.summarize_incoming_task': {'queue': 'summaries'},
+}
 
 # Расписание Celery Beat
 CELERY_BEAT_SCHEDULE = {
     'process-emails-every-5-minutes': {
         'task': 'registry.tasks.process_emails_task',
-        'schedule': 120.0,  # Каждые 2 минуты
+        'schedule': float(EMAIL_POLL_INTERVAL),  # Просмотр ящика; пачки раздаются воркерам
+    },
+    'extract-attachments-every-minute': {
+        'task': 'registry.tasks.extract_attachments_task',
+        'schedule': 60.0,
+    },
+    'requeue-summaries-every-15-minutes': {
+        'task': 'registry.tasks.requeue_summaries_task',
+        'schedule': crontab(minute='*/15'),
+    },
+    'cleanup-stale-uploads-hourly': {
+        'task': 'registry.tasks.cleanup_uploads_task',
+        'schedule': crontab(minute=30),
+    },
+    'collect-attachment-garbage-nightly': {
+        'task': 'registry.tasks.collect_attachment_garbage_task',
+        'schedule': crontab(hour=1, minute=0),
+    },
+    'prune-ingestion-runs-nightly': {
+        'task': 'registry.tasks.prune_ingestion_runs_task',
+        'schedule': crontab(hour=1, minute=30),
+    },
+    'prune-tombstones-nightly': {
+        'task': 'registry.tasks.prune_tombstones_task',
+        'schedule': crontab(hour=1, minute=45),
+    },
+    'archive-register-nightly': {
+        'task': 'registry.tasks.archive_register_task',
+        'schedule': crontab(hour=2, minute=0),
+    },
+    'rebuild-deadline-summary-nightly': {
+        'task': 'registry.tasks.rebuild_deadline_summary_task',
+        'schedule': crontab(hour=0, minute=5),  # Сразу после смены дня по CELERY_TIMEZONE
     },
 }
 
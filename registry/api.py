@@ -0,0 +1,316 @@
+# registry/api.py
+"""JSON API реестра только для чтения (/api/v1/) для отчётов и интеграций.
+
+incoming/ — записи с теми же фильтрами, что у списка реестра, по курсору
+номера (after), без OFFSET; fields= выбирает поля ответа. ETag списка
+строится по версии реестра (page_cache.py), поэтому повторный опрос без
+изменений отвечает 304, не обращаясь к базе. Карточка записи и вложения
+отдают ETag и Last-Modified по updated_at. Вложения закрытых записей
+(archived) — по archive/attachments/<id>/: их id из ArchivedAttachment.
+
+changes/ — лента изменений для инкрементальной синхронизации: записи,
+изменённые после курсора, по (updated_at, id) и отметки об удалении
+(DeletedIncoming) по (deleted_at, id). Первый запрос без курсора отдаёт
+весь реестр; ответ содержит курсор для следующего запроса. Изменения
+попадают в ленту через API_CHANGES_LAG секунд: за это время фиксируются
+транзакции, начатые раньше, и запись с более ранним updated_at не окажется
+позади уже выданного курсора. Дочитанный поток курсор продвигает до этого
+момента, поэтому регулярно синхронизирующийся клиент не получает 410 из-за
+того, что удалений давно не было.
+
+Доступ — по токену API_TOKEN (Authorization: Bearer) или вошедшему сотруднику.
+"""
+import base64
+import hashlib
+import hmac
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import wraps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, urlencode
+from django.views.decorators.http import require_safe
+from .filters import attachment_count, attachment_model, filter_incoming, get_filters
+from .models import ArchivedAttachment, ArchivedIncoming, Attachment, DeletedIncoming, Incoming
+from .page_cache import register_version
+from .pagination import cached_count, keyset_query, page_from_rows, parse_cursor
+
+INCOMING_FIELDS = (
+    'id', 'incoming_number', 'incoming_date', 'applicant', 'summary', 'summary_status', 'responsible',
+    'response_deadline', 'updated_at', 'attachment_count', 'attachments',
+)
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class APIError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def api_view(view):
+    """GET/HEAD по токену API_TOKEN или сессии сотрудника; APIError — JSON с кодом ошибки."""
+    @require_safe
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        token = settings.API_TOKEN
+        authorization = request.headers.get('Authorization', '')
+        if not (token and hmac.compare_digest(authorization, f'Bearer {token}')) and not request.user.is_authenticated:
+            response = JsonResponse({'error': 'authentication required'}, status=401)
+            response['WWW-Authenticate'] = 'Bearer'
+            return response
+        try:
+            return view(request, *args, **kwargs)
+        except APIError as error:
+            return JsonResponse({'error': str(error)}, status=error.status)
+    return wrapper
+
+
+def conditional(request, etag, last_modified, build):
+    """Ответ build() или 304, если у клиента та же версия (If-None-Match, If-Modified-Since)."""
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = build()
+    response['ETag'] = etag
+    if timestamp is not None:
+        response['Last-Modified'] = http_date(timestamp)
+    response['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    return response
+
+
+def make_etag(*parts):
+    return '"' + hashlib.sha256('\x1f'.join(map(str, parts)).encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def parse_fields(request):
+    """Поля из fields=a,b,c; id есть всегда."""
+    value = request.GET.get('fields')
+    if not value:
+        return INCOMING_FIELDS
+    fields = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in INCOMING_FIELDS]
+    if unknown:
+        raise APIError(f'unknown fields: {", ".join(unknown)}; available: {", ".join(INCOMING_FIELDS)}')
+    return ('id', *[name for name in fields if name != 'id'])
+
+
+def parse_limit(request):
+    try:
+        limit = int(request.GET.get('limit') or settings.API_PAGE_SIZE)
+    except ValueError:
+        raise APIError('limit must be a number')
+    return max(1, min(limit, settings.API_MAX_PAGE_SIZE))
+
+
+def attachment_data(request, attachment):
+    archived = isinstance(attachment, ArchivedAttachment)
+    url_name = 'archived_attachment_download' if archived else 'attachment_download'
+    return {
+        'id': attachment.pk,
+        'incoming': attachment.incoming_id,
+        'filename': attachment.filename,
+        'sha256': attachment.sha256,
+        'archived': archived,
+        'url': request.build_absolute_uri(reverse(url_name, args=[attachment.pk])),
+    }
+
+
+def attachments_by_record(request, records, fields):
+    """Вложения записей страницы одним запросом, если они запрошены."""
+    if 'attachments' not in fields or not records:
+        return {}
+    grouped = {}
+    for attachment in attachment_model(type(records[0])).objects.filter(incoming__in=records).order_by('pk'):
+        grouped.setdefault(attachment.incoming_id, []).append(attachment_data(request, attachment))
+    return grouped
+
+
+def incoming_data(incoming, fields, attachments):
+    data = {}
+    for name in fields:
+        if name == 'attachments':
+            data[name] = attachments.get(incoming.pk, [])
+        elif name == 'summary_status':
+            data[name] = getattr(incoming, name, Incoming.SUMMARY_DONE)  # У архивных записей резюме готово
+        elif name == 'updated_at':
+            data[name] = getattr(incoming, 'updated_at', None) or incoming.archived_at
+        else:
+            data[name] = getattr(incoming, name)
+    return data
+
+
+def serialize(request, records, fields):
+    attachments = attachments_by_record(request, records, fields)
+    return [incoming_data(incoming, fields, attachments) for incoming in records]
+
+
+def filter_params(request):
+    """Фильтры списка реестра; неверное значение (дата, номер) — ошибка 400, а не 500."""
+    filters = get_filters(request.GET)
+    try:
+        for name in ('date_from', 'date_to', 'deadline_from', 'deadline_to'):
+            if filters[name]:
+                Incoming._meta.get_field('incoming_date').to_python(filters[name])
+        if filters['number_filter']:
+            int(filters['number_filter'])
+    except (ValidationError, ValueError):
+        raise APIError('invalid filter value')
+    return filters
+
+
+@api_view
+def incoming_list(request):
+    """Записи реестра по убыванию номера; следующая страница — по ссылке next (after=номер).
+
+    count — число записей под фильтром из кэша итогов (None, если кэш выключен).
+    """
+    filters = filter_params(request)
+    fields = parse_fields(request)
+    limit = parse_limit(request)
+    after = parse_cursor(request.GET.get('after'))
+    etag = make_etag('incoming', register_version(), sorted(request.GET.items()))
+
+    def build():
+        # Поиск в API — фильтр, а не сортировка по релевантности: иначе курсор по номеру неприменим
+        queryset = filter_incoming(filters, rank=False)
+        page = page_from_rows(list(keyset_query(queryset, after=after, per_page=limit)), after=after, per_page=limit)
+        next_url = None
+        if page.has_next():
+            query = {name: value for name, value in request.GET.items() if name != 'after'}
+            next_url = request.build_absolute_uri(f"{reverse('api_incoming_list')}?{urlencode({**query, 'after': page.next_cursor})}")
+        return JsonResponse({
+            'results': serialize(request, page.object_list, fields),
+            'next': next_url,
+            'count': cached_count(queryset, filters),
+        })
+    return conditional(request, etag, None, build)
+
+
+@api_view
+def incoming_detail(request, pk):
+    """Одна запись; закрытая запись из архива — с признаком archived."""
+    fields = parse_fields(request)
+    incoming = Incoming.objects.annotate(attachment_count=attachment_count()).filter(pk=pk).first()
+    archived = incoming is None
+    if archived:
+        incoming = ArchivedIncoming.objects.annotate(
+            attachment_count=attachment_count(ArchivedIncoming)).filter(pk=pk).first()
+        if incoming is None:
+            raise APIError('not found', status=404)
+    modified = incoming.archived_at if archived else incoming.updated_at
+    etag = make_etag('incoming', pk, modified.isoformat(), fields)
+
+    def build():
+        data = serialize(request, [incoming], fields)[0]
+        data['archived'] = archived
+        return JsonResponse(data)
+    return conditional(request, etag, modified, build)
+
+
+def attachment_response(request, model, pk):
+    attachment = model.objects.filter(pk=pk).first()
+    if attachment is None:
+        raise APIError('not found', status=404)
+    # Содержимое вложения неизменно: ETag — его SHA-256
+    return conditional(request, f'"{attachment.sha256 or attachment.pk}"', None,
+                       lambda: JsonResponse(attachment_data(request, attachment)))
+
+
+@api_view
+def attachment_detail(request, pk):
+    return attachment_response(request, Attachment, pk)
+
+
+@api_view
+def archived_attachment_detail(request, pk):
+    """Вложение закрытой записи: у архивных вложений свои id, поэтому и свой адрес."""
+    return attachment_response(request, ArchivedAttachment, pk)
+
+
+def encode_cursor(changed, deleted):
+    """Курсор ленты: позиции (микросекунды, id) в записях и в отметках об удалении."""
+    payload = json.dumps([changed, deleted], separators=(',', ':')).encode('ascii')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(value):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+        (changed_at, changed_id), (deleted_at, deleted_id) = payload
+        return (int(changed_at), int(changed_id)), (int(deleted_at), int(deleted_id))
+    except (ValueError, TypeError):
+        raise APIError('invalid cursor')
+
+
+def to_micros(moment):
+    return (moment - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+def after_position(queryset, field, position):
+    moment, pk = from_micros(position[0]), position[1]
+    return queryset.filter(Q(**{f'{field}__gt': moment}) | Q(**{field: moment, 'pk__gt': pk}))
+
+
+@api_view
+def changes(request):
+    """Записи, изменённые после курсора (cursor=), или после момента since= (ISO 8601)."""
+    fields = parse_fields(request)
+    limit = parse_limit(request)
+    settled = timezone.now() - timedelta(seconds=settings.API_CHANGES_LAG)
+    if request.GET.get('cursor'):
+        changed_position, deleted_position = decode_cursor(request.GET['cursor'])
+    elif request.GET.get('since'):
+        since = parse_datetime(request.GET['since'])
+        if since is None:
+            raise APIError('since must be an ISO 8601 datetime')
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        changed_position = deleted_position = (to_micros(since), 0)
+    else:
+        # Полная выгрузка: все записи; удалённые до её начала клиенту не нужны
+        changed_position, deleted_position = (0, 0), (to_micros(settled), 0)
+
+    retention = timezone.now() - timedelta(days=settings.API_TOMBSTONE_RETENTION_DAYS)
+    if from_micros(deleted_position[0]) < retention:
+        raise APIError('cursor is older than the deletion log, start a full sync without cursor', status=410)
+
+    changed = list(after_position(
+        Incoming.objects.filter(updated_at__lte=settled), 'updated_at', changed_position,
+    ).annotate(attachment_count=attachment_count()).order_by('updated_at', 'pk')[:limit + 1])
+    deleted = list(after_position(
+        DeletedIncoming.objects.filter(deleted_at__lte=settled), 'deleted_at', deleted_position,
+    ).order_by('deleted_at', 'pk')[:limit + 1])
+    has_more = len(changed) > limit or len(deleted) > limit
+    # Выбранная до конца лента продвигает курсор до settled, даже если изменений не было:
+    # иначе позиция отметок тихого реестра устаревала бы и через срок хранения давала 410
+    horizon = (to_micros(settled), 0)
+    if len(changed) > limit:
+        changed_position = (to_micros(changed[limit - 1].updated_at), changed[limit - 1].pk)
+    else:
+        changed_position = max(changed_position, horizon)
+    if len(deleted) > limit:
+        deleted_position = (to_micros(deleted[limit - 1].deleted_at), deleted[limit - 1].pk)
+    else:
+        deleted_position = max(deleted_position, horizon)
+    changed, deleted = changed[:limit], deleted[:limit]
+    return JsonResponse({
+        'changed': serialize(request, changed, fields),
+        'deleted': [
+            {'id': tombstone.incoming_id, 'incoming_number': tombstone.incoming_number,
+             'reason': tombstone.reason, 'deleted_at': tombstone.deleted_at}
+            for tombstone in deleted
+        ],
+        'cursor': encode_cursor(changed_position, deleted_position),
+        'has_more': has_more,
+    })
@@ -0,0 +1,335 @@
+# registry/archive.py
+"""Архив старой переписки.
+
+Закрытые записи — срок ответа и дата поступления старше ARCHIVE_AFTER_DAYS,
+резюме не ждёт модели, нет сессий загрузки — переносятся из реестра
+в ArchivedIncoming с теми же id и номерами. Вложения упаковываются
+в месячные zip-пакеты ARCHIVE_ROOT/<год>/<год>-<месяц>.zip, один элемент
+на SHA-256 содержимого. Смещение элемента и его размеры хранятся
+в ArchivedAttachment, и файл читается прямо с этого места, без разбора
+оглавления пакета (PackMember). Записи переносятся помесячно: вложения
+всех пачек месяца дописываются в одну копию пакета за запуск, копия
+сбрасывается на диск и заменяет пакет (os.replace), и только затем
+записи переносятся транзакциями по ARCHIVE_BATCH_SIZE. Оборванная запись
+не портит оглавление пакета, а при сбое после замены в пакете остаются
+лишние элементы, но ни одно вложение не теряется. Blob-файлы перенесённых вложений удаляет
+обычная сборка мусора хранилища, когда на них не остаётся ссылок.
+
+Карточка записи, поиск (отдельный индекс, см. search.py) и скачивание
+вложений читают архив прозрачно; restore возвращает запись в реестр.
+"""
+import io
+import logging
+import os
+import shutil
+import struct
+import zipfile
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+from .ingestion import worker_id
+from .mail import chunked
+from .models import (
+    ArchivedAttachment, ArchivedIncoming, ArchivePack, Attachment, DeletedIncoming, Incoming, UploadSession,
+)
+from .search import index_many, remove_incoming
+from .storage import file_digest
+
+logger = logging.getLogger(__name__)
+
+ARCHIVED_FIELDS = ['id', 'incoming_number', 'incoming_date', 'applicant', 'summary', 'responsible',
+                   'response_deadline', 'dedup_key', 'message_id']
+# Уже сжатые форматы хранятся без повторного сжатия: deflate только тратил бы время
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.zip', '.gz', '.7z', '.rar', '.docx', '.xlsx',
+                     '.pptx', '.odt', '.ods', '.mp3', '.mp4'}
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')  # Локальный заголовок элемента zip (APPNOTE 4.3.7)
+
+
+def cutoff_date(days=None):
+    days = settings.ARCHIVE_AFTER_DAYS if days is None else days
+    return timezone.localdate() - timedelta(days=days)
+
+
+def candidates(cutoff):
+    """Записи, которые можно перенести в архив, по возрастанию id."""
+    return (
+        Incoming.objects.filter(incoming_date__lt=cutoff, response_deadline__lt=cutoff)
+        .exclude(summary_status=Incoming.SUMMARY_PENDING)
+        # Сессия загрузки (и готовый, но не прикреплённый файл) удалилась бы каскадом, оставив файл без ссылок
+        .filter(~Exists(UploadSession.objects.filter(incoming=OuterRef('pk'))))
+        .order_by('pk')
+    )
+
+
+def pack_name(day):
+    return f'{day:%Y}/{day:%Y-%m}.zip'
+
+
+def pack_path(name):
+    return os.path.join(settings.ARCHIVE_ROOT, name)
+
+
+def member_method(filename):
+    return zipfile.ZIP_STORED if os.path.splitext(filename)[1].lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+class PackWriter:
+    """Дописывание пакета через временную копию.
+
+    Копия делается один раз, в неё пишутся все пачки месяца; commit
+    заменяет пакет готовой копией с оглавлением. Смещения прежних
+    элементов в копии те же.
+    """
+
+    def __init__(self, pack):
+        self.pack = pack
+        self.path = pack_path(pack.name)
+        self.temporary = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            shutil.copyfile(self.path, self.temporary)
+        elif os.path.exists(self.temporary):
+            os.remove(self.temporary)  # Остаток записи, прерванной сбоем
+        self.archive = zipfile.ZipFile(self.temporary, 'a', compresslevel=settings.ARCHIVE_COMPRESSLEVEL)
+        self.members = {info.filename: info for info in self.archive.infolist()}
+        self.added, self.original = 0, 0
+
+    def write(self, attachments):
+        """Дописывание содержимого вложений; возвращает {pk вложения: поля ArchivedAttachment}.
+
+        Одинаковое содержимое (тот же SHA-256) в пакете хранится один раз.
+        """
+        entries = {}
+        for attachment in attachments:
+            storage = attachment.file.storage
+            if not attachment.file or not storage.exists(attachment.file.name):
+                logger.warning(f'Attachment {attachment.pk} has no file, archiving its name only')
+                continue
+            digest = attachment.sha256 or storage.digest(attachment.file.name)
+            if not digest:
+                with storage.open(attachment.file.name, 'rb') as source:
+                    digest = file_digest(source)
+            if digest not in self.members:
+                size = storage.size(attachment.file.name)
+                info = zipfile.ZipInfo(digest, date_time=datetime.now().timetuple()[:6])
+                info.compress_type = member_method(attachment.filename or attachment.file.name)
+                with storage.open(attachment.file.name, 'rb') as source, \
+                        self.archive.open(info, 'w', force_zip64=size > zipfile.ZIP64_LIMIT) as target:
+                    for chunk in iter(lambda: source.read(settings.ATTACHMENT_CHUNK_SIZE), b''):
+                        target.write(chunk)
+                self.members[digest] = self.archive.getinfo(digest)
+                self.added += 1
+                self.original += size
+            info = self.members[digest]
+            entries[attachment.pk] = {
+                'sha256': digest, 'pack': self.pack, 'offset': info.header_offset,
+                'compressed_size': info.compress_size, 'size': info.file_size, 'method': info.compress_type,
+            }
+        return entries
+
+    def commit(self):
+        """Замена пакета копией; возвращает размер пакета на диске."""
+        self.archive.close()
+        if self.added:
+            # Пакет на диске до фиксации транзакций, которые удалят исходные файлы
+            fsync(self.temporary)
+            os.replace(self.temporary, self.path)
+            fsync(os.path.dirname(self.path))
+        else:
+            os.remove(self.temporary)
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def abort(self):
+        """Отказ от копии: пакет остаётся прежним."""
+        try:
+            self.archive.close()
+        finally:
+            if os.path.exists(self.temporary):
+                os.remove(self.temporary)
+
+
+def fsync(path):
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def move_records(records, attachments, entries):
+    """Перенос пачки записей в архив одной транзакцией; вложения уже в пакете."""
+    archived = [ArchivedIncoming(**{field: getattr(incoming, field) for field in ARCHIVED_FIELDS})
+                for incoming in records]
+    with transaction.atomic():
+        ArchivedIncoming.objects.bulk_create(archived)
+        ArchivedAttachment.objects.bulk_create([
+            ArchivedAttachment(incoming_id=incoming.pk, filename=attachment.filename,
+                               **entries.get(attachment.pk, {'sha256': attachment.sha256}))
+            for incoming in records for attachment in attachments[incoming.pk]
+        ])
+        index_many(archived)
+        # Удаление через ORM: сигналы убирают записи из индекса реестра и сводки сроков, blob — сборщику мусора
+        ids = [incoming.pk for incoming in records]
+        Incoming.objects.filter(pk__in=ids).delete()
+        DeletedIncoming.objects.filter(incoming_id__in=ids, reason=DeletedIncoming.DELETED).update(
+            reason=DeletedIncoming.ARCHIVED)
+    return len(records)
+
+
+def archive_pack(name, records, owner, batch_size):
+    """Перенос записей одного месяца; возвращает число перенесённых.
+
+    Если пакет дописывает другой процесс, записи остаются до следующего запуска.
+    """
+    pack, _ = ArchivePack.objects.get_or_create(name=name)
+    if not ArchivePack.objects.acquire(pack.pk, owner, settings.ARCHIVE_LEASE_SECONDS):
+        logger.info(f'Pack {name} is being written by another worker, {len(records)} records wait')
+        return 0
+    attachments = defaultdict(list)
+    writer = PackWriter(pack)
+    try:
+        entries = {}
+        for batch in chunked(records, batch_size):
+            for attachment in Attachment.objects.filter(incoming__in=batch).order_by('pk'):
+                attachments[attachment.incoming_id].append(attachment)
+            entries.update(writer.write([attachment for incoming in batch for attachment in attachments[incoming.pk]]))
+            # Аренда продлевается на каждой пачке: большой месяц пишется дольше её срока
+            if not ArchivePack.objects.acquire(pack.pk, owner, settings.ARCHIVE_LEASE_SECONDS):
+                logger.warning(f'Lost the lease on pack {name}, its records wait for the next run')
+                writer.abort()
+                return 0
+        size = writer.commit()
+    except BaseException:
+        writer.abort()
+        ArchivePack.objects.release(pack.pk, owner)
+        raise
+    ArchivePack.objects.release(pack.pk, owner, size=size, members=F('members') + writer.added,
+                                original_size=F('original_size') + writer.original)
+    return sum(move_records(batch, attachments, entries) for batch in chunked(records, batch_size))
+
+
+def archive_records(cutoff=None, limit=None, batch_size=None):
+    """Перенос закрытых записей старше cutoff по месяцам; возвращает число перенесённых."""
+    cutoff = cutoff or cutoff_date()
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    owner = worker_id()
+    total = 0
+    for month in candidates(cutoff).dates('incoming_date', 'month'):
+        if limit is not None and total >= limit:
+            break
+        records = candidates(cutoff).filter(incoming_date__year=month.year, incoming_date__month=month.month)
+        if limit is not None:
+            records = records[:limit - total]
+        total += archive_pack(pack_name(month), list(records), owner, batch_size)
+    if total:
+        logger.info(f'Archived {total} records older than {cutoff}')
+    return total
+
+
+class PackMember(io.RawIOBase):
+    """Файл вложения внутри пакета: чтение с сохранённого смещения, распаковка на лету.
+
+    Позиция меняется лениво: seek в конец (FileResponse узнаёт так размер) ничего
+    не читает, а переход назад начинает распаковку сначала.
+    """
+
+    def __init__(self, attachment):
+        super().__init__()
+        self.attachment = attachment
+        self.size = attachment.size
+        self.file = open(pack_path(attachment.pack.name), 'rb')
+        self.file.seek(attachment.offset)
+        header = self.file.read(LOCAL_HEADER.size)
+        if len(header) < LOCAL_HEADER.size or not header.startswith(b'PK\x03\x04'):
+            self.file.close()
+            raise OSError(f'no zip member at offset {attachment.offset} of {attachment.pack.name}')
+        name_length, extra_length = LOCAL_HEADER.unpack(header)[-2:]
+        self.data_start = attachment.offset + LOCAL_HEADER.size + name_length + extra_length
+        self.position = 0
+        self._rewind()
+
+    def _rewind(self):
+        self.file.seek(self.data_start)
+        self.remaining = self.attachment.compressed_size  # Непрочитанные сжатые байты
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = b''
+        self.offset = 0  # Позиция распакованного потока
+
+    def _next(self, limit):
+        """Следующие распакованные байты (не больше limit); b'' — конец элемента."""
+        if not self.buffer:
+            while not self.buffer and self.remaining > 0:
+                raw = self.file.read(min(settings.ATTACHMENT_CHUNK_SIZE, self.remaining))
+                if not raw:
+                    raise OSError(f'{self.attachment.pack.name} is truncated')
+                self.remaining -= len(raw)
+                if self.attachment.method == zipfile.ZIP_STORED:
+                    self.buffer = raw
+                else:
+                    self.buffer = self.decompressor.decompress(raw)
+                    if not self.remaining:
+                        self.buffer += self.decompressor.flush()
+        chunk, self.buffer = self.buffer[:limit], self.buffer[limit:]
+        self.offset += len(chunk)
+        return chunk
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def readinto(self, target):
+        if self.position >= self.size:
+            return 0
+        if self.position < self.offset:
+            self._rewind()
+        while self.offset < self.position:
+            if not self._next(min(settings.ATTACHMENT_CHUNK_SIZE, self.position - self.offset)):
+                return 0
+        chunk = self._next(len(target))
+        target[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+def open_member(attachment):
+    """Буферизованный файл вложения архива для чтения."""
+    return io.BufferedReader(PackMember(attachment), buffer_size=settings.ATTACHMENT_CHUNK_SIZE)
+
+
+def restore(archived):
+    """Возврат записи из архива в реестр вместе с вложениями; элементы пакета остаются на месте."""
+    with transaction.atomic():
+        incoming = Incoming(**{field: getattr(archived, field) for field in ARCHIVED_FIELDS})
+        attachments = list(archived.attachments.select_related('pack'))
+        archived.delete()
+        remove_incoming(archived.pk, ArchivedIncoming)
+        # Запись снова в реестре: клиенты API получат её в ленте изменений, а не отметку об архиве
+        DeletedIncoming.objects.filter(incoming_id=archived.pk).delete()
+        incoming.save(force_insert=True)
+        for attachment in attachments:
+            if attachment.pack is None:
+                continue
+            with open_member(attachment) as source:
+                Attachment(incoming=incoming, filename=attachment.filename,
+                           file=File(source, name=attachment.filename or attachment.sha256)).save()
+    return incoming
@@ -0,0 +1,304 @@
+# registry/benchmarks.py
+"""Воспроизводимые замеры производительности реестра и импорта почты.
+
+Генераторы создают синтетический реестр заданного размера (заявители,
+содержания и вложения на русском, одинаковые при одном seed) и письма
+для локального IMAP-сервера. Сценарии замеряют время и число SQL-запросов
+каждого повтора; итог — перцентили по сценарию, которые сохраняются
+в JSON и сравниваются с прежним базовым файлом (команда benchmark).
+
+Внешняя модель в замерах не вызывается: её заменяет FakeSummarizer
+с заданной задержкой, а почтовый сервер — IMAPStandIn с задержкой ответа.
+"""
+import asyncio
+import hashlib
+import platform
+import random
+import re
+import statistics
+from contextlib import ExitStack
+from datetime import date, datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime
+from io import StringIO
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+from . import imap, summaries, summarizers
+from .forms import IncomingForm
+from .imap_standin import IMAPStandIn
+from .loadtest import percentile_ms
+from .metrics import collect
+from .models import Attachment, Incoming, NumberCounter
+from .page_cache import get_cache
+from .register_io import write_batch
+
+FIRST_NAMES = ['Александр', 'Мария', 'Сергей', 'Елена', 'Дмитрий', 'Ольга', 'Андрей', 'Наталья', 'Алексей',
+               'Татьяна', 'Иван', 'Светлана', 'Михаил', 'Анна', 'Николай', 'Ирина', 'Владимир', 'Екатерина']
+PATRONYMICS = ['Александров', 'Сергеев', 'Иванов', 'Петров', 'Николаев', 'Владимиров', 'Михайлов', 'Андреев']
+LAST_NAMES = ['Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов', 'Новиков',
+              'Фёдоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов', 'Егоров', 'Павлов', 'Козлов']
+ORGANIZATIONS = ['ООО «Северный ветер»', 'АО «Горводоканал»', 'ТСЖ «Рассвет»', 'МБОУ СОШ № 12',
+                 'ИП Сидоров', 'ГБУЗ «Городская больница № 3»', 'ПАО «Энергосбыт»', 'ООО «УК Жилсервис»']
+REQUESTS = ['Просим предоставить', 'Прошу разъяснить', 'Направляем на рассмотрение', 'Просим согласовать',
+            'Жалоба на', 'Запрос о', 'Уведомляем о', 'Прошу рассмотреть вопрос о']
+SUBJECTS = ['график вывоза мусора', 'ремонт кровли дома по ул. Ленина, 15', 'начисления за отопление',
+            'выдачу справки о составе семьи', 'проект благоустройства двора', 'отключение горячей воды',
+            'ямочный ремонт дороги', 'выделение земельного участка', 'подключение к сетям водоснабжения',
+            'перенос остановки общественного транспорта', 'уличное освещение в микрорайоне']
+DETAILS = ['в течение 30 дней', 'до конца текущего месяца', 'с приложением подтверждающих документов',
+           'в связи с многочисленными обращениями жителей', 'повторно, ответ на прошлое обращение не получен',
+           'по адресу, указанному в приложении']
+RESPONSIBLE = ['Иванов И. И.', 'Петрова А. С.', 'Сидоров П. П.', 'Кузнецова Е. В.', 'Орлов Д. А.']
+EXTENSIONS = ['pdf', 'docx', 'jpg', 'xlsx']
+
+
+def person(rng):
+    last_name = rng.choice(LAST_NAMES)
+    first_name = rng.choice(FIRST_NAMES)
+    female = first_name[-1] in 'ая'
+    patronymic = rng.choice(PATRONYMICS) + ('на' if female else 'ич')
+    return f"{last_name}{'а' if female else ''} {first_name} {patronymic}"
+
+
+def applicant(rng):
+    return rng.choice(ORGANIZATIONS) if rng.random() < 0.3 else person(rng)
+
+
+def summary_text(rng):
+    return f'{rng.choice(REQUESTS)} {rng.choice(SUBJECTS)} {rng.choice(DETAILS)}.'
+
+
+def synthetic_incoming(rng, start=date(2020, 1, 1), days=365 * 5):
+    incoming_date = start + timedelta(days=rng.randrange(days))
+    name, summary = applicant(rng), summary_text(rng)
+    return Incoming(
+        incoming_date=incoming_date,
+        applicant=name,
+        summary=summary,
+        responsible=rng.choice(RESPONSIBLE),
+        response_deadline=incoming_date + timedelta(days=rng.choice([10, 14, 30])),
+        dedup_key=Incoming.make_dedup_key(name, incoming_date, summary),
+    )
+
+
+def generate_register(count, attachments_every=10, seed=0, batch_size=5000):
+    """Синтетический реестр из count записей тем же путём, что и импорт из файла.
+
+    Каждой attachments_every-й записи добавляются два вложения (только
+    строки в БД, без файлов). Возвращает число созданных записей.
+    """
+    rng = random.Random(seed)
+    created = 0
+    while created < count:
+        batch = [synthetic_incoming(rng) for _ in range(min(batch_size, count - created))]
+        write_batch(batch)
+        if attachments_every:
+            records = Incoming.objects.order_by('-pk').values_list('pk', flat=True)[:len(batch)]
+            Attachment.objects.bulk_create([
+                Attachment(incoming_id=pk, file=f'attachments/bench-{pk}-{number}.{extension}',
+                           filename=f'Приложение {number + 1}.{extension}',
+                           sha256=hashlib.sha256(f'{pk}-{number}'.encode()).hexdigest())
+                for pk in records if pk % attachments_every == 0
+                for number, extension in enumerate(rng.sample(EXTENSIONS, 2))
+            ])
+        created += len(batch)
+    return created
+
+
+def synthetic_email(rng, index, received=None):
+    """Письмо для IMAPStandIn с уникальными Message-ID и текстом."""
+    message = EmailMessage()
+    message['From'] = f'{person(rng)} <citizen{index}@example.ru>'
+    message['Subject'] = f'{rng.choice(REQUESTS)} {rng.choice(SUBJECTS)}'
+    message['Date'] = format_datetime(received or datetime(2025, 1, 1, 9, tzinfo=timezone.utc) + timedelta(minutes=index))
+    message['Message-ID'] = f'<bench-{index}@example.ru>'
+    message.set_content('\n\n'.join(summary_text(rng) for _ in range(rng.randint(2, 6))) + f'\n\nОбращение № {index}')
+    return message.as_bytes()
+
+
+class FakeSummarizer(summarizers.ChatSummarizer):
+    """Модель для замеров: отвечает через latency секунд, пакетные запросы поддерживаются."""
+    name = 'fake'
+
+    def __init__(self, latency=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    async def complete(self, prompt, session):
+        await asyncio.sleep(self.latency)
+        letters = re.split(r'^Письмо \d+:\n', prompt, flags=re.M)[1:]
+        if not letters:
+            return prompt.split('\n\n', 1)[-1][:summarizers.MAX_LENGTH]
+        return '\n'.join(f'{number}: {" ".join(text.split())[:summarizers.MAX_LENGTH]}'
+                         for number, text in enumerate(letters, 1))
+
+
+class Benchmark:
+    """Окружение замеров: пользователь, клиент и параметры почтового сценария."""
+
+    def __init__(self, stack, emails=50, imap_latency=0.0, summary_latency=0.0, deferred_summaries=False, seed=0):
+        self.stack = stack  # ExitStack: IMAP-сервер и подмены снимаются после всех сценариев
+        self.emails = emails
+        self.deferred_summaries = deferred_summaries
+        self.imap_latency = imap_latency
+        self.summary_latency = summary_latency
+        self.rng = random.Random(seed)
+        self.user, _ = User.objects.get_or_create(username='benchmark')
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.sent = 0
+
+    def get(self, url):
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f'{url} returned HTTP {response.status_code}')
+        return response
+
+    def page(self, url, cold=True):
+        # Кэш страниц и итогов очищается до замера, чтобы не учитывать его очистку
+        setup = get_cache().clear if cold else None
+        return setup, lambda: self.get(url)
+
+    def middle_cursor(self):
+        numbers = Incoming.objects.order_by('-incoming_number').values_list('incoming_number', flat=True)
+        count = numbers.count()
+        return numbers[count // 2] if count else 0
+
+    # Сценарии возвращают (подготовка повтора или None, замеряемый шаг)
+
+    def list_first_page(self):
+        return self.page(reverse('incoming_list'))
+
+    def list_cached_page(self):
+        url = reverse('incoming_list')
+        self.get(url)
+        return self.page(url, cold=False)
+
+    def list_deep_page(self):
+        return self.page(f"{reverse('incoming_list')}?after={self.middle_cursor()}")
+
+    def list_filter(self):
+        return self.page(f"{reverse('incoming_list')}?responsible_filter={RESPONSIBLE[0]}&date_from=2022-01-01")
+
+    def list_search(self):
+        return self.page(f"{reverse('incoming_list')}?q=ремонт кровли")
+
+    def form_save(self):
+        def save():
+            # Запись откатывается: реестр одинаков во всех повторах
+            with transaction.atomic():
+                incoming = synthetic_incoming(self.rng)
+                form = IncomingForm(data={
+                    'applicant': incoming.applicant,
+                    'incoming_date': incoming.incoming_date,
+                    'summary': incoming.summary,
+                    'responsible': incoming.responsible,
+                    'response_deadline': incoming.response_deadline,
+                })
+                if not form.is_valid():
+                    raise RuntimeError(f'form errors: {form.errors.as_text()}')
+                form.save()
+                transaction.set_rollback(True)
+        return None, save
+
+    def process_emails(self):
+        """Импорт self.emails новых писем через IMAPStandIn и поддельную модель.
+
+        С deferred_summaries модель в замер не входит: записи создаются
+        с предварительным резюме, постановка в очередь подменена.
+        """
+        server = IMAPStandIn(latency=self.imap_latency).start()
+        mailbox = {'name': 'benchmark', 'host': '127.0.0.1', 'port': server.port, 'ssl': False,
+                   'username': server.username, 'password': server.password}
+        self.stack.callback(server.stop)
+        self.stack.callback(imap.pool.close_all)
+        self.stack.enter_context(override_settings(MAILBOXES=[mailbox]))
+        self.stack.enter_context(mock.patch.dict(summarizers.BACKENDS, fake=lambda: FakeSummarizer(self.summary_latency)))
+        self.stack.enter_context(override_settings(SUMMARIZER_BACKENDS=['fake']))
+        self.stack.enter_context(mock.patch.object(summaries, 'dispatch', side_effect=len))
+
+        def deliver():
+            for _ in range(self.emails):
+                self.sent += 1
+                server.deliver(synthetic_email(self.rng, self.sent))
+        return deliver, lambda: call_command('process_emails', immediate=True, stdout=StringIO(),
+                                             deferred_summaries=self.deferred_summaries)
+
+
+SCENARIOS = ['list_first_page', 'list_cached_page', 'list_deep_page', 'list_filter', 'list_search',
+             'form_save', 'process_emails']
+
+
+def measure(setup, step, repeat):
+    """Время (с) и число SQL-запросов каждого из repeat повторов step."""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with collect() as timer:
+            step()
+        samples.append((timer.elapsed, timer.queries))
+    return samples
+
+
+def summarize_samples(samples, items=1):
+    seconds = sorted(elapsed for elapsed, _ in samples)
+    queries = [count for _, count in samples]
+    return {
+        'repeat': len(samples),
+        'p50_ms': percentile_ms(seconds, 0.5),
+        'p95_ms': percentile_ms(seconds, 0.95),
+        'p99_ms': percentile_ms(seconds, 0.99),
+        'mean_ms': round(statistics.fmean(seconds) * 1000, 1),
+        'queries': max(queries),
+        'items_per_second': round(items * len(seconds) / sum(seconds), 1) if items > 1 and sum(seconds) else None,
+    }
+
+
+def run(scenarios=None, repeat=20, warmup=2, **options):
+    """Замер сценариев на текущей базе; возвращает {сценарий: итоги}."""
+    results = {}
+    with ExitStack() as stack:
+        benchmark = Benchmark(stack, **options)
+        for name in scenarios or SCENARIOS:
+            if name not in SCENARIOS:
+                raise ValueError(f'unknown scenario {name}, expected one of: {", ".join(SCENARIOS)}')
+            setup, step = getattr(benchmark, name)()
+            measure(setup, step, warmup)
+            items = benchmark.emails if name == 'process_emails' else 1
+            results[name] = summarize_samples(measure(setup, step, repeat), items)
+    return results
+
+
+def environment(scale):
+    return {
+        'scale': scale,
+        'records': Incoming.objects.count(),
+        'database': connection.vendor,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'page_cache_ttl': settings.REGISTER_PAGE_CACHE_TTL,
+        'next_number': NumberCounter.objects.peek(),
+    }
+
+
+def compare(results, baseline, tolerance=0.25, min_ms=1.0):
+    """Регрессии относительно базового замера: рост p95 больше чем на tolerance
+    (и больше min_ms, чтобы не реагировать на шум коротких сценариев) или рост
+    числа запросов. Возвращает список строк с описанием."""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if current['queries'] > previous['queries']:
+            regressions.append(f"{name}: {previous['queries']} -> {current['queries']} queries")
+        before, after = previous.get('p95_ms'), current.get('p95_ms')
+        if before is not None and after is not None and after > before * (1 + tolerance) and after - before > min_ms:
+            regressions.append(f'{name}: p95 {before} -> {after} ms (+{(after / before - 1) * 100:.0f}%)')
+    return regressions
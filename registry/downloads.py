@@ -0,0 +1,179 @@
+# registry/downloads.py
+"""Отдача файлов вложений: условные запросы, диапазоны байт и передача файла веб-серверу.
+
+При ATTACHMENT_SENDFILE = 'x-accel-redirect' (nginx) или 'x-sendfile' (Apache,
+lighttpd) Django только проверяет доступ и отдаёт заголовок, а сам файл,
+включая Range-запросы, передаёт веб-сервер. Без этого файл читается
+из хранилища кусками, не занимая память, но занимая рабочий процесс.
+Под ASGI куски читаются в потоках через асинхронный итератор: синхронный
+итератор Django перед отправкой собрал бы в память весь файл. Вложения
+архива лежат внутри zip-пакетов и всегда отдаются через Django.
+"""
+import hashlib
+import mimetypes
+import re
+from urllib.parse import quote
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import content_disposition_header, http_date
+from .archive import open_member
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def etag_for(name, size, modified):
+    digest = hashlib.sha256(f'{name}:{size}:{modified.timestamp()}'.encode('utf-8')).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in (tag.strip().removeprefix('W/') for tag in header.split(','))
+
+
+def parse_range(header, size):
+    """Диапазон (start, end) включительно из заголовка Range.
+
+    None — заголовка нет или он не поддерживается (несколько диапазонов):
+    отдаётся весь файл. ValueError — диапазон вне файла (ответ 416).
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-N: последние N байт
+        length = int(last)
+        if not length:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def read_range(file, start, length, chunk_size):
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+async def aread_range(file, start, length, chunk_size):
+    """read_range для ASGI: файл читается в отдельном потоке, цикл событий не блокируется."""
+    read = sync_to_async(file.read, thread_sensitive=False)
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = await read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def sendfile_response(field, filename):
+    """Ответ без тела с заголовком для веб-сервера; None, если передача выключена.
+
+    Тип содержимого задаётся по имени вложения: у файлов хранилища
+    (blob по SHA-256) расширения нет, и веб-сервер не определит его сам.
+    """
+    mode = settings.ATTACHMENT_SENDFILE
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if mode == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = quote(settings.ATTACHMENT_ACCEL_PREFIX + field.name)
+    elif mode == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = field.path
+    else:
+        return None
+    return response
+
+
+def serve_attachment(request, attachment):
+    # Для blob хранилища содержимое однозначно задаётся его SHA-256
+    etag = f'"{attachment.sha256}"' if attachment.sha256 else None
+    return serve_file(request, attachment.file, attachment.filename, etag)
+
+
+def serve_file(request, field, filename=None, etag=None):
+    """Отдача файла поля field с проверкой ETag; etag по умолчанию — по имени, размеру и времени."""
+    storage = field.storage
+    size = storage.size(field.name)
+    modified = storage.get_modified_time(field.name)
+    etag = etag or etag_for(field.name, size, modified)
+    filename = filename or field.name.rsplit('/', 1)[-1]
+
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = HttpResponseNotModified()
+    else:
+        response = sendfile_response(field, filename)
+    if response is None:
+        response = file_response(request, lambda: field.open('rb'), size, etag, filename)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified.timestamp())
+    response['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    if response.status_code != 304:
+        response['Content-Disposition'] = content_disposition_header(False, filename)
+    return response
+
+
+def serve_archived(request, attachment):
+    """Отдача вложения из архивного пакета (archive.py) с проверкой ETag и диапазонами байт."""
+    etag = f'"{attachment.sha256}"'
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = HttpResponseNotModified()
+    else:
+        response = file_response(request, lambda: open_member(attachment), attachment.size, etag, attachment.filename)
+        response['Content-Disposition'] = content_disposition_header(False, attachment.filename)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(attachment.incoming.archived_at.timestamp())
+    response['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    return response
+
+
+def file_response(request, open_file, size, etag, filename):
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if not if_range or if_range == etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if byte_range is None and not isinstance(request, ASGIRequest):
+        response = FileResponse(open_file(), filename=filename)
+        response.block_size = settings.ATTACHMENT_CHUNK_SIZE
+    else:
+        start, end = byte_range or (0, size - 1)
+        reader = aread_range if isinstance(request, ASGIRequest) else read_range
+        response = StreamingHttpResponse(
+            reader(open_file(), start, end - start + 1, settings.ATTACHMENT_CHUNK_SIZE),
+            status=200 if byte_range is None else 206,
+            content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        )
+        if byte_range is not None:
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,293 @@
+# registry/extraction.py
+"""Извлечение текста и превью из вложений в фоне.
+
+Очередь — строки AttachmentContent со статусом pending, по одной на
+SHA-256 файла; строка заводится для каждого содержимого вложений, у
+которого её ещё нет. Задача Celery забирает пачку, разбирает файлы в пуле
+процессов (разбор PDF и отрисовка превью нагружают процессор) и
+сохраняет результаты. Повторный запуск безопасен: готовые файлы не
+разбираются заново, а зависшие в processing возвращаются в очередь.
+
+PDF и изображения требуют необязательных пакетов pypdf, pypdfium2 и
+Pillow; без них такие файлы помечаются unsupported и разбираются при
+следующем запуске с --retry-unsupported.
+"""
+import io
+import logging
+import multiprocessing
+import os
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from xml.etree import ElementTree
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from .models import Attachment, AttachmentContent, Incoming
+from .storage import file_digest
+
+logger = logging.getLogger(__name__)
+
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+PREVIEW_SIZE = (320, 320)
+TEXT_ENCODINGS = ('utf-8', 'cp1251', 'koi8-r')
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+# Разбор файлов: выполняется в дочерних процессах, поэтому только функции модуля и простые типы
+
+def sniff(head, filename):
+    """Тип содержимого по сигнатуре файла, а для текста — по расширению имени."""
+    if head.startswith(b'%PDF'):
+        return 'application/pdf'
+    if head.startswith(b'PK\x03\x04') and filename.lower().endswith('.docx'):
+        return 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'image/tiff'
+    if filename.lower().endswith(('.txt', '.csv', '.eml')):
+        return 'text/plain'
+    return ''
+
+
+def normalize_whitespace(text):
+    return re.sub(r'[ \t\r\f\v]+', ' ', re.sub(r'\n\s*\n+', '\n\n', text)).strip()
+
+
+def extract_txt(data):
+    for encoding in TEXT_ENCODINGS:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode('utf-8', errors='replace')
+
+
+def extract_docx(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        root = ElementTree.fromstring(archive.read('word/document.xml'))
+    paragraphs = (''.join(node.text or '' for node in paragraph.iter(WORD_NS + 't'))
+                  for paragraph in root.iter(WORD_NS + 'p'))
+    return '\n'.join(paragraph for paragraph in paragraphs if paragraph)
+
+
+def extract_pdf(data):
+    try:
+        import pypdf
+    except ImportError:
+        raise UnsupportedFormat('pypdf is not installed')
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    return '\n'.join(page.extract_text() or '' for page in reader.pages), len(reader.pages)
+
+
+def thumbnail_png(image):
+    image.thumbnail(PREVIEW_SIZE)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format='PNG', optimize=True)
+    return output.getvalue()
+
+
+def preview_pdf(data):
+    try:
+        import pypdfium2
+    except ImportError:
+        return None
+    document = pypdfium2.PdfDocument(data)
+    try:
+        return thumbnail_png(document[0].render(scale=1).to_pil())
+    finally:
+        document.close()
+
+
+def preview_image(data):
+    try:
+        from PIL import Image
+    except ImportError:
+        raise UnsupportedFormat('Pillow is not installed')
+    with Image.open(io.BytesIO(data)) as image:
+        return thumbnail_png(image)
+
+
+def extract_file(path, filename, max_text, max_size):
+    """Разбор одного файла: {'status', 'content_type', 'text', 'pages', 'preview', 'error'}."""
+    result = {'status': AttachmentContent.DONE, 'content_type': '', 'text': '', 'pages': None,
+              'preview': None, 'error': ''}
+    try:
+        if os.path.getsize(path) > max_size:
+            raise UnsupportedFormat(f'file is larger than {max_size} bytes')
+        with open(path, 'rb') as source:
+            data = source.read()
+        content_type = result['content_type'] = sniff(data[:8], filename)
+        if content_type == 'application/pdf':
+            result['text'], result['pages'] = extract_pdf(data)
+            result['preview'] = preview_pdf(data)
+        elif content_type.endswith('wordprocessingml.document'):
+            result['text'] = extract_docx(data)
+        elif content_type == 'text/plain':
+            result['text'] = extract_txt(data)
+        elif content_type.startswith('image/'):
+            result['preview'] = preview_image(data)
+        else:
+            raise UnsupportedFormat(f'unknown format of {filename}')
+        result['text'] = normalize_whitespace(result['text'])[:max_text]
+    except UnsupportedFormat as error:
+        result.update(status=AttachmentContent.UNSUPPORTED, error=str(error))
+    except Exception as error:  # повреждённый файл не должен останавливать пачку
+        result.update(status=AttachmentContent.FAILED, error=f'{type(error).__name__}: {error}')
+    return result
+
+
+def _extract_job(job):
+    return extract_file(*job)
+
+
+# Очередь и сохранение результатов
+
+def fill_missing_digests():
+    """SHA-256 вложений, сохранённых до хранилища по содержимому; возвращает число обновлённых.
+
+    Вложения без файла проверяются заново при каждом запуске, пока их не
+    переносит dedupe_attachments.
+    """
+    storage = Attachment._meta.get_field('file').storage
+    updated = []
+    for attachment in Attachment.objects.filter(sha256='').exclude(file='').iterator():
+        if storage.exists(attachment.file.name):
+            with storage.open(attachment.file.name, 'rb') as source:
+                attachment.sha256 = file_digest(source)
+            updated.append(attachment)
+    Attachment.objects.bulk_update(updated, ['sha256'], batch_size=1000)
+    return len(updated)
+
+
+def enqueue_new_attachments(batch_size=1000):
+    """Постановка в очередь содержимого, которое ещё не разбиралось; возвращает число новых строк очереди.
+
+    Вложение ждёт разбора, пока для его SHA-256 нет строки AttachmentContent.
+    Отметка по Attachment.pk здесь не годится: вложение, транзакция которого
+    зафиксирована позже вложения с большим pk, осталось бы за отметкой.
+    """
+    fill_missing_digests()
+    digests = list(
+        Attachment.objects.exclude(sha256='')
+        .filter(~Exists(AttachmentContent.objects.filter(sha256=OuterRef('sha256'))))
+        .order_by().values_list('sha256', flat=True).distinct()[:batch_size]
+    )
+    AttachmentContent.objects.bulk_create(
+        [AttachmentContent(sha256=digest) for digest in digests], ignore_conflicts=True,
+    )
+    return len(digests)
+
+
+def release_stale(timeout):
+    """Возврат в очередь файлов, застрявших в processing (процесс-обработчик упал)."""
+    return AttachmentContent.objects.filter(
+        status=AttachmentContent.PROCESSING, updated_at__lt=timezone.now() - timeout,
+    ).update(status=AttachmentContent.PENDING)
+
+
+def claim(batch_size):
+    """Захват пачки из очереди; строку, которую уже забрал другой обработчик, UPDATE не изменит."""
+    pending = list(AttachmentContent.objects.filter(status=AttachmentContent.PENDING)
+                   .order_by('pk').values_list('pk', flat=True)[:batch_size])
+    claimed = []
+    for pk in pending:
+        if AttachmentContent.objects.filter(pk=pk, status=AttachmentContent.PENDING).update(
+                status=AttachmentContent.PROCESSING, updated_at=timezone.now()):
+            claimed.append(pk)
+    return list(AttachmentContent.objects.filter(pk__in=claimed))
+
+
+def pool_size(workers):
+    # Воркер Celery с пулом prefork — демонический процесс, ему нельзя порождать дочерние
+    if multiprocessing.current_process().daemon:
+        return 0
+    return workers
+
+
+def process_batch(batch_size=None, workers=None):
+    """Разбор одной пачки из очереди; возвращает число обработанных файлов."""
+    batch_size = batch_size or settings.EXTRACTION_BATCH_SIZE
+    workers = pool_size(settings.EXTRACTION_WORKERS if workers is None else workers)
+    contents = claim(batch_size)
+    if not contents:
+        return 0
+
+    storage = Attachment._meta.get_field('file').storage
+    sources = {}
+    for sha256, name, filename in Attachment.objects.filter(
+            sha256__in=[content.sha256 for content in contents]).values_list('sha256', 'file', 'filename'):
+        if sha256 not in sources and storage.exists(name):
+            sources[sha256] = (storage.path(name), filename or name)
+
+    jobs, ready = [], []
+    for content in contents:
+        if content.sha256 in sources:
+            path, filename = sources[content.sha256]
+            jobs.append((path, filename, settings.EXTRACTION_MAX_TEXT, settings.EXTRACTION_MAX_FILE_SIZE))
+            ready.append(content)
+        else:
+            content.status, content.error = AttachmentContent.FAILED, 'file not found'
+            content.save()
+
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            results = list(pool.map(_extract_job, jobs))
+    else:
+        results = [_extract_job(job) for job in jobs]
+
+    for content, result in zip(ready, results):
+        save_result(content, result)
+    reindex_attachments([content.sha256 for content in ready])
+    return len(contents)
+
+
+def save_result(content, result):
+    preview = result.pop('preview')
+    for field, value in result.items():
+        setattr(content, field, value)
+    content.attempts += 1
+    if preview:
+        if content.preview:
+            content.preview.delete(save=False)
+        content.preview.save(f'{content.sha256}.png', ContentFile(preview), save=False)
+    content.save()
+    if content.status == AttachmentContent.FAILED:
+        logger.warning(f'Attachment {content.sha256} extraction failed: {content.error}')
+
+
+def reindex_attachments(digests):
+    """Обновление поискового индекса записей, к которым приложены разобранные файлы."""
+    from .search import index_many
+    records = list(Incoming.objects.filter(attachments__sha256__in=digests).distinct())
+    if records:
+        index_many(records)
+
+
+def run(batch_size=None, workers=None, stale_after=timedelta(hours=1), limit=None):
+    """Полный проход: очередь новых вложений и разбор пачками, пока очередь не опустеет."""
+    while enqueue_new_attachments():
+        pass
+    release_stale(stale_after)
+    total = 0
+    while limit is None or total < limit:
+        processed = process_batch(batch_size, workers)
+        if not processed:
+            break
+        total += processed
+    return total
+
+
+def retry(statuses):
+    """Возврат в очередь файлов с указанными статусами (например, после установки pypdf)."""
+    return AttachmentContent.objects.filter(status__in=statuses).update(status=AttachmentContent.PENDING)
@@ -0,0 +1,82 @@
+# registry/filters.py
+import unicodedata
+from django.db.models import Count, Exists, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from .models import Incoming
+from .search import search
+
+FILTER_PARAMS = (
+    'search', 'q', 'date_from', 'date_to', 'responsible_filter', 'number_filter',
+    'summary_filter', 'deadline_from', 'deadline_to', 'attachment_filter',
+)
+NORMALIZED_PARAMS = ('search', 'q', 'responsible_filter', 'summary_filter')
+# Фильтры, с которыми ищут конкретное письмо: по ним просматривается и архив
+ARCHIVE_PARAMS = ('search', 'q', 'responsible_filter', 'number_filter', 'summary_filter')
+
+
+def get_filters(params):
+    """Значения фильтров реестра из GET-параметров; текстовые поля приводятся к NFKC."""
+    filters = {}
+    for name in FILTER_PARAMS:
+        value = params.get(name, '')
+        if name in NORMALIZED_PARAMS:
+            value = unicodedata.normalize('NFKC', value.strip())
+        filters[name] = value
+    return filters
+
+
+def attachment_model(model):
+    """Модель вложений записи: Attachment для реестра, ArchivedAttachment для архива."""
+    return model._meta.get_field('attachments').related_model
+
+
+def attachments_exist(model=Incoming):
+    return Exists(attachment_model(model).objects.filter(incoming=OuterRef('pk')))
+
+
+def attachment_count(model=Incoming):
+    """Число вложений коррелированным подзапросом: считается только для строк страницы."""
+    counts = (
+        attachment_model(model).objects.filter(incoming=OuterRef('pk'))
+        .order_by()
+        .values('incoming')
+        .annotate(total=Count('pk'))
+        .values('total')
+    )
+    return Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+
+
+def filter_incoming(filters, queryset=None, rank=True):
+    """Отфильтрованный реестр с числом вложений, упорядоченный по убыванию номера.
+
+    Текстовые фильтры идут через полнотекстовый индекс; при общем поиске
+    (search) записи упорядочиваются по релевантности, если не задано
+    rank=False. queryset может быть и по архиву (ArchivedIncoming).
+    """
+    incoming = queryset if queryset is not None else Incoming.objects.all()
+    model = incoming.model
+    incoming = incoming.annotate(attachment_count=attachment_count(model)).order_by('-incoming_number')
+
+    if filters['search']:
+        incoming = search(incoming, filters['search'], rank=rank)
+    if filters['q']:
+        incoming = search(incoming, filters['q'], column='applicant')
+    if filters['date_from']:
+        incoming = incoming.filter(incoming_date__gte=filters['date_from'])
+    if filters['date_to']:
+        incoming = incoming.filter(incoming_date__lte=filters['date_to'])
+    if filters['responsible_filter']:
+        incoming = search(incoming, filters['responsible_filter'], column='responsible')
+    if filters['number_filter']:
+        incoming = incoming.filter(incoming_number=filters['number_filter'])
+    if filters['summary_filter']:
+        incoming = search(incoming, filters['summary_filter'], column='summary')
+    if filters['deadline_from']:
+        incoming = incoming.filter(response_deadline__gte=filters['deadline_from'])
+    if filters['deadline_to']:
+        incoming = incoming.filter(response_deadline__lte=filters['deadline_to'])
+    if filters['attachment_filter'] == 'yes':
+        incoming = incoming.filter(attachments_exist(model))
+    elif filters['attachment_filter'] == 'no':
+        incoming = incoming.filter(~attachments_exist(model))
+    return incoming
@@ -1,12 +1,32 @@
 # registry/forms.py
 from django import forms
 from django.core.exceptions import ValidationError
-from django.db.models import Max
-from .models import Incoming, Attachment
+from django.db import transaction
+from .models import ArchivedIncoming, Incoming, Attachment, NumberCounter, SummaryRequest
+
+class MultipleFileInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+
+class MultipleFileField(forms.FileField):
+    """Несколько файлов в одном поле; cleaned_data — список файлов."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('widget', MultipleFileInput(attrs={'class': 'form-control'}))
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        clean_file = super().clean
+        if isinstance(data, (list, tuple)):
+            return [clean_file(item, initial) for item in data]
+        return [clean_file(data, initial)] if data else []
+
 
 class IncomingForm(forms.ModelForm):
-    attachments = forms.FileField(
-        widget=forms.FileInput(),  # Убираем multiple=True
+    # Файлы уходят одним запросом вместе с формой: так вложения можно выбрать ещё
+    # при создании записи, когда у неё нет id для загрузки кусками (uploads.py).
+    # Большие файлы загружаются кусками с карточки записи.
+    attachments = MultipleFileField(
         required=False,
         label='Вложения',
         allow_empty_file=True
@@ -32,26 +52,36 @@ class IncomingForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if not self.instance.pk:
-            max_number = Incoming.objects.aggregate(Max('incoming_number'))['incoming_number__max']
-            self.initial['incoming_number'] = (max_number or 0) + 1
+            # Номер выделяется атомарно при сохранении; в поле только подсказка,
+            # чтобы форма не конфликтовала с одновременным импортом почты
+            number_field = self.fields['incoming_number']
+            number_field.required = False
+            number_field.widget.attrs['placeholder'] = NumberCounter.objects.peek()
+            number_field.help_text = 'Оставьте пустым, чтобы присвоить следующий свободный номер.'
 
     def clean_incoming_number(self):
         incoming_number = self.cleaned_data.get('incoming_number')
         if incoming_number is not None:
             if Incoming.objects.filter(incoming_number=incoming_number).exclude(pk=self.instance.pk).exists():
                 raise ValidationError('Запись с таким номером уже существует.')
+            if ArchivedIncoming.objects.filter(incoming_number=incoming_number).exists():
+                raise ValidationError('Запись с таким номером есть в архиве.')
             if incoming_number <= 0:
                 raise ValidationError('Номер должен быть положительным числом.')
         return incoming_number
 
     def save(self, commit=True):
         instance = super().save(commit=False)
+        if 'summary' in self.changed_data:
+            # Резюме, исправленное сотрудником, фоновое реферирование больше не заменяет
+            instance.summary_status = Incoming.SUMMARY_DONE
         if commit:
-            instance.save()
-            # Обработка загруженных файлов
-            files = self.files.getlist('attachments')  # Получаем список файлов
-            for file in files:
-                if file:  # Проверяем, что файл не пустой
+            with transaction.atomic():
+                instance.save()
+                if instance.summary_status == Incoming.SUMMARY_DONE:
+                    # Текст письма для модели больше не нужен
+                    SummaryRequest.objects.filter(incoming=instance).delete()
+                for file in self.cleaned_data.get('attachments') or []:
                     Attachment.objects.create(
                         incoming=instance,
                         file=file,
@@ -0,0 +1,194 @@
+# registry/imap.py
+"""Соединения с почтовыми ящиками: настройки MAILBOXES, пул и IDLE.
+
+Пул держит открытыми соединения, уже прошедшие TLS и LOGIN, и отдаёт их
+импорту писем повторно (в том числе между задачами одного воркера Celery).
+Перед выдачей давно не использованное соединение проверяется NOOP.
+После неудачного подключения к ящику следующие попытки откладываются
+с удвоением паузы до EMAIL_RECONNECT_MAX_DELAY.
+"""
+import atexit
+import imaplib
+import logging
+import select
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+NOOP_AFTER = 60  # Секунд простоя, после которых соединение проверяется перед выдачей
+NEW_MAIL_RESPONSES = (b'EXISTS', b'RECENT')
+
+
+@dataclass(frozen=True)
+class MailboxConfig:
+    """Почтовый ящик из настройки MAILBOXES."""
+    name: str
+    host: str
+    username: str
+    password: str
+    port: int = 993
+    folder: str = 'INBOX'
+    ssl: bool = True
+
+    @property
+    def state_name(self):
+        """Имя строки MailboxSyncState ящика."""
+        return f'{self.username}/{self.folder}'
+
+
+class MailboxUnavailable(Exception):
+    """Ящик недоступен: подключение отложено после ошибок."""
+
+
+def mailboxes(names=None):
+    """Ящики из настроек; names — отбор по имени."""
+    configs = [MailboxConfig(**options) for options in settings.MAILBOXES if options.get('username')]
+    if names:
+        unknown = set(names) - {config.name for config in configs}
+        if unknown:
+            raise ImproperlyConfigured(f'Unknown mailboxes: {", ".join(sorted(unknown))}')
+        configs = [config for config in configs if config.name in names]
+    return configs
+
+
+def open_connection(config):
+    """Новое соединение с выполненным LOGIN."""
+    connection_class = imaplib.IMAP4_SSL if config.ssl else imaplib.IMAP4
+    imap_server = connection_class(config.host, config.port, timeout=settings.EMAIL_CONNECT_TIMEOUT)
+    try:
+        imap_server.login(config.username, config.password)
+    except Exception:
+        imap_server.shutdown()
+        raise
+    return imap_server
+
+
+def close_connection(imap_server):
+    try:
+        imap_server.logout()
+    except Exception:
+        pass
+
+
+class ConnectionPool:
+    """Пул соединений с IMAP: не больше EMAIL_POOL_SIZE одновременно на ящик."""
+
+    def __init__(self, size=None):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = {}  # ящик -> [(соединение, время возврата)]
+        self.slots = {}  # ящик -> семафор занятых соединений
+        self.failures = {}  # ящик -> (число ошибок подряд, время следующей попытки)
+
+    def _slots(self, config):
+        with self.lock:
+            if config not in self.slots:
+                self.slots[config] = threading.BoundedSemaphore(self.size or settings.EMAIL_POOL_SIZE)
+            return self.slots[config]
+
+    def _take_idle(self, config):
+        with self.lock:
+            connections = self.idle.get(config) or []
+            return connections.pop() if connections else (None, None)
+
+    def _connect(self, config):
+        with self.lock:
+            failures, retry_at = self.failures.get(config, (0, 0))
+        if time.monotonic() < retry_at:
+            raise MailboxUnavailable(f'{config.name}: reconnecting in {retry_at - time.monotonic():.0f}s')
+        try:
+            imap_server = open_connection(config)
+        except Exception as error:
+            delay = min(settings.EMAIL_RECONNECT_MAX_DELAY, 2 ** failures)
+            with self.lock:
+                self.failures[config] = (failures + 1, time.monotonic() + delay)
+            logger.warning(f'Connection to mailbox {config.name} failed ({error}), next attempt in {delay}s.')
+            raise
+        with self.lock:
+            self.failures.pop(config, None)
+        return imap_server
+
+    def _alive(self, imap_server, returned_at):
+        if time.monotonic() - returned_at < NOOP_AFTER:
+            return True
+        try:
+            return imap_server.noop()[0] == 'OK'
+        except Exception:
+            return False
+
+    @contextmanager
+    def connection(self, config):
+        """Соединение с ящиком config; после ошибки внутри блока оно закрывается, а не возвращается."""
+        slots = self._slots(config)
+        if not slots.acquire(timeout=settings.EMAIL_CONNECT_TIMEOUT):
+            raise MailboxUnavailable(f'{config.name}: all {self.size or settings.EMAIL_POOL_SIZE} connections are busy')
+        imap_server = None
+        try:
+            while imap_server is None:
+                imap_server, returned_at = self._take_idle(config)
+                if imap_server is None:
+                    imap_server = self._connect(config)
+                elif not self._alive(imap_server, returned_at):
+                    close_connection(imap_server)
+                    imap_server = None
+            try:
+                yield imap_server
+            except BaseException:
+                close_connection(imap_server)
+                raise
+            with self.lock:
+                self.idle.setdefault(config, []).append((imap_server, time.monotonic()))
+        finally:
+            slots.release()
+
+    def close_all(self):
+        with self.lock:
+            connections = [imap_server for idle in self.idle.values() for imap_server, _ in idle]
+            self.idle.clear()
+        for imap_server in connections:
+            close_connection(imap_server)
+
+
+pool = ConnectionPool()
+atexit.register(pool.close_all)
+
+
+def idle(imap_server, timeout, stop=None):
+    """Ожидание новых писем командой IDLE (RFC 2177) в выбранной папке.
+
+    Возвращает True, если сервер сообщил о новых письмах, и False по истечении
+    timeout секунд или при установке события stop. Ошибки соединения
+    пробрасываются: вызывающий переподключается.
+    """
+    tag = imap_server._new_tag()
+    imap_server.send(tag + b' IDLE\r\n')
+    response = imap_server.readline()
+    if not response.startswith(b'+'):
+        raise imap_server.error(f'IDLE rejected: {response!r}')
+    sock = imap_server.socket()
+    deadline = time.monotonic() + timeout
+    new_mail = False
+    try:
+        while not new_mail and time.monotonic() < deadline and not (stop and stop.is_set()):
+            # Данные могут уже лежать в буфере TLS, тогда select их не увидит
+            pending = getattr(sock, 'pending', lambda: 0)()
+            if not pending and not select.select([sock], [], [], min(1.0, max(0.0, deadline - time.monotonic())))[0]:
+                continue
+            line = imap_server.readline()
+            if not line:
+                raise imap_server.abort('connection closed during IDLE')
+            new_mail = line.startswith(b'* ') and line.rstrip().split(b' ')[-1].upper() in NEW_MAIL_RESPONSES
+    finally:
+        imap_server.send(b'DONE\r\n')
+    while True:
+        line = imap_server.readline()
+        if not line:
+            raise imap_server.abort('connection closed after IDLE')
+        if line.startswith(tag):
+            break
+    return new_mail
@@ -0,0 +1,329 @@
+# registry/imap_standin.py
+"""Локальный IMAP-сервер для тестов и отладки импорта почты без Gmail.
+
+Поддерживает ровно то, что использует импорт: LOGIN, SELECT/EXAMINE,
+UID SEARCH (ALL, UNSEEN, UID n:*, SINCE), UID FETCH (RFC822, BODYSTRUCTURE,
+BODY.PEEK[HEADER], BODY.PEEK[n]<начало.длина>), UID STORE +FLAGS, NOOP,
+IDLE и LOGOUT, без TLS. Параметры Content-Type и Content-Disposition
+попадают в BODYSTRUCTURE как есть, с продолжениями RFC 2231, как у Dovecot. Письма кладутся
+методом deliver; клиентам в IDLE сразу отправляется EXISTS. latency —
+задержка перед ответом на каждую команду, как у удалённого сервера.
+Полученные команды с аргументами пишутся в commands.
+
+    server = IMAPStandIn(('127.0.0.1', 0), username='clerk', password='secret')
+    server.start()
+    server.deliver(raw_message_bytes)
+"""
+import email
+import re
+import select
+import shlex
+import socketserver
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime
+
+IMAP_DATE_FORMAT = '%d-%b-%Y'
+FETCH_ITEM_RE = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?|BODYSTRUCTURE|RFC822|UID', re.I)
+PARAM_RE = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
+
+
+def quoted(value):
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def raw_header(message, name):
+    """Значение заголовка без декодирования, с развёрнутыми продолжениями строк."""
+    for key, value in message.raw_items():
+        if key.lower() == name.lower():
+            return re.sub(r'\r?\n(?=[ \t])', '', str(value))
+    return None
+
+
+def header_fields(message, name):
+    """Основное значение заголовка и список BODYSTRUCTURE его параметров: ("KEY" "value" ...) или NIL."""
+    value = raw_header(message, name)
+    if value is None:
+        return None, 'NIL'
+    params = []
+    for key, param in PARAM_RE.findall(value):
+        param = param.strip()
+        if len(param) > 1 and param.startswith('"') and param.endswith('"'):
+            param = re.sub(r'\\(.)', r'\1', param[1:-1])
+        params.append(f'{quoted(key)} {quoted(param)}')
+    return value.split(';', 1)[0].strip(), f'({" ".join(params)})' if params else 'NIL'
+
+
+def part_body(message):
+    """Содержимое части в кодировке передачи — то, что сервер отдаёт на BODY[n]."""
+    if message.get_content_type() == 'message/rfc822':
+        return message.get_payload(0).as_bytes()
+    if message.is_multipart():
+        raw = message.as_bytes()
+        return raw[HEADER_END_RE.search(raw).end():]
+    if (message.get('Content-Transfer-Encoding') or '').lower() in ('base64', 'quoted-printable'):
+        return message.get_payload().encode('ascii')
+    return message.get_payload(decode=True)  # 7bit/8bit: исходные байты без перекодирования
+
+
+def body_structure(message):
+    """BODYSTRUCTURE части письма (RFC 3501, 7.4.2) с расширенными полями."""
+    disposition, disposition_params = header_fields(message, 'Content-Disposition')
+    disposition = f'({quoted(disposition.upper())} {disposition_params})' if disposition else 'NIL'
+    params = header_fields(message, 'Content-Type')[1]
+    if message.get_content_maintype() == 'multipart':
+        children = ''.join(body_structure(part) for part in message.get_payload())
+        return f'({children} {quoted(message.get_content_subtype())} {params} {disposition} NIL NIL)'
+    body = part_body(message)
+    if params == 'NIL' and message.get_content_maintype() == 'text':
+        params = '("CHARSET" "us-ascii")'
+    fields = [
+        quoted(message.get_content_maintype()), quoted(message.get_content_subtype()), params,
+        quoted(message.get('Content-ID')), 'NIL', quoted((message.get('Content-Transfer-Encoding') or '7bit').upper()),
+        str(len(body)),
+    ]
+    if message.get_content_type() == 'message/rfc822':
+        fields += ['NIL', body_structure(message.get_payload(0)), str(body.count(b'\n'))]
+    elif message.get_content_maintype() == 'text':
+        fields.append(str(body.count(b'\n')))
+    fields += ['NIL', disposition, 'NIL', 'NIL']
+    return f'({" ".join(fields)})'
+
+
+def find_part(message, section):
+    """Часть письма по номеру секции IMAP ('1', '2.1'); None, если такой нет."""
+    part = message
+    for index in section.split('.'):
+        if part.get_content_type() == 'message/rfc822':
+            part = part.get_payload(0)
+        if part.is_multipart():
+            children = part.get_payload()
+            if not 0 < int(index) <= len(children):
+                return None
+            part = children[int(index) - 1]
+        elif index != '1':
+            return None
+    return part
+
+
+def section_bytes(raw, section):
+    """Содержимое BODY[section] письма raw."""
+    if section.upper() == 'HEADER':
+        return raw[:HEADER_END_RE.search(raw).end()]
+    if not section:
+        return raw
+    part = find_part(email.message_from_bytes(raw), section)
+    return part_body(part) if part is not None else b''
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode('utf-8') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections.append(self.connection)
+        self.authenticated = False
+        self.send('* OK IMAP stand-in ready')
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                tag, _, rest = line.decode('utf-8').strip().partition(' ')
+                command, _, arguments = rest.partition(' ')
+                command = command.upper()
+                if command == 'UID':
+                    command, _, arguments = arguments.partition(' ')
+                    command = 'UID ' + command.upper()
+                with server.lock:
+                    server.commands.append((command, arguments))
+                if server.latency:
+                    time.sleep(server.latency)
+                method = getattr(self, 'do_' + command.replace(' ', '_'), None)
+                if method is None or (command not in ('CAPABILITY', 'LOGIN', 'LOGOUT', 'NOOP') and not self.authenticated):
+                    self.send(f'{tag} BAD {command} is not supported')
+                    continue
+                if method(tag, arguments) is False:
+                    return
+        except (ConnectionError, OSError):
+            return
+        finally:
+            with server.lock:
+                if self.connection in server.connections:
+                    server.connections.remove(self.connection)
+
+    def do_CAPABILITY(self, tag, arguments):
+        self.send('* CAPABILITY IMAP4rev1 IDLE UIDPLUS')
+        self.send(f'{tag} OK CAPABILITY completed')
+
+    def do_LOGIN(self, tag, arguments):
+        username, password = shlex.split(arguments)
+        if (username, password) != (self.server.username, self.server.password):
+            self.send(f'{tag} NO [AUTHENTICATIONFAILED] Invalid credentials')
+            return
+        self.authenticated = True
+        self.send(f'{tag} OK LOGIN completed')
+
+    def do_NOOP(self, tag, arguments):
+        self.send(f'{tag} OK NOOP completed')
+
+    def do_LOGOUT(self, tag, arguments):
+        self.send('* BYE logging out')
+        self.send(f'{tag} OK LOGOUT completed')
+        return False
+
+    def do_SELECT(self, tag, arguments):
+        server = self.server
+        with server.lock:
+            self.send(f'* {len(server.messages)} EXISTS')
+            self.send(f'* OK [UIDVALIDITY {server.uidvalidity}] UIDs valid')
+            self.send(f'* OK [UIDNEXT {server.uidnext}] Predicted next UID')
+        self.send(f'{tag} OK [READ-WRITE] SELECT completed')
+
+    do_EXAMINE = do_SELECT
+
+    def matching_uids(self, criteria):
+        criteria = [criterion.upper() for criterion in shlex.split(criteria)]
+        with self.server.lock:
+            messages = list(self.server.messages)
+        if criteria[0] == 'UNSEEN':
+            messages = [message for message in messages if '\\Seen' not in message['flags']]
+        elif criteria[0] == 'UID':
+            first, last = criteria[1].split(':')
+            messages = [message for message in messages
+                        if message['uid'] >= int(first) and (last == '*' or message['uid'] <= int(last))]
+            if not messages and self.server.messages and last == '*':
+                messages = [self.server.messages[-1]]  # 'n:*' всегда включает последнее письмо
+        elif criteria[0] == 'SINCE':
+            since = datetime.strptime(criteria[1].title(), IMAP_DATE_FORMAT).date()
+            messages = [message for message in messages if message['date'] >= since]
+        return [message['uid'] for message in messages]
+
+    def do_UID_SEARCH(self, tag, arguments):
+        uids = self.matching_uids(arguments)
+        self.send('* SEARCH' + ''.join(f' {uid}' for uid in uids))
+        self.send(f'{tag} OK SEARCH completed')
+
+    def selected_messages(self, uid_set):
+        wanted = {int(uid) for uid in uid_set.split(',') if uid.isdigit()}
+        with self.server.lock:
+            return [(index, message) for index, message in enumerate(self.server.messages, 1)
+                    if message['uid'] in wanted]
+
+    def do_UID_FETCH(self, tag, arguments):
+        uid_set, _, items = arguments.partition(' ')
+        requested = [match for match in FETCH_ITEM_RE.finditer(items) if match.group(0).upper() != 'UID']
+        if not requested:
+            self.send(f'{tag} BAD only RFC822, BODYSTRUCTURE and BODY[] are supported')
+            return
+        for index, message in self.selected_messages(uid_set):
+            raw = message['raw']
+            response = f'* {index} FETCH (UID {message["uid"]}'.encode('utf-8')
+            for item in requested:
+                name = item.group(0).upper()
+                if name == 'RFC822':
+                    response += f' RFC822 {{{len(raw)}}}\r\n'.encode('utf-8') + raw
+                elif name == 'BODYSTRUCTURE':
+                    structure = body_structure(email.message_from_bytes(raw))
+                    response += b' BODYSTRUCTURE ' + structure.encode('utf-8', 'surrogateescape')
+                else:
+                    section, offset, length = item.groups()
+                    data, key = section_bytes(raw, section), f'BODY[{section.upper()}]'
+                    if offset is not None:
+                        data, key = data[int(offset):int(offset) + int(length)], f'{key}<{offset}>'
+                    response += f' {key} {{{len(data)}}}\r\n'.encode('utf-8') + data
+            self.send(response + b')\r\n')
+        self.send(f'{tag} OK FETCH completed')
+
+    def do_UID_STORE(self, tag, arguments):
+        uid_set, _, change = arguments.partition(' ')
+        flags = re.findall(r'\\\w+', change)
+        for index, message in self.selected_messages(uid_set):
+            with self.server.lock:
+                message['flags'].update(flags)
+            self.send(f'* {index} FETCH (UID {message["uid"]} FLAGS ({" ".join(sorted(message["flags"]))}))')
+        self.send(f'{tag} OK STORE completed')
+
+    def do_IDLE(self, tag, arguments):
+        server = self.server
+        with server.lock:
+            known = len(server.messages)
+        self.send('+ idling')
+        while True:
+            with server.lock:
+                exists = len(server.messages)
+            if exists > known:
+                self.send(f'* {exists} EXISTS')
+                known = exists
+            if select.select([self.connection], [], [], 0.05)[0]:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == b'DONE':
+                    break
+        self.send(f'{tag} OK IDLE terminated')
+
+
+class IMAPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), username='clerk', password='secret', uidvalidity=1, latency=0):
+        super().__init__(address, StandInHandler)
+        self.latency = latency
+        self.username = username
+        self.password = password
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []
+        self.commands = []  # [(команда, аргументы)] в порядке получения
+        self.connections = []
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.drop_connections()
+        self.shutdown()
+        self.server_close()
+
+    def deliver(self, raw):
+        """Новое письмо в папке; возвращает его UID."""
+        try:
+            date = parsedate_to_datetime(re.search(rb'^Date: (.+)$', raw, re.M).group(1).decode().strip()).date()
+        except (AttributeError, TypeError, ValueError):
+            date = datetime.now().date()
+        with self.lock:
+            uid = self.uidnext
+            self.uidnext += 1
+            self.messages.append({'uid': uid, 'raw': raw, 'flags': set(), 'date': date})
+        return uid
+
+    def renumber(self, uidvalidity):
+        """Смена UIDVALIDITY: письма получают новые UID, как после пересоздания папки на сервере."""
+        with self.lock:
+            self.uidvalidity = uidvalidity
+            self.uidnext += 10
+            for message in self.messages:
+                message['uid'] = self.uidnext
+                self.uidnext += 1
+
+    def drop_connections(self):
+        """Обрыв всех соединений, как при перезапуске сервера."""
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            try:
+                connection.shutdown(2)
+            except OSError:
+                pass
@@ -0,0 +1,109 @@
+# registry/ingestion.py
+"""Распределение импорта почты между воркерами.
+
+Просмотр ящика (UID SEARCH новых писем) выполняет один воркер под арендой
+строки MailboxSyncState и разбивает найденные UID на пачки MailboxBatch.
+Пачки разбирают любые свободные воркеры, каждый под арендой своей пачки,
+поэтому производительность растёт с числом воркеров. Если воркер упал,
+аренда истекает и пачку забирает другой; повторно созданных записей не
+будет благодаря уникальному Incoming.message_id.
+
+Если запуск по расписанию застаёт предыдущий просмотр незавершённым или
+пачки прошлого просмотра ещё не разобраны, следующий просмотр
+откладывается с удвоением паузы до EMAIL_MAX_BACKOFF.
+"""
+import os
+import socket
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .mail import chunked, uid_set
+from .models import MailboxBatch, MailboxSyncState
+
+
+class LeaseLost(Exception):
+    """Аренду пачки перехватил другой воркер: работа прекращается, пачку доделает он."""
+
+
+def worker_id():
+    # Поток входит в идентификатор: воркер Celery с пулом threads — один процесс
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def backoff_seconds(overruns):
+    return min(settings.EMAIL_MAX_BACKOFF, settings.EMAIL_POLL_INTERVAL * 2 ** overruns)
+
+
+def scan_due(state, now=None):
+    return state.next_scan_at is None or state.next_scan_at <= (now or timezone.now())
+
+
+def note_overrun(state):
+    """Запуск пришёлся на незавершённый просмотр: следующий откладывается."""
+    overruns = state.overruns + 1
+    MailboxSyncState.objects.filter(pk=state.pk).update(
+        overruns=F('overruns') + 1,
+        next_scan_at=timezone.now() + timedelta(seconds=backoff_seconds(overruns)),
+    )
+
+
+def finish_scan(state, owner, overran):
+    """Снятие аренды ящика; при наложении запусков или ошибке следующий просмотр откладывается."""
+    overruns = state.overruns + 1 if overran else 0
+    next_scan_at = timezone.now() + timedelta(seconds=backoff_seconds(overruns)) if overran else None
+    MailboxSyncState.objects.release(state.pk, owner, overruns=overruns, next_scan_at=next_scan_at)
+
+
+def has_backlog(state):
+    return state.batches.filter(status=MailboxBatch.PENDING).exists()
+
+
+def schedule_batches(state, uidvalidity, uids, uidnext=None, size=None):
+    """Разбиение новых UID на пачки и сдвиг отметки ящика одной транзакцией."""
+    size = size or settings.EMAIL_SHARD_SIZE
+    with transaction.atomic():
+        batches = MailboxBatch.objects.bulk_create([
+            MailboxBatch(state=state, uidvalidity=uidvalidity, uids=uid_set(chunk),
+                         first_uid=chunk[0], last_uid=chunk[-1])
+            for chunk in chunked(uids, size)
+        ])
+        # Всё, что было в ящике на момент SELECT, распределено: следующий просмотр начнёт с UIDNEXT
+        state.uidvalidity = uidvalidity
+        state.last_uid = max([state.last_uid, *uids[-1:], (uidnext or 1) - 1])
+        state.save(update_fields=['uidvalidity', 'last_uid', 'updated_at'])
+    return batches
+
+
+def claimable_batches():
+    return MailboxBatch.objects.filter(
+        Q(lease_owner='') | Q(lease_expires_at__lt=timezone.now()),
+        status=MailboxBatch.PENDING,
+        attempts__lt=settings.EMAIL_BATCH_MAX_ATTEMPTS,
+    )
+
+
+def claim_batch(owner, state=None):
+    """Захват первой свободной пачки (ящика state, если задан); None, если разбирать нечего."""
+    batches = claimable_batches()
+    if state is not None:
+        batches = batches.filter(state=state)
+    for pk in batches.order_by('first_uid').values_list('pk', flat=True)[:10]:
+        if MailboxBatch.objects.acquire(pk, owner, settings.EMAIL_LEASE_SECONDS):
+            return MailboxBatch.objects.select_related('state').get(pk=pk)
+    return None
+
+
+def renew_batch(batch, owner):
+    if not MailboxBatch.objects.acquire(batch.pk, owner, settings.EMAIL_LEASE_SECONDS):
+        raise LeaseLost(f'lease on batch {batch.pk} was taken over')
+
+
+def finish_batch(batch, owner, status=MailboxBatch.DONE):
+    MailboxBatch.objects.release(batch.pk, owner, status=status, error='')
+
+
+def fail_batch(batch, owner, error):
+    MailboxBatch.objects.release(batch.pk, owner, attempts=F('attempts') + 1, error=str(error)[:2000])
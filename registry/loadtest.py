@@ -0,0 +1,125 @@
+# registry/loadtest.py
+"""Нагрузочная проверка страниц реестра: сравнение развёртываний WSGI и ASGI.
+
+Каждый виртуальный пользователь — поток со своим keep-alive соединением,
+который по кругу запрашивает адреса, пока не истечёт время. Все потоки
+используют одну сессию, полученную входом через форму. Клиент работает
+в одном процессе, поэтому при тысячах запросов в секунду упор может быть
+в нём самом: сравнивать стоит запуски на одной машине.
+"""
+import http.client
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import quote, urlencode, urlsplit
+
+
+class LoadTestError(Exception):
+    pass
+
+
+def connect(url, timeout):
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    return connection_class(parts.netloc, timeout=timeout)
+
+
+def request_path(url):
+    parts = urlsplit(url)
+    path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+    return quote(path, safe="/?&=%+:")
+
+
+def cookie_header(cookies):
+    return '; '.join(f'{name}={morsel.value}' for name, morsel in cookies.items())
+
+
+def login(base_url, username, password, timeout=10):
+    """Вход через форму /login/; возвращает заголовок Cookie с сессией."""
+    url = base_url.rstrip('/') + '/login/'
+    connection = connect(url, timeout)
+    try:
+        cookies = SimpleCookie()
+        connection.request('GET', request_path(url))
+        response = connection.getresponse()
+        response.read()
+        cookies.load(', '.join(response.headers.get_all('Set-Cookie') or []))
+        if 'csrftoken' not in cookies:
+            raise LoadTestError(f'no CSRF cookie from {url}')
+        body = urlencode({'username': username, 'password': password,
+                          'csrfmiddlewaretoken': cookies['csrftoken'].value})
+        connection.request('POST', request_path(url), body=body, headers={
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Cookie': cookie_header(cookies),
+            'Referer': url,
+        })
+        response = connection.getresponse()
+        response.read()
+        cookies.load(', '.join(response.headers.get_all('Set-Cookie') or []))
+    finally:
+        connection.close()
+    if response.status != 302 or 'sessionid' not in cookies:
+        raise LoadTestError(f'login as {username} failed with HTTP {response.status}')
+    return cookie_header(cookies)
+
+
+def percentile_ms(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))] * 1000, 1)
+
+
+def run_user(urls, headers, deadline, timeout, results, offset):
+    latencies, errors = [], 0
+    connection = connect(urls[0], timeout)
+    index = offset
+    while time.monotonic() < deadline:
+        url = urls[index % len(urls)]
+        index += 1
+        started = time.perf_counter()
+        try:
+            connection.request('GET', request_path(url), headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = connect(url, timeout)
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+    results.append((latencies, errors))
+
+
+def run(urls, users=50, duration=30, cookie='', timeout=30):
+    """Нагрузка urls от users параллельных пользователей в течение duration секунд.
+
+    Возвращает сводку: число запросов и ошибок, запросов в секунду
+    и задержки p50/p95/p99 в миллисекундах.
+    """
+    headers = {'Cookie': cookie} if cookie else {}
+    results = []
+    deadline = time.monotonic() + duration
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=run_user, args=(urls, headers, deadline, timeout, results, offset), daemon=True)
+        for offset in range(users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    latencies = sorted(latency for user_latencies, _ in results for latency in user_latencies)
+    return {
+        'users': users,
+        'duration': round(elapsed, 1),
+        'requests': len(latencies),
+        'errors': sum(errors for _, errors in results),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'p50_ms': percentile_ms(latencies, 0.50),
+        'p95_ms': percentile_ms(latencies, 0.95),
+        'p99_ms': percentile_ms(latencies, 0.99),
+    }
@@ -0,0 +1,419 @@
+# registry/mail.py
+import binascii
+import re
+from dataclasses import dataclass, field
+from datetime import date
+from email.header import decode_header, make_header
+from email.utils import collapse_rfc2231_value, decode_rfc2231
+from itertools import takewhile
+from urllib.parse import unquote
+from typing import Optional
+from django.core.files.base import File
+
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
+
+
+@dataclass
+class IncomingEmail:
+    """Письмо, прошедшее разбор и ожидающее записи в реестр."""
+    uid: int
+    message_id: str
+    applicant: str
+    subject: str
+    incoming_date: date
+    body: str = ''
+    attachments: list = field(default_factory=list)  # [(filename, django File)]
+    summary: Optional[str] = None
+    summary_key: Optional[str] = None  # ключ в кэше резюме, если текст отправляется в модель
+    summary_status: str = 'done'  # pending — предварительное резюме, модель реферирует позже
+    duplicate: bool = False  # то же содержание уже в реестре: письмо не записывается и остаётся непрочитанным
+
+
+def chunked(items, size):
+    """Разбиение списка на последовательные пачки не длиннее size."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def uid_set(uids):
+    """Строка набора UID для команд UID FETCH/STORE: '1,2,5'."""
+    return ','.join(str(uid) for uid in uids)
+
+
+def select_mailbox(imap_server, folder='INBOX'):
+    """SELECT папки, возвращает пару (UIDVALIDITY, UIDNEXT) из ответа сервера."""
+    typ, data = imap_server.select(folder)
+    if typ != 'OK':
+        raise RuntimeError(f'SELECT {folder} failed: {data!r}')
+
+    def untagged_int(name):
+        _, values = imap_server.response(name)
+        value = values[0] if values else None
+        return int(value) if value else None
+
+    return untagged_int('UIDVALIDITY'), untagged_int('UIDNEXT')
+
+
+def uid_search(imap_server, *criteria):
+    """UID SEARCH, возвращает отсортированный список UID."""
+    typ, data = imap_server.uid('search', None, *criteria)
+    if typ != 'OK' or not data or not data[0]:
+        return []
+    return sorted(int(uid) for uid in data[0].split())
+
+
+def fetch_messages(imap_server, uids):
+    """Пакетный UID FETCH полного текста писем одним запросом.
+
+    Возвращает список пар (uid, raw_bytes) в порядке ответа сервера.
+    """
+    typ, data = imap_server.uid('fetch', uid_set(uids), '(RFC822)')
+    if typ != 'OK':
+        raise RuntimeError(f'UID FETCH failed: {typ} {data!r}')
+
+    messages = []
+    pending = None  # литерал, для которого UID пришёл после тела
+    for item in data:
+        if isinstance(item, tuple):
+            match = FETCH_UID_RE.search(item[0])
+            if match:
+                messages.append((int(match.group(1)), item[1]))
+            else:
+                pending = item[1]
+        elif pending is not None and isinstance(item, bytes):
+            match = FETCH_UID_RE.search(item)
+            if match:
+                messages.append((int(match.group(1)), pending))
+            pending = None
+    return messages
+
+
+def mark_seen(imap_server, uids):
+    """Пометить письма прочитанными одной командой UID STORE."""
+    if uids:
+        imap_server.uid('store', uid_set(uids), '+FLAGS', '(\\Seen)')
+
+
+# --- Разбор ответов FETCH (RFC 3501) -------------------------------------
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+
+
+def _tokenize(data):
+    """Токены ответа imaplib: '(' , ')', атомы (str), строки (str), литералы (bytes), None для NIL.
+
+    imaplib отдаёт ответ списком, где литерал {n} вынесен во второй элемент кортежа.
+    """
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            yield from _tokenize_line(LITERAL_RE.sub(b'', head.rstrip()))
+            yield literal
+        elif isinstance(item, bytes):
+            yield from _tokenize_line(item)
+
+
+def _tokenize_line(line):
+    pos, length = 0, len(line)
+    while pos < length:
+        char = line[pos:pos + 1]
+        if char in (b' ', b'\r', b'\n'):
+            pos += 1
+        elif char in (b'(', b')'):
+            yield char.decode()
+            pos += 1
+        elif char == b'"':
+            pos += 1
+            value = bytearray()
+            while pos < length and line[pos:pos + 1] != b'"':
+                if line[pos:pos + 1] == b'\\':
+                    pos += 1
+                value += line[pos:pos + 1]
+                pos += 1
+            pos += 1
+            yield QuotedString(value.decode('utf-8', errors='replace'))
+        else:
+            start, depth = pos, 0
+            while pos < length:
+                char = line[pos:pos + 1]
+                if char == b'[':
+                    depth += 1
+                elif char == b']':
+                    depth -= 1
+                elif depth == 0 and char in (b' ', b'(', b')', b'"'):
+                    break
+                pos += 1
+            atom = line[start:pos].decode('ascii', errors='replace')
+            yield None if atom.upper() == 'NIL' else atom
+
+
+class QuotedString(str):
+    """Строка в кавычках: отличается от атома при разборе, но ведёт себя как str."""
+
+
+def _parse_list(tokens):
+    result = []
+    for token in tokens:
+        if token == '(' and not isinstance(token, QuotedString):
+            result.append(_parse_list(tokens))
+        elif token == ')' and not isinstance(token, QuotedString):
+            return result
+        else:
+            result.append(token)
+    return result
+
+
+def parse_fetch_response(data):
+    """Разбор ответа UID FETCH в словари {имя элемента: значение} по одному на письмо.
+
+    Имена элементов приводятся к верхнему регистру: 'UID', 'BODYSTRUCTURE',
+    'BODY[HEADER]', 'BODY[2]<0>' и т. п.
+    """
+    tokens = iter(_tokenize(data))
+    messages = []
+    for token in tokens:
+        if token != '(':
+            continue  # порядковый номер письма перед списком элементов
+        values = _parse_list(tokens)
+        items = {}
+        for key, value in zip(values[::2], values[1::2]):
+            items[str(key).upper()] = value
+        if 'UID' in items:
+            items['UID'] = int(items['UID'])
+            messages.append(items)
+    return messages
+
+
+# --- BODYSTRUCTURE --------------------------------------------------------
+
+@dataclass
+class MessagePart:
+    """Одна часть письма из BODYSTRUCTURE."""
+    section: str
+    content_type: str
+    params: dict
+    encoding: str
+    size: int
+    disposition: Optional[str] = None
+    disposition_params: dict = field(default_factory=dict)
+
+    @property
+    def charset(self):
+        return self.params.get('charset') or 'utf-8'
+
+    @property
+    def filename(self):
+        name = _param(self.disposition_params, 'filename') or _param(self.params, 'name')
+        return decode_mime_words(name) if name else None
+
+    @property
+    def is_attachment(self):
+        return is_attachment(self.disposition, self.filename)
+
+
+def is_attachment(disposition, filename):
+    """Часть — вложение, если она приложена файлом (Content-Disposition: attachment) и у неё есть имя.
+
+    Одно правило для обоих режимов разбора: картинки, встроенные в HTML (inline), вложениями не считаются.
+    """
+    return bool(filename) and disposition == 'attachment'
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return value
+
+
+def _params(values):
+    """Список ("KEY" "value" ...) в словарь с ключами в нижнем регистре."""
+    if not isinstance(values, list):
+        return {}
+    return {_text(key).lower(): _text(value) for key, value in zip(values[::2], values[1::2])}
+
+
+def _param(params, name):
+    """Значение параметра с учётом RFC 2231: name, name*, name*0, name*0*."""
+    if name in params:
+        return params[name]
+    if f'{name}*' in params:
+        return _rfc2231(params[f'{name}*'])
+    pieces, index = [], 0
+    while f'{name}*{index}' in params or f'{name}*{index}*' in params:
+        encoded = f'{name}*{index}*' in params
+        pieces.append((encoded, params.get(f'{name}*{index}*', params.get(f'{name}*{index}'))))
+        index += 1
+    if not pieces:
+        return None
+    if pieces[0][0]:
+        return _rfc2231(''.join(value for _, value in pieces))
+    return ''.join(value for _, value in pieces)
+
+
+def _rfc2231(value):
+    """charset'lang'%XX%XX -> str."""
+    charset, language, text = decode_rfc2231(value)
+    return collapse_rfc2231_value((charset, language, unquote(text, encoding='latin-1')))
+
+
+def decode_mime_words(value):
+    """Декодирование заголовка вида =?utf-8?B?...?=, строки без кодирования возвращаются как есть."""
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def walk_bodystructure(structure, prefix=''):
+    """Плоский список MessagePart с номерами секций для BODY[n]."""
+    if structure and isinstance(structure[0], list):
+        # multipart: вложенные части идут первыми, за ними подтип и расширения
+        children = takewhile(lambda item: isinstance(item, list), structure)
+        parts = []
+        for index, child in enumerate(children, start=1):
+            parts.extend(walk_bodystructure(child, f'{prefix}{index}.'))
+        return parts
+
+    maintype, subtype = _text(structure[0]).lower(), _text(structure[1]).lower()
+    extension = 7
+    if maintype == 'text':
+        extension = 8
+    elif (maintype, subtype) == ('message', 'rfc822'):
+        extension = 10
+    disposition = structure[extension + 1] if len(structure) > extension + 1 else None
+    disposition_type, disposition_params = None, {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = _text(disposition[0]).lower()
+        disposition_params = _params(disposition[1] if len(disposition) > 1 else None)
+    return [MessagePart(
+        section=prefix.rstrip('.') or '1',
+        content_type=f'{maintype}/{subtype}',
+        params=_params(structure[2]),
+        encoding=(_text(structure[5]) or '7bit').lower(),
+        size=int(structure[6] or 0),
+        disposition=disposition_type,
+        disposition_params=disposition_params,
+    )]
+
+
+# --- Потоковая выгрузка частей --------------------------------------------
+
+class TransferDecoder:
+    """Инкрементальное декодирование base64 / quoted-printable по кускам произвольной длины."""
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or '7bit').lower()
+        self.pending = b''
+
+    def feed(self, data):
+        if self.encoding == 'base64':
+            data = self.pending + re.sub(rb'[^A-Za-z0-9+/=]', b'', data)
+            usable = len(data) - len(data) % 4
+            self.pending = data[usable:]
+            return binascii.a2b_base64(data[:usable]) if usable else b''
+        if self.encoding == 'quoted-printable':
+            data = self.pending + data
+            cut = data.rfind(b'\n') + 1
+            self.pending = data[cut:]
+            return binascii.a2b_qp(data[:cut])
+        return data
+
+    def flush(self):
+        data, self.pending = self.pending, b''
+        if not data:
+            return b''
+        if self.encoding == 'base64':
+            return binascii.a2b_base64(data + b'=' * (-len(data) % 4))
+        if self.encoding == 'quoted-printable':
+            return binascii.a2b_qp(data)
+        return data
+
+
+def fetch_text_parts(imap_server, requests, limit=65536):
+    """Загрузка текстовых частей писем: {uid: str}.
+
+    requests — список пар (uid, MessagePart). Письма с одинаковым номером
+    секции запрашиваются одним UID FETCH; читается не больше limit байт части.
+    """
+    by_section = {}
+    for uid, part in requests:
+        by_section.setdefault(part.section, []).append((uid, part))
+
+    texts = {}
+    for section, group in by_section.items():
+        parts = dict(group)
+        typ, data = imap_server.uid('fetch', uid_set(parts), f'(UID BODY.PEEK[{section}]<0.{limit}>)')
+        if typ != 'OK':
+            raise RuntimeError(f'UID FETCH BODY[{section}] failed: {data!r}')
+        for items in parse_fetch_response(data):
+            part = parts.get(items['UID'])
+            raw = next((value for key, value in items.items() if key.startswith('BODY[')), None)
+            if part is None or raw is None:
+                continue
+            if isinstance(raw, str):
+                raw = raw.encode()
+            decoder = TransferDecoder(part.encoding)
+            payload = decoder.feed(raw) + decoder.flush()
+            try:
+                texts[items['UID']] = payload.decode(part.charset, errors='ignore')
+            except LookupError:
+                texts[items['UID']] = payload.decode('utf-8', errors='ignore')
+    return texts
+
+
+def fetch_part(imap_server, uid, section, offset, length):
+    """Частичный UID FETCH BODY.PEEK[section]<offset.length>, возвращает сырые байты части."""
+    typ, data = imap_server.uid('fetch', str(uid), f'(BODY.PEEK[{section}]<{offset}.{length}>)')
+    if typ != 'OK':
+        raise RuntimeError(f'UID FETCH BODY[{section}] failed: {data!r}')
+    for items in parse_fetch_response(data):
+        for key, value in items.items():
+            if key.startswith('BODY['):
+                return value if isinstance(value, bytes) else (value or '').encode()
+    return b''
+
+
+class IMAPPartFile(File):
+    """Часть письма на IMAP-сервере, читаемая кусками при сохранении в хранилище.
+
+    Сырые данные запрашиваются частичными FETCH по chunk_size байт и сразу
+    декодируются, так что в памяти одновременно находится не больше одного куска.
+    """
+
+    def __init__(self, imap_server, uid, part, chunk_size=1024 * 1024):
+        super().__init__(None, name=part.filename)
+        self.imap_server = imap_server
+        self.uid = uid
+        self.part = part
+        self.chunk_size = chunk_size
+
+    @property
+    def size(self):
+        return self.part.size  # размер в кодировке передачи, оценка сверху
+
+    def multiple_chunks(self, chunk_size=None):
+        return True
+
+    def chunks(self, chunk_size=None):
+        decoder = TransferDecoder(self.part.encoding)
+        offset = 0
+        while True:
+            raw = fetch_part(self.imap_server, self.uid, self.part.section, offset, self.chunk_size)
+            offset += len(raw)
+            decoded = decoder.feed(raw)
+            if decoded:
+                yield decoded
+            if len(raw) < self.chunk_size:
+                break
+        tail = decoder.flush()
+        if tail:
+            yield tail
+
+    def read(self, size=-1):
+        return b''.join(self.chunks())
+
+    def open(self, mode=None):
+        return self
+
+    def close(self):
+        pass
@@ -0,0 +1,36 @@
+# registry/management/commands/archive_register.py
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Sum
+from registry import archive
+from registry.models import ArchivedIncoming, ArchivePack
+
+
+class Command(BaseCommand):
+	help = ('Move closed register records older than ARCHIVE_AFTER_DAYS into the archive tables '
+			'and pack their attachments into monthly zip files; --restore brings a record back')
+
+	def add_arguments(self, parser):
+		parser.add_argument('--older-than', type=int, help='Days since the incoming date and the deadline, default ARCHIVE_AFTER_DAYS')
+		parser.add_argument('--limit', type=int, help='Archive at most this many records')
+		parser.add_argument('--batch-size', type=int, help='Records per transaction, default ARCHIVE_BATCH_SIZE')
+		parser.add_argument('--dry-run', action='store_true', help='Only count the records that would be archived')
+		parser.add_argument('--restore', type=int, metavar='NUMBER', help='Move the archived record with this incoming number back')
+
+	def handle(self, *args, **options):
+		if options['restore'] is not None:
+			archived = ArchivedIncoming.objects.filter(incoming_number=options['restore']).first()
+			if archived is None:
+				raise CommandError(f"No archived record with number {options['restore']}")
+			incoming = archive.restore(archived)
+			self.stdout.write(self.style.SUCCESS(f'Restored {incoming} to the register'))
+			return
+
+		cutoff = archive.cutoff_date(options['older_than'])
+		if options['dry_run']:
+			self.stdout.write(f'{archive.candidates(cutoff).count()} records older than {cutoff} can be archived')
+			return
+		total = archive.archive_records(cutoff, limit=options['limit'], batch_size=options['batch_size'])
+		packs = ArchivePack.objects.aggregate(count=Count('pk'), size=Sum('size'))
+		self.stdout.write(self.style.SUCCESS(
+			f'Archived {total} records older than {cutoff}; {ArchivedIncoming.objects.count()} in the archive, '
+			f"{packs['count']} packs, {(packs['size'] or 0) / 1024 ** 2:.1f} MiB"))
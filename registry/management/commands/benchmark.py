@@ -0,0 +1,81 @@
+# registry/management/commands/benchmark.py
+import json
+import tempfile
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from registry import benchmarks
+
+COLUMNS = ('p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'queries', 'items_per_second')
+
+
+class Command(BaseCommand):
+	help = ('Benchmark the register views, the entry form and email ingestion on a synthetic register '
+			'in a separate test database; save the results as a JSON baseline and compare with a previous one')
+
+	def add_arguments(self, parser):
+		parser.add_argument('--scale', type=int, default=10000, help='Number of synthetic register records')
+		parser.add_argument('--attachments-every', type=int, default=10, help='Every N-th record gets two attachments')
+		parser.add_argument('--scenario', action='append', dest='scenarios', choices=benchmarks.SCENARIOS,
+							help='Scenario to run (repeatable), default: all')
+		parser.add_argument('--repeat', type=int, default=20, help='Measured repetitions per scenario')
+		parser.add_argument('--warmup', type=int, default=2, help='Unmeasured repetitions before each scenario')
+		parser.add_argument('--emails', type=int, default=50, help='Emails imported per process_emails repetition')
+		parser.add_argument('--imap-latency', type=float, default=0.0, help='Seconds the fake IMAP server waits before each response')
+		parser.add_argument('--summary-latency', type=float, default=0.0, help='Seconds the fake summarizer takes per email')
+		parser.add_argument('--deferred-summaries', action='store_true',
+							help='Import emails with provisional summaries, leaving the model to the summaries queue')
+		parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+		parser.add_argument('--output', help='Write the results to this JSON file (a new baseline)')
+		parser.add_argument('--baseline', help='Compare with a JSON file written earlier by --output')
+		parser.add_argument('--tolerance', type=float, default=0.25,
+							help='Allowed p95 growth against the baseline before it is reported as a regression')
+
+	def handle(self, *args, **options):
+		baseline = None
+		if options['baseline']:
+			try:
+				with open(options['baseline'], encoding='utf-8') as source:
+					baseline = json.load(source)
+			except (OSError, ValueError) as error:
+				raise CommandError(f"Cannot read baseline {options['baseline']}: {error}")
+
+		# Рабочая база и кэш страниц не затрагиваются: замер идёт на тестовой базе и своём кэше
+		cache_dir = tempfile.TemporaryDirectory()
+		caches = {**settings.CACHES, settings.REGISTER_CACHE_ALIAS: {
+			**settings.CACHES[settings.REGISTER_CACHE_ALIAS], 'LOCATION': cache_dir.name}}
+		old_config = setup_databases(verbosity=0, interactive=False)
+		try:
+			with override_settings(CACHES=caches, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+				started = time.monotonic()
+				benchmarks.generate_register(options['scale'], options['attachments_every'], options['seed'])
+				self.stdout.write(f"Generated {options['scale']} records in {time.monotonic() - started:.1f}s")
+				environment = benchmarks.environment(options['scale'])
+				results = benchmarks.run(
+					options['scenarios'], repeat=options['repeat'], warmup=options['warmup'],
+					emails=options['emails'], imap_latency=options['imap_latency'],
+					summary_latency=options['summary_latency'], deferred_summaries=options['deferred_summaries'],
+					seed=options['seed'],
+				)
+		finally:
+			teardown_databases(old_config, verbosity=0)
+			cache_dir.cleanup()
+
+		self.stdout.write(f"{'scenario':<18}" + ''.join(f'{column:>18}' for column in COLUMNS))
+		for name, row in results.items():
+			self.stdout.write(f'{name:<18}' + ''.join(f'{row[column]!s:>18}' for column in COLUMNS))
+
+		if options['output']:
+			with open(options['output'], 'w', encoding='utf-8') as target:
+				json.dump({'environment': environment, 'scenarios': results}, target, indent=2, ensure_ascii=False)
+			self.stdout.write(f"Baseline written to {options['output']}")
+
+		if baseline is not None:
+			if baseline.get('environment', {}).get('scale') != options['scale']:
+				self.stderr.write(f"Baseline was measured at scale {baseline.get('environment', {}).get('scale')}, "
+								  f"this run at {options['scale']}: timings are not comparable")
+			regressions = benchmarks.compare(results, baseline.get('scenarios', {}), options['tolerance'])
+			if regressions:
+				raise CommandError('Performance regressions against the baseline:\n' + '\n'.join(regressions))
+			self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
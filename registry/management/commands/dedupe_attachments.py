@@ -0,0 +1,67 @@
+# registry/management/commands/dedupe_attachments.py
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from registry.models import Attachment
+from registry.storage import BLOB_DIR, file_digest
+
+
+class Command(BaseCommand):
+	help = 'Move existing attachment files into content-addressed blobs and delete duplicates'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=500)
+		parser.add_argument('--dry-run', action='store_true', help='Only report how much space deduplication would free')
+		parser.add_argument('--gc', action='store_true', help='Also delete blobs that no attachment references')
+
+	def handle(self, *args, **options):
+		storage = Attachment._meta.get_field('file').storage
+		batch_size = max(1, options['batch_size'])
+		legacy = Attachment.objects.exclude(file__startswith=BLOB_DIR + '/').exclude(file='').order_by('pk')
+		seen = set()
+		moved = missing = 0
+		total_bytes = duplicate_bytes = 0
+		last_pk = 0
+		while True:
+			batch = list(legacy.filter(pk__gt=last_pk)[:batch_size])
+			if not batch:
+				break
+			last_pk = batch[-1].pk
+			updated, old_names = [], []
+			for attachment in batch:
+				name = attachment.file.name
+				if not storage.exists(name):
+					missing += 1
+					self.stderr.write(f'Missing file for attachment {attachment.pk}: {name}')
+					continue
+				with storage.open(name, 'rb') as source:
+					digest = file_digest(source)
+				size = storage.size(name)
+				total_bytes += size
+				if digest in seen or storage.exists(storage.blob_name(digest)):
+					duplicate_bytes += size
+				seen.add(digest)
+				if options['dry_run']:
+					continue
+				attachment.file.name = storage.adopt(name, digest, keep_source=True)
+				attachment.sha256 = digest
+				updated.append(attachment)
+				old_names.append(name)
+			if updated:
+				with transaction.atomic():
+					Attachment.objects.bulk_update(updated, ['file', 'sha256'])
+				# Старые файлы удаляются после фиксации, и только если на них больше никто не ссылается
+				for name in old_names:
+					storage.collect(name)
+				moved += len(updated)
+
+		collected = 0
+		if options['gc'] and not options['dry_run']:
+			for name in storage.unreferenced_blobs():
+				storage.delete(name)
+				collected += 1
+
+		verb = 'Would free' if options['dry_run'] else 'Freed'
+		self.stdout.write(self.style.SUCCESS(
+			f'{moved} attachments moved to blobs, {missing} files missing, {collected} unreferenced blobs deleted. '
+			f'{verb} {duplicate_bytes / 1024 / 1024:.1f} MB of {total_bytes / 1024 / 1024:.1f} MB.'
+		))
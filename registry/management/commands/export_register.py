@@ -0,0 +1,37 @@
+# registry/management/commands/export_register.py
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from registry.filters import FILTER_PARAMS, filter_incoming, get_filters
+from registry.register_io import export_rows, file_format, write_csv, write_xlsx
+
+
+class Command(BaseCommand):
+	help = 'Export the register to a CSV or XLSX file'
+
+	def add_arguments(self, parser):
+		parser.add_argument('path', help='Output file')
+		parser.add_argument('--format', choices=['csv', 'xlsx'], help='File format (by default taken from the extension)')
+		parser.add_argument('--filter', action='append', default=[], metavar='NAME=VALUE',
+			help=f'Register filter, may be repeated: {", ".join(FILTER_PARAMS)}')
+		parser.add_argument('--chunk-size', type=int, default=2000)
+		parser.add_argument('--delimiter', default=',', help='CSV delimiter')
+
+	def handle(self, *args, **options):
+		params = {}
+		for item in options['filter']:
+			name, _, value = item.partition('=')
+			if name not in FILTER_PARAMS:
+				raise CommandError(f'Unknown filter {name!r}')
+			params[name] = value
+		rows = export_rows(filter_incoming(get_filters(params)), chunk_size=max(1, options['chunk_size']))
+
+		path = options['path']
+		try:
+			if (options['format'] or file_format(path)) == 'xlsx':
+				count = write_xlsx(rows, path)
+			else:
+				with open(path, 'w', encoding='utf-8', newline='') as stream:
+					count = write_csv(rows, stream, options['delimiter'])
+		except (ImproperlyConfigured, OSError) as error:
+			raise CommandError(str(error))
+		self.stdout.write(self.style.SUCCESS(f'Exported {count} rows to {path}.'))
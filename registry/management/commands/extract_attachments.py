@@ -0,0 +1,33 @@
+# registry/management/commands/extract_attachments.py
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from registry import extraction
+from registry.models import AttachmentContent
+
+
+class Command(BaseCommand):
+	help = 'Extract text and previews from attachments that have not been processed yet'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--workers', type=int, default=None, help='Parser processes (default EXTRACTION_WORKERS, 0 runs inline)')
+		parser.add_argument('--batch-size', type=int, default=None)
+		parser.add_argument('--limit', type=int, default=None, help='Stop after this many files')
+		parser.add_argument('--retry-unsupported', action='store_true', help='Requeue files skipped for a missing library')
+		parser.add_argument('--retry-failed', action='store_true', help='Requeue files whose extraction failed')
+		parser.add_argument('--stale-minutes', type=int, default=60, help='Requeue files stuck in processing for this long')
+
+	def handle(self, *args, **options):
+		statuses = []
+		if options['retry_unsupported']:
+			statuses.append(AttachmentContent.UNSUPPORTED)
+		if options['retry_failed']:
+			statuses.append(AttachmentContent.FAILED)
+		if statuses:
+			self.stdout.write(f'{extraction.retry(statuses)} files requeued')
+		processed = extraction.run(
+			batch_size=options['batch_size'],
+			workers=options['workers'],
+			stale_after=timedelta(minutes=options['stale_minutes']),
+			limit=options['limit'],
+		)
+		self.stdout.write(self.style.SUCCESS(f'{processed} attachments processed'))
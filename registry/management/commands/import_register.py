@@ -0,0 +1,53 @@
+# registry/management/commands/import_register.py
+import time
+from contextlib import contextmanager
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from registry.models import NumberCounter
+from registry.register_io import file_format, import_rows, max_number, read_csv, read_xlsx
+
+
+class Command(BaseCommand):
+	help = 'Import register rows from a CSV or XLSX file in batches'
+
+	def add_arguments(self, parser):
+		parser.add_argument('path', help='CSV or XLSX file; the first row must contain column names')
+		parser.add_argument('--format', choices=['csv', 'xlsx'], help='File format (by default taken from the extension)')
+		parser.add_argument('--batch-size', type=int, default=1000)
+		parser.add_argument('--delimiter', default=',', help='CSV delimiter')
+		parser.add_argument('--skip-existing', action='store_true',
+			help='Skip rows whose incoming_number is already in the register instead of failing')
+
+	@contextmanager
+	def open_rows(self, options):
+		"""Строки файла; файл читается дважды, поэтому открывается заново на каждый проход."""
+		path = options['path']
+		if (options['format'] or file_format(path)) == 'xlsx':
+			yield read_xlsx(path)
+		else:
+			with open(path, encoding='utf-8-sig', newline='') as stream:
+				yield read_csv(stream, options['delimiter'])
+
+	def handle(self, *args, **options):
+		started = time.monotonic()
+		created = skipped = 0
+		try:
+			# Первый проход: явные номера файла резервируются до выдачи номеров остальным строкам
+			with self.open_rows(options) as rows:
+				highest = max_number(rows)
+			if highest:
+				NumberCounter.objects.reserve(highest)
+
+			with self.open_rows(options) as rows:
+				for batch_created, batch_skipped in import_rows(
+						rows, max(1, options['batch_size']), options['skip_existing']):
+					created += batch_created
+					skipped += batch_skipped
+					if options['verbosity'] > 1:
+						self.stdout.write(f'{created} rows imported')
+		except (ImproperlyConfigured, OSError, ValueError) as error:
+			raise CommandError(f'Import stopped after {created} rows: {error}')
+		elapsed = time.monotonic() - started
+		self.stdout.write(self.style.SUCCESS(
+			f'Imported {created} rows, skipped {skipped} existing in {elapsed:.1f}s.'
+		))
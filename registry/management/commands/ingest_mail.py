@@ -0,0 +1,77 @@
+# registry/management/commands/ingest_mail.py
+import logging
+import signal
+import threading
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from registry.imap import close_connection, idle, mailboxes, open_connection
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+	help = 'Run the mail ingestion service: hold IDLE connections to the mailboxes and import new mail within seconds'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--mailbox', action='append', dest='mailboxes', help='Name of a mailbox from MAILBOXES (repeatable)')
+		parser.add_argument('--idle-timeout', type=int, default=settings.EMAIL_IDLE_TIMEOUT,
+							help='Seconds before IDLE is restarted and the mailbox is checked anyway')
+
+	def ingest(self, config):
+		"""Импорт новых писем ящика тем же путём, что и по расписанию (process_emails)."""
+		try:
+			call_command('process_emails', mailboxes=[config.name], immediate=True, stdout=self.stdout)
+		finally:
+			close_old_connections()
+
+	def watch(self, config, idle_timeout):
+		"""Отдельное соединение в IDLE на ящик; после обрыва — переподключение с удвоением паузы."""
+		delay = 1
+		while not self.stop.is_set():
+			imap_server = None
+			try:
+				imap_server = open_connection(config)
+				imap_server.select(config.folder, readonly=True)
+				logger.info(f'Watching mailbox {config.name} with IDLE.')
+				delay = 1
+				# Письма, пришедшие, пока соединения не было
+				self.ingest(config)
+				while not self.stop.is_set():
+					if idle(imap_server, idle_timeout, self.stop):
+						logger.info(f'New mail in {config.name}.')
+					if not self.stop.is_set():
+						# И по таймауту: уведомление могло потеряться
+						self.ingest(config)
+			except Exception as e:
+				logger.warning(f'Mailbox {config.name}: {e}; reconnecting in {delay}s.')
+				self.stderr.write(f'Mailbox {config.name}: {e}; reconnecting in {delay}s.')
+				self.stop.wait(delay)
+				delay = min(settings.EMAIL_RECONNECT_MAX_DELAY, delay * 2)
+			finally:
+				if imap_server is not None:
+					close_connection(imap_server)
+
+	def handle(self, *args, **options):
+		configs = mailboxes(options['mailboxes'])
+		if not configs:
+			raise CommandError('No mailboxes configured, see MAILBOXES in settings')
+		self.stop = threading.Event()
+		signal.signal(signal.SIGTERM, lambda *_: self.stop.set())
+
+		threads = [
+			threading.Thread(target=self.watch, args=(config, options['idle_timeout']), name=f'imap-{config.name}', daemon=True)
+			for config in configs
+		]
+		for thread in threads:
+			thread.start()
+		self.stdout.write(f'Watching {", ".join(config.name for config in configs)}. Press Ctrl+C to stop.')
+		try:
+			while not self.stop.wait(1):
+				pass
+		except KeyboardInterrupt:
+			self.stop.set()
+		self.stdout.write('Stopping mail ingestion...')
+		for thread in threads:
+			thread.join(timeout=settings.EMAIL_CONNECT_TIMEOUT)
@@ -0,0 +1,50 @@
+# registry/management/commands/loadtest.py
+import json
+import os
+from django.core.management.base import BaseCommand, CommandError
+from registry.loadtest import LoadTestError, login, run
+
+DEFAULT_PATHS = ('/incoming/', '/incoming/?search=письмо', '/incoming/?after=100')
+COLUMNS = ('requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+class Command(BaseCommand):
+	help = 'Load-test the register pages of a running server and compare results between deployments'
+
+	def add_arguments(self, parser):
+		parser.add_argument('base_url', help='Server root, e.g. http://127.0.0.1:8000')
+		parser.add_argument('--path', action='append', dest='paths', help='Page to request (repeatable), default: register pages')
+		parser.add_argument('--users', type=int, default=50, help='Concurrent users')
+		parser.add_argument('--duration', type=float, default=30, help='Seconds to run')
+		parser.add_argument('--username', help='Log in as this user before the run')
+		parser.add_argument('--password', default='')
+		parser.add_argument('--label', default='run', help='Name of this run in the results file, e.g. wsgi or asgi')
+		parser.add_argument('--output', help='JSON file that collects results of several runs for comparison')
+
+	def handle(self, *args, **options):
+		base_url = options['base_url'].rstrip('/')
+		urls = [base_url + path for path in options['paths'] or DEFAULT_PATHS]
+		cookie = ''
+		if options['username']:
+			try:
+				cookie = login(base_url, options['username'], options['password'])
+			except (LoadTestError, OSError) as error:
+				raise CommandError(str(error))
+
+		self.stdout.write(f"{options['users']} users for {options['duration']:g}s against {base_url}")
+		summary = run(urls, users=options['users'], duration=options['duration'], cookie=cookie)
+
+		results = {}
+		if options['output'] and os.path.exists(options['output']):
+			with open(options['output'], encoding='utf-8') as source:
+				results = json.load(source)
+		results[options['label']] = summary
+		if options['output']:
+			with open(options['output'], 'w', encoding='utf-8') as target:
+				json.dump(results, target, indent=2)
+
+		self.stdout.write(f"{'label':<12}" + ''.join(f'{column:>10}' for column in COLUMNS))
+		for label, row in results.items():
+			self.stdout.write(f'{label:<12}' + ''.join(f'{row[column]!s:>10}' for column in COLUMNS))
+		if summary['errors']:
+			self.stderr.write(f"{summary['errors']} requests failed")
@@ -1,15 +1,31 @@
 # registry/management/commands/process_emails.py
-import imaplib
+import argparse
 import email
+from collections import Counter
+from contextlib import ExitStack
 from email.header import decode_header
 from email.utils import parseaddr
 from datetime import datetime, timedelta
 from django.core.management.base import BaseCommand
 from django.core.files.base import ContentFile
 from django.conf import settings
-from registry.models import Incoming, Attachment
+from django.db import transaction
+from django.utils import timezone
+from registry.models import (
+	ArchivedIncoming, Incoming, Attachment, DeadlineSummary, IngestionRun, MailboxBatch, MailboxSyncState,
+	NumberCounter, SummaryRequest,
+)
+from registry import ingestion, summaries, summarizers
+from registry.metrics import collect, stage
+from registry.imap import mailboxes, pool
+from registry.summary_cache import SummaryCache, cache_key
+from registry.search import index_many
+from registry.page_cache import bump_register_version
+from registry.mail import (
+	IncomingEmail, IMAPPartFile, chunked, select_mailbox, uid_search, uid_set,
+	fetch_messages, fetch_text_parts, is_attachment, mark_seen, parse_fetch_response, walk_bodystructure,
+)
 import logging
-import g4f
 import asyncio
 import aiohttp
 
@@ -17,7 +33,49 @@ logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
-	help = 'Process unread emails from Gmail INBOX, create Incoming records, and mark emails as read'
+	help = ('Scan the configured mailboxes for new messages, split them into UID batches and process the batches '
+			'(create Incoming records, mark emails as read); safe to run on several workers at once')
+	deferred = False  # Отложенное реферирование; задаётся в handle
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--batch-size', type=int, default=settings.EMAIL_FETCH_BATCH_SIZE,
+			help='Number of messages fetched from IMAP with one UID FETCH command',
+		)
+		parser.add_argument(
+			'--concurrency', type=int, default=settings.EMAIL_SUMMARY_CONCURRENCY,
+			help='Maximum number of summaries requested at the same time',
+		)
+		parser.add_argument(
+			'--full-resync', action='store_true',
+			help='Ignore the stored UID high-water mark and rescan the whole mailbox',
+		)
+		parser.add_argument(
+			'--mailbox', action='append', dest='mailboxes',
+			help='Name of a mailbox from MAILBOXES (repeatable), default: all of them',
+		)
+		parser.add_argument(
+			'--immediate', action='store_true',
+			help='Scan even if the mailbox is backing off (used when IDLE reports new mail)',
+		)
+		parser.add_argument(
+			'--no-scan', action='store_false', dest='scan',
+			help='Only process batches that are already scheduled, do not look for new messages',
+		)
+		parser.add_argument(
+			'--max-batches', type=int, default=None,
+			help='Stop after processing this many batches (0 only scans the mailbox)',
+		)
+		parser.add_argument(
+			'--streaming', action=argparse.BooleanOptionalAction, default=settings.EMAIL_STREAM_ATTACHMENTS,
+			help='Fetch BODYSTRUCTURE first and stream attachments to storage in chunks '
+				 'instead of downloading whole messages',
+		)
+		parser.add_argument(
+			'--deferred-summaries', action=argparse.BooleanOptionalAction, default=settings.EMAIL_DEFERRED_SUMMARIES,
+			help='Create records right away with a provisional summary and let the summaries queue '
+				 'request model summaries (default); --no-deferred-summaries waits for the model',
+		)
 
 	def decode_email_subject(self, subject):
 		"""Декодирование заголовка письма или имени отправителя."""
@@ -37,161 +95,509 @@ class Command(BaseCommand):
 			return decoded_name if decoded_name else email_addr
 		return email_addr
 
-	async def async_summarize(self, prompt):
-		"""Асинхронный вызов g4f с таймаутом для модели gpt-4o-mini."""
+	def apply_cached_summaries(self, emails):
+		"""Подстановка резюме из кэша; возвращает письма, которым нужен запрос к модели."""
+		for item in emails:
+			item.summary_key = cache_key(summarizers.build_prompt(item.body)) if item.body else None
+		cached = self.summary_cache.get_many(item.summary_key for item in emails if item.summary_key)
+		pending, queued = [], set()
+		for item in emails:
+			if item.summary_key in cached:
+				item.summary = cached[item.summary_key]
+			elif item.summary_key not in queued:
+				pending.append(item)
+				if item.summary_key:
+					queued.add(item.summary_key)
+			# Одинаковые тексты в одной пачке (рассылки) реферируются один раз
+		return pending
+
+	def copy_shared_summaries(self, emails):
+		"""Заполнение резюме писем с тем же текстом, что и у уже реферированных."""
+		shared = {item.summary_key: (item.summary, item.summary_status)
+				  for item in emails if item.summary_key and item.summary is not None}
+		for item in emails:
+			if item.summary is None:
+				item.summary, item.summary_status = shared[item.summary_key]
+
+	def defer_summaries(self, emails):
+		"""Предварительные резюме из текста писем; резюме моделей запросит очередь summaries."""
+		for item in emails:
+			item.summary = summaries.provisional_summary(item.body, item.subject)
+			if item.body:
+				item.summary_status = Incoming.SUMMARY_PENDING
+
+	def dedup_summary(self, item):
+		# При отложенном реферировании ключ дубликата строится по предварительному резюме:
+		# оно однозначно определяется текстом, а резюме модели может прийти позже или из кэша
+		if self.deferred:
+			return summaries.provisional_summary(item.body, item.subject)
+		return item.summary
+
+	async def summarize_all(self, emails, session, concurrency):
+		"""Реферирование пачки писем цепочкой моделей (summarizers.py).
+
+		Письма без текста получают тему. Возвращает {ключ кэша: резюме}
+		для резюме, которые стоит сохранить в кэше (полученных от модели).
+		"""
+		for item in emails:
+			if not item.body:
+				logger.warning("Empty email content, using subject as summary.")
+				item.summary = item.subject[:200]
+		with_text = [item for item in emails if item.body]
+		results = await self.summarizer.summarize_many([item.body for item in with_text], session, concurrency)
+		generated = {}
+		for item, (summary, backend) in zip(with_text, results):
+			item.summary = summary or item.body[:200] or item.subject
+			if backend is not None and backend.cacheable and item.summary_key:
+				generated[item.summary_key] = item.summary
+			self.summarized_by[backend.name if backend else 'none'] += 1
+		return generated
+
+	async def _open_session(self):
+		"""Сессия aiohttp должна создаваться внутри работающего цикла событий."""
+		return aiohttp.ClientSession()
+
+	def message_id(self, msg):
+		"""Ключ идемпотентности письма: Message-ID или хэш заголовков, если его нет."""
+		return Incoming.make_message_id(msg.get('Message-ID'), msg.get('From'), msg.get('Date'), msg.get('Subject'))
+
+	def parse_headers(self, msg):
+		"""Отправитель, тема и дата поступления из заголовков письма."""
+		from_header = msg.get('From', 'Unknown')
+		from_email = self.decode_email_from(from_header)
+		subject = self.decode_email_subject(msg.get('Subject', 'No Subject'))
+		date_str = msg.get('Date')
 		try:
-			# Проверка доступности модели
-			model = g4f.models.gpt_4o_mini
-			if not model.best_provider:
-				logger.error("No provider available for model: gpt-4o-mini")
-				return None
-
-			async with aiohttp.ClientSession() as session:
-				logger.info("Attempting to summarize with model: gpt-4o-mini")
-				response = await asyncio.wait_for(
-					g4f.ChatCompletion.create_async(
-						model="gpt-4o-mini",
-						messages=[{"role": "user", "content": prompt}],
-						max_tokens=200,
-						session=session
-					),
-					timeout=20.0  # Таймаут 20 секунд
-				)
-				# Обработка ответа
-				if isinstance(response, str):
-					logger.warning("g4f returned a string instead of an object.")
-					return response.strip()
-				elif hasattr(response, 'choices') and response.choices:
-					return response.choices[0].message.content.strip()
-				else:
-					logger.warning("Invalid response format from g4f.")
-					return None
-		except asyncio.TimeoutError:
-			logger.warning("g4f summarization timed out after 20 seconds.")
-			return None
+			email_date = email.utils.parsedate_to_datetime(date_str)
+			incoming_date = email_date.date()
 		except Exception as e:
-			logger.error(f"Failed to summarize email with g4f: {e}")
-			return None
+			logger.warning(f'Failed to parse email date: {e}')
+			incoming_date = datetime.now().date()
+		return from_email, subject, incoming_date
+
+	def parse_email(self, uid, email_body):
+		"""Разбор письма: отправитель, дата, текст и вложения."""
+		msg = email.message_from_bytes(email_body)
+		from_email, subject, incoming_date = self.parse_headers(msg)
+
+		raw_summary = ""
+		if msg.is_multipart():
+			for part in msg.walk():
+				if part.get_content_type() == 'text/plain' and part.get_content_disposition() != 'attachment':
+					try:
+						raw_summary = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+					except Exception as e:
+						logger.warning(f'Failed to decode text/plain part: {e}')
+					break
+		else:
+			try:
+				raw_summary = msg.get_payload(decode=True).decode('utf-8', errors='ignore')
+			except Exception as e:
+				logger.warning(f'Failed to decode single-part payload: {e}')
+
+		attachments = []
+		if msg.is_multipart():
+			for part in msg.walk():
+				if part.get_content_maintype() == 'multipart':
+					continue
+				filename = part.get_filename()
+				# То же правило, что и в потоковом режиме: встроенные (inline) части — не вложения
+				if is_attachment(part.get_content_disposition(), filename):
+					try:
+						decoded_filename = self.decode_email_subject(filename)
+						attachments.append((decoded_filename, ContentFile(part.get_payload(decode=True))))
+					except Exception as e:
+						logger.error(f'Failed to process attachment {filename}: {e}')
+
+		return IncomingEmail(
+			uid=uid,
+			message_id=self.message_id(msg),
+			applicant=from_email,
+			subject=subject,
+			incoming_date=incoming_date,
+			body=raw_summary,
+			attachments=attachments,
+		)
+
+	def find_new_uids(self, imap_server, state, uidvalidity, full_resync=False):
+		"""Выбор UID писем для обработки по сохранённой отметке синхронизации."""
+		if full_resync:
+			logger.warning(f'Full resync requested for {state.mailbox}, rescanning all messages.')
+			state.last_uid = 0
+			return uid_search(imap_server, 'ALL')
+		if state.uidvalidity is None:
+			# Первый запуск: начинаем с непрочитанных, дальше работаем только по UID
+			logger.info(f'No sync state for {state.mailbox}, starting from unread messages.')
+			return uid_search(imap_server, 'UNSEEN')
+		if state.uidvalidity != uidvalidity:
+			# Сервер перенумеровал письма: старые UID недействительны. Пересматривается весь ящик:
+			# SINCE по дате пропустил бы письма, перенесённые в папку со старой датой;
+			# уже импортированные отсеиваются по Message-ID
+			logger.warning(
+				f'UIDVALIDITY of {state.mailbox} changed from {state.uidvalidity} to {uidvalidity}, '
+				f'rescanning all messages.'
+			)
+			state.last_uid = 0
+			return uid_search(imap_server, 'ALL')
+		# 'UID n:*' всегда возвращает хотя бы последнее письмо, даже если его UID меньше n
+		return [uid for uid in uid_search(imap_server, 'UID', f'{state.last_uid + 1}:*') if uid > state.last_uid]
+
+	def fetch_streaming(self, imap_server, uids):
+		"""Разбор пачки писем без загрузки их целиком.
+
+		Сначала одним запросом берутся заголовки и BODYSTRUCTURE, затем только
+		текстовые части; вложения остаются на сервере и читаются кусками
+		при сохранении в хранилище.
+		"""
+		typ, data = imap_server.uid('fetch', uid_set(uids), '(UID BODYSTRUCTURE BODY.PEEK[HEADER])')
+		if typ != 'OK':
+			raise RuntimeError(f'UID FETCH BODYSTRUCTURE failed: {data!r}')
+
+		emails, text_requests = [], []
+		for items in parse_fetch_response(data):
+			uid = items['UID']
+			msg = email.message_from_bytes(items.get('BODY[HEADER]') or b'')
+			from_email, subject, incoming_date = self.parse_headers(msg)
+			parts = walk_bodystructure(items.get('BODYSTRUCTURE') or [])
+
+			if len(parts) == 1 and not parts[0].filename:
+				text_part = parts[0]
+			else:
+				# Текст — первая text/plain, не приложенная файлом: .txt во вложении остаётся вложением
+				text_part = next((part for part in parts
+								  if part.content_type == 'text/plain' and part.disposition != 'attachment'), None)
+			if text_part is not None:
+				text_requests.append((uid, text_part))
+
+			emails.append(IncomingEmail(
+				uid=uid,
+				message_id=self.message_id(msg),
+				applicant=from_email,
+				subject=subject,
+				incoming_date=incoming_date,
+				attachments=[
+					(part.filename, IMAPPartFile(imap_server, uid, part, settings.EMAIL_STREAM_CHUNK_SIZE))
+					for part in parts if part.is_attachment
+				],
+			))
+
+		texts = fetch_text_parts(imap_server, text_requests)
+		for item in emails:
+			item.body = texts.get(item.uid, '')
+		return emails
+
+	def filter_duplicates(self, emails):
+		"""Отбрасывание уже импортированных писем (по Message-ID) и писем с тем же отправителем, датой и содержанием."""
+		keys = {
+			id(item): Incoming.make_dedup_key(item.applicant, item.incoming_date, self.dedup_summary(item))
+			for item in emails
+		}
+		existing = set(
+			Incoming.objects.filter(dedup_key__in=set(keys.values())).values_list('dedup_key', flat=True)
+		)
+		message_ids = [item.message_id for item in emails]
+		# Архивные письма тоже считаются импортированными: после смены UIDVALIDITY ящик просматривается заново
+		imported = set(Incoming.objects.filter(message_id__in=message_ids).values_list('message_id', flat=True))
+		imported |= set(ArchivedIncoming.objects.filter(message_id__in=message_ids).values_list('message_id', flat=True))
+		fresh = []
+		for item in emails:
+			key = keys[id(item)]
+			if item.message_id in imported:
+				logger.info(f'Skipping already imported email {item.uid} ({item.message_id})')
+				continue
+			if key in existing:
+				logger.info(f'Skipping duplicate email {item.uid} from {item.applicant}')
+				item.duplicate = True
+				continue
+			existing.add(key)
+			imported.add(item.message_id)
+			fresh.append(item)
+		return fresh
 
-	def summarize_email_content(self, text, subject):
-		"""Получение краткого содержания с помощью g4f с таймаутом."""
-		if not text:
-			logger.warning("Empty email content, using subject as summary.")
-			return subject[:200]
+	def store_attachments(self, item):
+		"""Сохранение вложений письма в хранилище; возвращает [(имя файла, путь в хранилище)]."""
+		field = Attachment._meta.get_field('file')
+		stored = []
+		for filename, content in item.attachments:
+			try:
+				name = field.storage.save(
+					field.generate_filename(None, filename), content, max_length=field.max_length
+				)
+				stored.append((filename, name))
+				logger.info(f'Saved attachment: {filename}')
+			except Exception as e:
+				logger.error(f'Failed to process attachment {filename}: {e}')
+		return stored
+
+	def write_batch(self, emails):
+		"""Запись пачки писем в реестр одной транзакцией.
+
+		Файлы вложений сохраняются до транзакции, чтобы долгая выгрузка
+		не держала блокировку БД; при откате они удаляются. Если то же письмо
+		одновременно записал другой воркер, уникальный message_id откатывает
+		транзакцию, а при повторе пачки письмо отсеивается как импортированное.
+		Возвращает список созданных записей Incoming.
+		"""
+		with stage('dedup'):
+			fresh = self.filter_duplicates(emails)
+		with stage('attachments'):
+			stored = [self.store_attachments(item) for item in fresh]
+		try:
+			with stage('db'), transaction.atomic():
+				records = self.create_records(fresh, stored)
+		except Exception:
+			# Blob может оказаться общим с другими вложениями: удаляется, только если на него нет ссылок
+			storage = Attachment._meta.get_field('file').storage
+			for files in stored:
+				for _, name in files:
+					storage.collect(name)
+			raise
+
+		for incoming in records:
+			logger.info(f'Created Incoming record for email from {incoming.applicant} with summary: {incoming.summary[:50]}...')
+			self.stdout.write(self.style.SUCCESS(f'Created Incoming record for email from {incoming.applicant}'))
+		return records
+
+	def create_records(self, fresh, stored):
+		"""Массовое создание Incoming и Attachment для новых писем."""
+		if not fresh:
+			return []
+		numbers = NumberCounter.objects.allocate(len(fresh))
+		records = Incoming.objects.bulk_create([
+			Incoming(
+				incoming_number=number,
+				incoming_date=item.incoming_date,
+				applicant=item.applicant,
+				summary=item.summary,
+				summary_status=item.summary_status,
+				responsible="Default Responsible",
+				response_deadline=item.incoming_date + timedelta(days=10),
+				dedup_key=Incoming.make_dedup_key(item.applicant, item.incoming_date, self.dedup_summary(item)),
+				message_id=item.message_id,
+			)
+			for number, item in zip(numbers, fresh)
+		])
+		storage = Attachment._meta.get_field('file').storage
+		Attachment.objects.bulk_create([
+			Attachment(incoming=incoming, file=name, filename=filename, sha256=storage.digest(name))
+			for incoming, files in zip(records, stored)
+			for filename, name in files
+		])
+		SummaryRequest.objects.bulk_create([
+			SummaryRequest(incoming=incoming, text=item.body[:summarizers.MAX_TEXT])
+			for incoming, item in zip(records, fresh) if incoming.summary_status == Incoming.SUMMARY_PENDING
+		])
+		index_many(records)
+		DeadlineSummary.objects.add_records(records)
+		bump_register_version()
+		return records
 
-		prompt = f"Перескажи краткое содержание этого письма на русском языке в пределах 200 символов:\n\n{text[:10000]}"  # Ограничиваем текст до 10,000 символов
-		# Запускаем асинхронный цикл для выполнения запроса
-		loop = asyncio.new_event_loop()
-		asyncio.set_event_loop(loop)
+	def scan(self, imap_server, mailbox, state, owner, full_resync=False):
+		"""Поиск новых писем и разбиение их на пачки под арендой ящика; возвращает число пачек."""
+		if not MailboxSyncState.objects.acquire(state.pk, owner, settings.EMAIL_LEASE_SECONDS):
+			# Предыдущий просмотр ещё идёт: запуски наложились
+			logger.warning(f'Mailbox {state.mailbox} is being scanned by another worker, backing off.')
+			ingestion.note_overrun(state)
+			return 0
+		overran = True
 		try:
-			summary = loop.run_until_complete(self.async_summarize(prompt))
-			if summary:
-				logger.info("Successfully generated summary with g4f.")
-				return summary[:200]
+			state.refresh_from_db()
+			backlog = ingestion.has_backlog(state)
+			uidvalidity, uidnext = select_mailbox(imap_server, mailbox.folder)
+			self.selected[id(imap_server)] = uidvalidity
+			uids = self.find_new_uids(imap_server, state, uidvalidity, full_resync)
+			batches = ingestion.schedule_batches(state, uidvalidity, uids, uidnext)
+			if not uids:
+				logger.info(f'No new emails found in {mailbox.name}.')
+				self.stdout.write(f'No new emails found in {mailbox.name}.')
 			else:
-				logger.warning("Empty summary returned by g4f.")
-				return text[:200] or subject
+				self.stdout.write(f'Scheduled {len(uids)} emails from {mailbox.name} in {len(batches)} batches.')
+			# Пачки прошлого просмотра ещё не разобраны: воркеры не успевают, просмотры реже
+			overran = backlog
+			return len(batches)
 		finally:
-			loop.close()
+			ingestion.finish_scan(state, owner, overran)
 
-	def handle(self, *args, **kwargs):
-		"""Обработка только непрочитанных писем из папки Входящие."""
-		logger.info('Starting email processing for unread messages in INBOX...')
-		self.stdout.write('Starting email processing for unread messages in INBOX...')
+	def dispatch_summaries(self, records):
+		"""Постановка новых записей в очередь реферирования; без брокера их позже подберёт requeue."""
+		ids = [incoming.pk for incoming in records if incoming.summary_status == Incoming.SUMMARY_PENDING]
+		if not ids:
+			return
+		try:
+			summaries.dispatch(ids)
+		except Exception as e:
+			logger.warning(f'Could not queue {len(ids)} summaries ({e}), they will be requeued later.')
+
+	def summary_session(self):
+		if self.session is None:
+			# Одна HTTP-сессия на весь запуск вместо новой на каждое письмо
+			self.session = self.loop.run_until_complete(self._open_session())
+		return self.session
+
+	def process_batch(self, imap_server, mailbox, batch, owner, options):
+		"""Разбор одной пачки UID; возвращает (обработано писем, создано записей)."""
+		uidvalidity = self.selected.get(id(imap_server))
+		if uidvalidity is None:
+			uidvalidity = self.selected[id(imap_server)] = select_mailbox(imap_server, mailbox.folder)[0]
+		if batch.uidvalidity != uidvalidity:
+			# UID пачки устарели; письма заново найдёт просмотр после смены UIDVALIDITY
+			logger.warning(f'Skipping batch {batch.pk}: UIDVALIDITY changed to {uidvalidity}.')
+			ingestion.finish_batch(batch, owner, MailboxBatch.SKIPPED)
+			return 0, 0
 
-		imap_server = imaplib.IMAP4_SSL('imap.gmail.com')
+		processed = created = 0
 		try:
-			imap_server.login(settings.GMAIL_EMAIL, settings.GMAIL_APP_PASSWORD)
-			imap_server.select('INBOX')
-
-			_, message_numbers = imap_server.search(None, 'UNSEEN')
-			if not message_numbers[0]:
-				logger.info('No unread emails found in INBOX.')
-				self.stdout.write('No unread emails found in INBOX.')
-				return
-
-			for num in message_numbers[0].split():
-				_, msg_data = imap_server.fetch(num, '(RFC822)')
-				email_body = msg_data[0][1]
-				msg = email.message_from_bytes(email_body)
-
-				from_header = msg.get('From', 'Unknown')
-				from_email = self.decode_email_from(from_header)
-				subject = self.decode_email_subject(msg.get('Subject', 'No Subject'))
-				date_str = msg.get('Date')
-				try:
-					email_date = email.utils.parsedate_to_datetime(date_str)
-					incoming_date = email_date.date()
-				except Exception as e:
-					logger.warning(f'Failed to parse email date: {e}')
-					incoming_date = datetime.now().date()
-
-				response_deadline = incoming_date + timedelta(days=10)
-
-				raw_summary = ""
-				if msg.is_multipart():
-					for part in msg.walk():
-						if part.get_content_type() == 'text/plain':
-							try:
-								raw_summary = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-							except Exception as e:
-								logger.warning(f'Failed to decode text/plain part: {e}')
-							break
+			for uids in chunked(batch.uid_list(), max(1, options['batch_size'])):
+				ingestion.renew_batch(batch, owner)
+				if options['streaming']:
+					with stage('fetch'):
+						emails = self.fetch_streaming(imap_server, uids)
 				else:
-					try:
-						raw_summary = msg.get_payload(decode=True).decode('utf-8', errors='ignore')
-					except Exception as e:
-						logger.warning(f'Failed to decode single-part payload: {e}')
-
-				summary = self.summarize_email_content(raw_summary, subject)
-
-				if not Incoming.objects.filter(summary=summary, incoming_date=incoming_date,
-											   applicant=from_email).exists():
-					incoming = Incoming(
-						incoming_date=incoming_date,
-						applicant=from_email,
-						summary=summary,
-						responsible="Default Responsible",
-						response_deadline=response_deadline
-					)
-					incoming.save()
-
-					if msg.is_multipart():
-						for part in msg.walk():
-							if part.get_content_maintype() == 'multipart':
-								continue
-							if part.get('Content-Disposition') is None:
-								continue
-							filename = part.get_filename()
-							if filename:
-								try:
-									decoded_filename = self.decode_email_subject(filename)
-									file_data = part.get_payload(decode=True)
-									attachment = Attachment(
-										incoming=incoming,
-										filename=decoded_filename
-									)
-									attachment.file.save(decoded_filename, ContentFile(file_data), save=True)
-									logger.info(f'Saved attachment: {decoded_filename}')
-								except Exception as e:
-									logger.error(f'Failed to process attachment {filename}: {e}')
-
-					logger.info(f'Created Incoming record for email from {from_email} with summary: {summary[:50]}...')
-					self.stdout.write(self.style.SUCCESS(f'Created Incoming record for email from {from_email}'))
-
-					imap_server.store(num, '+FLAGS', '\\Seen')
-					logger.info(f'Marked email {num} as read.')
-					self.stdout.write(f'Marked email {num} as read.')
+					with stage('fetch'):
+						messages = fetch_messages(imap_server, uids)
+					with stage('parse'):
+						emails = [self.parse_email(uid, raw) for uid, raw in messages]
+				if not emails:
+					continue
+				with stage('summarize'):
+					pending = self.apply_cached_summaries(emails)
+					if pending and self.deferred:
+						self.defer_summaries(pending)
+						self.copy_shared_summaries(emails)
+					elif pending:
+						generated = self.loop.run_until_complete(
+							self.summarize_all(pending, self.summary_session(), max(1, options['concurrency'])))
+						self.summary_cache.set_many(generated)
+						self.copy_shared_summaries(emails)
+				records = self.write_batch(emails)
+				self.dispatch_summaries(records)
 
+				# Дубликаты по содержанию, как и раньше, остаются непрочитанными; уже импортированные
+				# (тот же Message-ID, например после сбоя воркера до UID STORE) помечаются
+				seen = [item.uid for item in emails if not item.duplicate]
+				with stage('mark_seen'):
+					mark_seen(imap_server, seen)
+				logger.info(f'Marked {len(seen)} emails as read.')
+				self.stdout.write(f'Marked {len(seen)} emails as read.')
+
+				processed += len(emails)
+				created += len(records)
+		except ingestion.LeaseLost as e:
+			# Пачку забрал другой воркер после истечения аренды; записанное уже не повторится
+			logger.warning(str(e))
+			return processed, created
 		except Exception as e:
-			logger.error(f'Error processing emails: {e}')
-			self.stdout.write(self.style.ERROR(f'Error processing emails: {e}'))
+			ingestion.fail_batch(batch, owner, e)
 			raise
+		ingestion.finish_batch(batch, owner)
+		return processed, created
 
-		finally:
+	def ingest(self, mailbox, owner, options, max_batches=None):
+		"""Просмотр одного ящика и разбор его свободных пачек; возвращает (пачек, обработано, создано)."""
+		state, _ = MailboxSyncState.objects.get_or_create(mailbox=mailbox.state_name)
+		batches = processed = created = 0
+		with ExitStack() as stack:
+			imap_server = None
+
+			def connect():
+				# Соединение берётся из пула, только если есть работа: пустые запуски не ходят на сервер
+				nonlocal imap_server
+				if imap_server is None:
+					imap_server = stack.enter_context(pool.connection(mailbox))
+				return imap_server
+
+			if options['scan']:
+				if options['full_resync'] or options['immediate'] or ingestion.scan_due(state):
+					with stage('scan'):
+						self.scan(connect(), mailbox, state, owner, options['full_resync'])
+				else:
+					logger.info(f'Mailbox {state.mailbox} is backing off until {state.next_scan_at}.')
+
+			while max_batches is None or batches < max_batches:
+				batch = ingestion.claim_batch(owner, state)
+				if batch is None:
+					break
+				batch_processed, batch_created = self.process_batch(connect(), mailbox, batch, owner, options)
+				processed += batch_processed
+				created += batch_created
+				batches += 1
+		return batches, processed, created
+
+	def record_run(self, timer, started_at, owner, configs, counts, error=''):
+		"""Строка IngestionRun с итогами запуска; пустые запуски (ни просмотра, ни пачек) не записываются."""
+		batches, processed, created = counts
+		if not batches and 'scan' not in timer.seconds:
+			return None
+		try:
+			return IngestionRun.objects.create(
+				started_at=started_at,
+				duration=timer.elapsed,
+				worker=owner[:100],
+				mailboxes=', '.join(config.name for config in configs)[:255],
+				batches=batches,
+				processed=processed,
+				created=created,
+				queries=timer.queries,
+				query_seconds=timer.query_seconds,
+				error=error,
+				**{name: timer.seconds[name] for name in IngestionRun.STAGES},
+			)
+		except Exception as e:
+			# Метрики не должны ронять импорт
+			logger.error(f'Failed to record ingestion run: {e}')
+			return None
+
+	def handle(self, *args, **options):
+		"""Просмотр настроенных ящиков и разбор пачек новых писем, пока есть свободные."""
+		configs = mailboxes(options['mailboxes'])
+		logger.info(f'Starting email processing for {", ".join(config.name for config in configs) or "no mailboxes"}...')
+		self.stdout.write(f'Starting email processing for {", ".join(config.name for config in configs) or "no mailboxes"}...')
+
+		owner = ingestion.worker_id()
+		remaining = options['max_batches']
+		started_at = timezone.now()
+		processed = created = batches = 0
+		error = ''
+		self.summary_cache = SummaryCache()
+		self.summarizer = summarizers.build_chain()
+		# Откладывать есть смысл, только если кроме extractive есть модели
+		self.deferred = options['deferred_summaries'] and summaries.models_configured()
+		self.summarized_by = Counter()
+		self.selected = {}
+		self.loop = asyncio.new_event_loop()
+		self.session = None
+
+		with collect() as timer:
 			try:
-				imap_server.logout()
-			except:
-				pass
-			logger.info('Finished email processing.')
-			self.stdout.write('Finished email processing.')
\ No newline at end of file
+				for mailbox in configs:
+					mailbox_batches, mailbox_processed, mailbox_created = self.ingest(mailbox, owner, options, remaining)
+					batches += mailbox_batches
+					processed += mailbox_processed
+					created += mailbox_created
+					if remaining is not None:
+						remaining -= mailbox_batches
+
+			except Exception as e:
+				error = str(e)
+				logger.error(f'Error processing emails: {e}')
+				self.stdout.write(self.style.ERROR(f'Error processing emails: {e}'))
+				raise
+
+			finally:
+				if self.session is not None:
+					self.loop.run_until_complete(self.session.close())
+				self.loop.close()
+				self.record_run(timer, started_at, owner, configs, (batches, processed, created), error)
+				elapsed = timer.elapsed
+				rate = processed / elapsed if elapsed else 0.0
+				stages = ', '.join(f'{name} {timer.seconds[name]:.2f}s' for name in IngestionRun.STAGES if timer.seconds[name])
+				logger.info(f'Finished email processing: {batches} batches, {processed} processed, {created} created in {elapsed:.1f}s ({rate:.2f} msg/s).')
+				self.stdout.write(f'Finished email processing: {batches} batches, {processed} processed, {created} created in {elapsed:.1f}s ({rate:.2f} msg/s).')
+				logger.info(f'Stages: {stages or "none"}; {timer.queries} queries in {timer.query_seconds:.2f}s.')
+				self.stdout.write(f'Stages: {stages or "none"}; {timer.queries} queries in {timer.query_seconds:.2f}s.')
+				logger.info(f'Summary cache: {self.summary_cache.hits} hits, {self.summary_cache.misses} misses.')
+				self.stdout.write(f'Summary cache: {self.summary_cache.hits} hits, {self.summary_cache.misses} misses.')
+				if self.summarized_by:
+					backends = ', '.join(f'{name} {count}' for name, count in self.summarized_by.most_common())
+					logger.info(f'Summaries by backend: {backends}.')
+					self.stdout.write(f'Summaries by backend: {backends}.')
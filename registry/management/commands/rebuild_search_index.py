@@ -0,0 +1,16 @@
+# registry/management/commands/rebuild_search_index.py
+from django.core.management.base import BaseCommand
+from registry.models import ArchivedIncoming, Incoming
+from registry.search import rebuild_index
+
+
+class Command(BaseCommand):
+	help = 'Drop and rebuild the full-text search indexes of the register and its archive'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=1000)
+
+	def handle(self, *args, **options):
+		for model in (Incoming, ArchivedIncoming):
+			total = rebuild_index(batch_size=options['batch_size'], model=model)
+			self.stdout.write(self.style.SUCCESS(f'Indexed {total} {model.__name__} records.'))
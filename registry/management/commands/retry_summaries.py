@@ -0,0 +1,20 @@
+# registry/management/commands/retry_summaries.py
+from django.core.management.base import BaseCommand
+from registry import summaries
+from registry.models import Incoming
+
+
+class Command(BaseCommand):
+	help = ('Queue model summaries again for records left with provisional summaries '
+			'after the retries ran out (e.g. once the summarizer service is back)')
+
+	def add_arguments(self, parser):
+		parser.add_argument('--stale', action='store_true',
+							help='Also requeue pending records whose tasks were lost, without waiting for the beat task')
+
+	def handle(self, *args, **options):
+		queued = summaries.retry_failed()
+		if options['stale']:
+			queued += summaries.requeue_stale()
+		pending = Incoming.objects.filter(summary_status=Incoming.SUMMARY_PENDING).count()
+		self.stdout.write(self.style.SUCCESS(f'Queued {queued} records for summarization, {pending} pending in total'))
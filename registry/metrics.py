@@ -0,0 +1,222 @@
+# registry/metrics.py
+"""Замеры времени по этапам и метрики в текстовом формате Prometheus.
+
+collect() открывает замер: внутри него stage('имя') суммирует время этапа,
+а каждый SQL-запрос (через обёртку соединения) — число и время запросов.
+Текущий замер хранится в contextvar, поэтому в него попадают и запросы
+асинхронных представлений, выполняемые sync_to_async в другом потоке.
+
+Метрики представлений копятся в памяти процесса и отдаются /metrics того
+процесса, который обслужил запрос. Метрики импорта почты строятся из
+таблицы IngestionRun и одинаковы для всех процессов.
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+from functools import wraps
+from django.db.models import Count, Sum
+from django.utils import timezone
+from .models import IngestionRun
+
+_current = ContextVar('registry_metrics_timer', default=None)
+
+
+class StageTimer:
+    """Время по этапам и SQL-запросы одного запуска или запроса.
+
+    Запросы вложенного замера учитываются и во внешнем (parent).
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.started = time.perf_counter()
+        self.seconds = defaultdict(float)
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+@contextmanager
+def collect():
+    timer = StageTimer(_current.get())
+    token = _current.set(timer)
+    try:
+        yield timer
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """Время блока в этапе name текущего замера; вне замера ничего не делает."""
+    timer = _current.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.seconds[name] += time.perf_counter() - started
+
+
+def record_query(execute, sql, params, many, context):
+    """Обёртка выполнения SQL (connection.execute_wrappers)."""
+    timer = _current.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        while timer is not None:
+            timer.queries += 1
+            timer.query_seconds += elapsed
+            timer = timer.parent
+
+
+def install_query_wrapper(connection):
+    """Подключение обёртки к соединению (сигнал connection_created, signals.py)."""
+    if record_query not in connection.execute_wrappers:
+        # В начало списка: connection.execute_wrapper() снимает свою обёртку с конца
+        connection.execute_wrappers.insert(0, record_query)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = defaultdict(float)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] += amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + format_labels(self.labels, labels), value) for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            # Счётчики по корзинам (последняя — +Inf) и сумма наблюдений
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[labels] = (counts, total + value)
+
+    def samples(self):
+        label_names = self.labels + ('le',)
+        lines = []
+        with self.lock:
+            for labels, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append((self.name + '_bucket' + format_labels(label_names, labels + (bound,)), cumulative))
+                lines.append((self.name + '_sum' + format_labels(self.labels, labels), total))
+                lines.append((self.name + '_count' + format_labels(self.labels, labels), cumulative))
+        return lines
+
+
+VIEW_SECONDS = Histogram('registry_view_seconds', 'Time to serve a register view', ['view'])
+VIEW_QUERIES = Histogram('registry_view_queries', 'SQL queries per request', ['view'], buckets=(1, 2, 3, 5, 10, 20, 50, 100))
+VIEW_QUERY_SECONDS = Counter('registry_view_query_seconds_total', 'Time spent in SQL queries', ['view'])
+VIEW_RENDER_SECONDS = Counter('registry_view_render_seconds_total', 'Time spent rendering templates', ['view'])
+VIEW_METRICS = (VIEW_SECONDS, VIEW_QUERIES, VIEW_QUERY_SECONDS, VIEW_RENDER_SECONDS)
+
+
+def observe_view(name, timer):
+    VIEW_SECONDS.observe(timer.elapsed, name)
+    VIEW_QUERIES.observe(timer.queries, name)
+    VIEW_QUERY_SECONDS.inc(name, amount=timer.query_seconds)
+    VIEW_RENDER_SECONDS.inc(name, amount=timer.seconds['render'])
+
+
+def instrument_view(name):
+    """Замер асинхронного представления: время ответа, число и время запросов, отрисовка."""
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            with collect() as timer:
+                response = await view(request, *args, **kwargs)
+            observe_view(name, timer)
+            return response
+        return wrapper
+    return decorator
+
+
+def render_metrics(metrics):
+    """Текстовый формат экспозиции Prometheus."""
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(f'{sample} {value}' for sample, value in metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+def ingestion_metrics(window=3600):
+    """Метрики импорта почты из IngestionRun: итоги за последние window секунд и последний запуск."""
+    totals = Gauge('registry_ingestion_window_total', 'Ingestion totals over the recent window', ['window', 'value'])
+    stages = Gauge('registry_ingestion_stage_seconds', 'Seconds spent per ingestion stage over the recent window',
+                   ['window', 'stage'])
+    last_run = Gauge('registry_ingestion_last_run', 'Figures of the most recent ingestion run', ['value'])
+
+    label = f'{window}s'
+    recent = IngestionRun.objects.filter(started_at__gte=timezone.now() - timedelta(seconds=window))
+    fields = ['batches', 'processed', 'created', 'queries', 'query_seconds']
+    aggregates = recent.aggregate(
+        runs=Count('pk'),
+        **{name: Sum(name) for name in fields},
+        **{f'stage_{name}': Sum(name) for name in IngestionRun.STAGES},
+    )
+    for name in ['runs', *fields]:
+        totals.set(aggregates[name] or 0, label, name)
+    totals.set(recent.exclude(error='').count(), label, 'errors')
+    for name in IngestionRun.STAGES:
+        stages.set(aggregates[f'stage_{name}'] or 0.0, label, name)
+
+    run = IngestionRun.objects.order_by('-started_at').first()
+    if run is not None:
+        last_run.set(run.started_at.timestamp(), 'timestamp_seconds')
+        last_run.set(run.duration, 'duration_seconds')
+        last_run.set(run.processed, 'processed')
+        last_run.set(run.created, 'created')
+        last_run.set(int(bool(run.error)), 'failed')
+    return totals, stages, last_run
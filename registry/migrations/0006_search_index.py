@@ -0,0 +1,89 @@
+from django.db import migrations
+
+# Устройство индекса зафиксировано здесь, а не взято из registry/search.py:
+# последующие правки search.py не должны менять то, что делает эта миграция.
+COLUMNS = ('applicant', 'summary', 'responsible', 'attachments')
+SQLITE_TABLE = 'registry_incoming_fts'
+POSTGRES_TABLE = 'registry_incoming_search'
+POSTGRES_WEIGHTS = dict(zip(COLUMNS, 'ABCD'))
+
+
+def documents(apps):
+    """(pk, значения COLUMNS) каждой записи; вложения — их имена через пробел."""
+    Incoming = apps.get_model('registry', 'Incoming')
+    Attachment = apps.get_model('registry', 'Attachment')
+    filenames = {}
+    for incoming_id, filename in Attachment.objects.order_by('pk').values_list('incoming_id', 'filename'):
+        filenames.setdefault(incoming_id, []).append(filename)
+    rows = Incoming.objects.values_list('pk', 'applicant', 'summary', 'responsible')
+    for pk, applicant, summary, responsible in rows.iterator():
+        yield pk, (applicant, summary, responsible, ' '.join(filenames.get(pk, [])))
+
+
+def create_sqlite_index(apps, cursor):
+    # Основы слов — тем же стеммером, которым код поиска разбирает запросы:
+    # индекс, построенный другой версией алгоритма, не совпадал бы с запросами.
+    from registry.stemmer import stem_text
+
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_TABLE} "
+        f"USING fts5({', '.join(COLUMNS)}, tokenize='unicode61 remove_diacritics 2')"
+    )
+    cursor.executemany(
+        f"INSERT INTO {SQLITE_TABLE} (rowid, {', '.join(COLUMNS)}) VALUES (%s, %s, %s, %s, %s)",
+        [[pk] + [stem_text(value) for value in values] for pk, values in documents(apps)],
+    )
+
+
+def create_postgres_index(cursor):
+    columns = ', '.join(f'{column} tsvector' for column in COLUMNS)
+    cursor.execute(
+        f'CREATE TABLE IF NOT EXISTS {POSTGRES_TABLE} ('
+        f'incoming_id bigint PRIMARY KEY REFERENCES registry_incoming (id) ON DELETE CASCADE, '
+        f'{columns}, document tsvector)'
+    )
+    for column in COLUMNS + ('document',):
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {POSTGRES_TABLE}_{column}_gin ON {POSTGRES_TABLE} USING gin ({column})'
+        )
+    # Стемминг выполняет PostgreSQL, поэтому индекс заполняется одним запросом
+    vectors = ', '.join(f"to_tsvector('russian', {column})" for column in COLUMNS)
+    combined = ' || '.join(
+        f"setweight(to_tsvector('russian', {column}), '{POSTGRES_WEIGHTS[column]}')" for column in COLUMNS
+    )
+    cursor.execute(
+        f"INSERT INTO {POSTGRES_TABLE} (incoming_id, {', '.join(COLUMNS)}, document) "
+        f"SELECT id, {vectors}, {combined} FROM ("
+        f"SELECT incoming.id, incoming.applicant, incoming.summary, incoming.responsible, "
+        f"coalesce(string_agg(attachment.filename, ' ' ORDER BY attachment.id), '') AS attachments "
+        f"FROM registry_incoming incoming "
+        f"LEFT JOIN registry_attachment attachment ON attachment.incoming_id = incoming.id "
+        f"GROUP BY incoming.id) AS documents"
+    )
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    with schema_editor.connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            create_sqlite_index(apps, cursor)
+        elif vendor == 'postgresql':
+            create_postgres_index(cursor)
+
+
+def drop_search_index(apps, schema_editor):
+    table = {'sqlite': SQLITE_TABLE, 'postgresql': POSTGRES_TABLE}.get(schema_editor.connection.vendor)
+    if table:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0005_numbercounter'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
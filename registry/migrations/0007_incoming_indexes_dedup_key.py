@@ -0,0 +1,41 @@
+# Generated by Django 5.2 on 2026-10-18 20:18
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def fill_dedup_keys(apps, schema_editor):
+    Incoming = apps.get_model('registry', 'Incoming')
+    for incoming in Incoming.objects.only('applicant', 'incoming_date', 'summary').iterator():
+        source = f'{incoming.applicant}\x1f{incoming.incoming_date}\x1f{incoming.summary}'
+        incoming.dedup_key = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        incoming.save(update_fields=['dedup_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0006_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='incoming',
+            name='dedup_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64),
+        ),
+        migrations.RunPython(fill_dedup_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='incoming',
+            index=models.Index(fields=['-incoming_date', '-incoming_number'], name='incoming_date_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='incoming',
+            index=models.Index(fields=['response_deadline', 'incoming_number'], name='incoming_deadline_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='incoming',
+            index=models.Index(fields=['responsible', 'response_deadline'], name='incoming_responsible_idx'),
+        ),
+    ]
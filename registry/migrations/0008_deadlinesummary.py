@@ -0,0 +1,26 @@
+# Generated by Django 5.2 on 2026-10-18 20:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0007_incoming_indexes_dedup_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeadlineSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('responsible', models.CharField(max_length=100)),
+                ('bucket', models.CharField(choices=[('overdue', 'Просрочено'), ('today', 'Сегодня'), ('week', 'В ближайшие 7 дней'), ('later', 'Позже')], max_length=10)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('computed_on', models.DateField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('responsible', 'bucket'), name='deadline_summary_unique')],
+            },
+        ),
+    ]
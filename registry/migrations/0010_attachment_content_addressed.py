@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-18 20:35
+
+import registry.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0009_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attachment',
+            name='file',
+            field=models.FileField(db_index=True, storage=registry.storage.attachment_storage, upload_to='attachments/'),
+        ),
+    ]
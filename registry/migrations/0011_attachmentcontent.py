@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-18 20:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0010_attachment_content_addressed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentContent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('processing', 'Обрабатывается'), ('done', 'Готово'), ('unsupported', 'Формат не поддерживается'), ('failed', 'Ошибка')], db_index=True, default='pending', max_length=12)),
+                ('content_type', models.CharField(blank=True, max_length=100)),
+                ('text', models.TextField(blank=True)),
+                ('pages', models.PositiveIntegerField(blank=True, null=True)),
+                ('preview', models.FileField(blank=True, upload_to='previews/')),
+                ('error', models.TextField(blank=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
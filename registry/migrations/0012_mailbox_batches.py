@@ -0,0 +1,60 @@
+# Generated by Django 5.2 on 2026-10-18 20:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0011_attachmentcontent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='incoming',
+            name='message_id',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='mailboxsyncstate',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mailboxsyncstate',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='mailboxsyncstate',
+            name='next_scan_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mailboxsyncstate',
+            name='overruns',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='MailboxBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uidvalidity', models.BigIntegerField()),
+                ('uids', models.TextField()),
+                ('first_uid', models.BigIntegerField()),
+                ('last_uid', models.BigIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Ожидает'), ('done', 'Обработана'), ('skipped', 'Пропущена')], default='pending', max_length=10)),
+                ('lease_owner', models.CharField(blank=True, max_length=100)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batches', to='registry.mailboxsyncstate')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'lease_expires_at'], name='mailbox_batch_claim_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-18 20:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0012_mailbox_batches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(db_index=True)),
+                ('duration', models.FloatField()),
+                ('worker', models.CharField(max_length=100)),
+                ('mailboxes', models.CharField(blank=True, max_length=255)),
+                ('batches', models.PositiveIntegerField(default=0)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('created', models.PositiveIntegerField(default=0)),
+                ('queries', models.PositiveIntegerField(default=0)),
+                ('query_seconds', models.FloatField(default=0)),
+                ('scan', models.FloatField(default=0)),
+                ('fetch', models.FloatField(default=0)),
+                ('parse', models.FloatField(default=0)),
+                ('summarize', models.FloatField(default=0)),
+                ('dedup', models.FloatField(default=0)),
+                ('attachments', models.FloatField(default=0)),
+                ('db', models.FloatField(default=0)),
+                ('mark_seen', models.FloatField(default=0)),
+                ('error', models.TextField(blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-18 20:59
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0013_ingestionrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='incoming',
+            name='summary_status',
+            field=models.CharField(choices=[('done', 'Готово'), ('pending', 'Предварительное'), ('failed', 'Модель не ответила')], default='done', editable=False, max_length=10),
+        ),
+        migrations.CreateModel(
+            name='SummaryRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField()),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('requested_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('error', models.TextField(blank=True)),
+                ('incoming', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary_request', to='registry.incoming')),
+            ],
+        ),
+    ]
@@ -0,0 +1,95 @@
+# Generated by Django 5.2 on 2026-10-18 21:07
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+# Индекс архива устроен как индекс реестра (0006_search_index) и описан здесь же,
+# чтобы правки registry/search.py не меняли эту миграцию.
+COLUMNS = ('applicant', 'summary', 'responsible', 'attachments')
+SOURCE = 'registry_archivedincoming'
+
+
+def create_archive_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    with schema_editor.connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SOURCE}_fts "
+                f"USING fts5({', '.join(COLUMNS)}, tokenize='unicode61 remove_diacritics 2')"
+            )
+        elif vendor == 'postgresql':
+            table = f'{SOURCE}_search'
+            columns = ', '.join(f'{column} tsvector' for column in COLUMNS)
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} ('
+                f'incoming_id bigint PRIMARY KEY REFERENCES {SOURCE} (id) ON DELETE CASCADE, '
+                f'{columns}, document tsvector)'
+            )
+            for column in COLUMNS + ('document',):
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_{column}_gin ON {table} USING gin ({column})')
+
+
+def drop_archive_search_index(apps, schema_editor):
+    table = {'sqlite': f'{SOURCE}_fts', 'postgresql': f'{SOURCE}_search'}.get(schema_editor.connection.vendor)
+    if table:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0014_summary_requests'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivePack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('members', models.PositiveIntegerField(default=0)),
+                ('size', models.BigIntegerField(default=0)),
+                ('original_size', models.BigIntegerField(default=0)),
+                ('lease_owner', models.CharField(blank=True, max_length=100)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedIncoming',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('incoming_number', models.IntegerField(unique=True)),
+                ('incoming_date', models.DateField()),
+                ('applicant', models.CharField(max_length=255)),
+                ('summary', models.TextField()),
+                ('responsible', models.CharField(max_length=100)),
+                ('response_deadline', models.DateField()),
+                ('dedup_key', models.CharField(blank=True, max_length=64)),
+                ('message_id', models.CharField(blank=True, max_length=255, null=True, unique=True)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['-incoming_date', '-incoming_number'],
+                'indexes': [models.Index(fields=['-incoming_date', '-incoming_number'], name='archive_date_number_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedAttachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(blank=True, max_length=255)),
+                ('sha256', models.CharField(blank=True, max_length=64)),
+                ('offset', models.BigIntegerField(default=0)),
+                ('compressed_size', models.BigIntegerField(default=0)),
+                ('size', models.BigIntegerField(default=0)),
+                ('method', models.PositiveSmallIntegerField(default=0)),
+                ('incoming', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='registry.archivedincoming')),
+                ('pack', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='registry.archivepack')),
+            ],
+        ),
+        migrations.RunPython(create_archive_search_index, drop_archive_search_index),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-18 21:13
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0015_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedIncoming',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('incoming_id', models.BigIntegerField(db_index=True)),
+                ('incoming_number', models.IntegerField()),
+                ('reason', models.CharField(choices=[('deleted', 'Удалена'), ('archived', 'Перенесена в архив')], default='deleted', max_length=10)),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='incoming',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='incoming',
+            index=models.Index(fields=['updated_at', 'id'], name='incoming_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deletedincoming',
+            index=models.Index(fields=['deleted_at', 'id'], name='deleted_incoming_cursor_idx'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+from django.db import migrations
+
+# Столбец attachments индекса теперь хранит имя каждого вложения вместе
+# с извлечённым текстом (AttachmentContent). Записи, проиндексированные
+# до этого, переиндексируются в новом виде; устройство индекса описано
+# в 0006_search_index.
+COLUMNS = ('applicant', 'summary', 'responsible', 'attachments')
+SQLITE_TABLE = 'registry_incoming_fts'
+POSTGRES_TABLE = 'registry_incoming_search'
+POSTGRES_WEIGHTS = dict(zip(COLUMNS, 'ABCD'))
+
+
+def documents(apps):
+    """(pk, значения COLUMNS) каждой записи; вложения — имя и текст через пробел."""
+    Incoming = apps.get_model('registry', 'Incoming')
+    Attachment = apps.get_model('registry', 'Attachment')
+    AttachmentContent = apps.get_model('registry', 'AttachmentContent')
+    texts = dict(AttachmentContent.objects.filter(status='done').values_list('sha256', 'text'))
+    attachments = {}
+    for incoming_id, filename, sha256 in Attachment.objects.order_by('pk').values_list(
+            'incoming_id', 'filename', 'sha256'):
+        text = texts.get(sha256)
+        attachments.setdefault(incoming_id, []).append(f'{filename} {text}' if text else filename)
+    rows = Incoming.objects.values_list('pk', 'applicant', 'summary', 'responsible')
+    for pk, applicant, summary, responsible in rows.iterator():
+        yield pk, (applicant, summary, responsible, ' '.join(attachments.get(pk, [])))
+
+
+def reindex_sqlite(apps, cursor):
+    from registry.stemmer import stem_text
+
+    rows = [[pk] + [stem_text(value) for value in values] for pk, values in documents(apps)]
+    cursor.executemany(f'DELETE FROM {SQLITE_TABLE} WHERE rowid = %s', [[row[0]] for row in rows])
+    cursor.executemany(
+        f"INSERT INTO {SQLITE_TABLE} (rowid, {', '.join(COLUMNS)}) VALUES (%s, %s, %s, %s, %s)", rows,
+    )
+
+
+def reindex_postgres(cursor):
+    vectors = ', '.join(f"to_tsvector('russian', {column})" for column in COLUMNS)
+    combined = ' || '.join(
+        f"setweight(to_tsvector('russian', {column}), '{POSTGRES_WEIGHTS[column]}')" for column in COLUMNS
+    )
+    cursor.execute(
+        f"INSERT INTO {POSTGRES_TABLE} (incoming_id, {', '.join(COLUMNS)}, document) "
+        f"SELECT id, {vectors}, {combined} FROM ("
+        f"SELECT incoming.id, incoming.applicant, incoming.summary, incoming.responsible, "
+        f"coalesce(string_agg(concat_ws(' ', attachment.filename, content.text), ' ' ORDER BY attachment.id), '') "
+        f"AS attachments "
+        f"FROM registry_incoming incoming "
+        f"LEFT JOIN registry_attachment attachment ON attachment.incoming_id = incoming.id "
+        f"LEFT JOIN registry_attachmentcontent content "
+        f"ON content.sha256 = attachment.sha256 AND content.status = 'done' "
+        f"GROUP BY incoming.id) AS documents "
+        f"ON CONFLICT (incoming_id) DO UPDATE SET "
+        + ', '.join(f'{column} = EXCLUDED.{column}' for column in COLUMNS + ('document',))
+    )
+
+
+def reindex_attachments(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    with schema_editor.connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            reindex_sqlite(apps, cursor)
+        elif vendor == 'postgresql':
+            reindex_postgres(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0016_api_changes'),
+    ]
+
+    operations = [
+        migrations.RunPython(reindex_attachments, migrations.RunPython.noop),
+    ]
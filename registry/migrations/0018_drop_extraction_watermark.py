@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def drop_watermark(apps, schema_editor):
+    # Очередь извлечения больше не ведёт отметку по Attachment.pk в таблице счётчиков номеров
+    NumberCounter = apps.get_model('registry', 'NumberCounter')
+    NumberCounter.objects.filter(name='attachment_extraction').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0017_reindex_attachment_text'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_watermark, migrations.RunPython.noop),
+    ]
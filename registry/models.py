@@ -1,32 +1,522 @@
 # registry/models.py
-from django.db import models
-from django.db.models import Max
+import hashlib
+import uuid
+from datetime import timedelta
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, Max, Value, When
+from django.conf import settings
 from django.utils import timezone
+from .storage import attachment_storage
+
+
+class NumberCounterManager(models.Manager):
+    """Выдача входящих номеров через строку-счётчик вместо Max() по всей таблице."""
+
+    def allocate(self, count=1, name='incoming'):
+        """Атомарное выделение блока из count последовательных номеров, возвращает range.
+
+        UPDATE блокирует строку счётчика до конца транзакции, поэтому параллельные
+        писатели (форма и импорт почты) получают непересекающиеся блоки. Вызывается
+        в транзакции вставки записей: при откате откатывается и счётчик, пропусков нет.
+        """
+        with transaction.atomic():
+            if not self.filter(name=name).update(last_value=F('last_value') + count):
+                self._create(name)
+                self.filter(name=name).update(last_value=F('last_value') + count)
+            last_value = self.filter(name=name).values_list('last_value', flat=True).get()
+        return range(last_value - count + 1, last_value + 1)
+
+    def reserve(self, number, name='incoming'):
+        """Учёт номера, введённого вручную, чтобы счётчик не выдал его повторно."""
+        if not self.filter(name=name, last_value__lt=number).update(last_value=number):
+            if not self.filter(name=name).exists():
+                self._create(name)
+                self.filter(name=name, last_value__lt=number).update(last_value=number)
+
+    def peek(self, name='incoming'):
+        """Номер, который получит следующая запись; ничего не резервирует."""
+        last_value = self.filter(name=name).values_list('last_value', flat=True).first()
+        if last_value is None:
+            last_value = self._issued()
+        return last_value + 1
+
+    def _issued(self):
+        # Номера архивных записей тоже заняты
+        return max(model.objects.aggregate(Max('incoming_number'))['incoming_number__max'] or 0
+                   for model in (Incoming, ArchivedIncoming))
+
+    def _create(self, name):
+        # Первый запуск: счётчик продолжает уже выданные номера
+        start = self._issued()
+        try:
+            with transaction.atomic():
+                self.create(name=name, last_value=start)
+        except IntegrityError:
+            pass  # счётчик одновременно создал другой процесс
+
+
+class NumberCounter(models.Model):
+    """Последний выданный номер; одна строка на нумератор."""
+    name = models.CharField(max_length=50, unique=True)
+    last_value = models.BigIntegerField(default=0)
+
+    objects = NumberCounterManager()
+
+    def __str__(self):
+        return f"{self.name}: {self.last_value}"
+
+
+class IncomingManager(models.Manager):
+    def touch(self, pks):
+        """Отметка изменения записей для ленты изменений API: update() не обновляет auto_now."""
+        return self.filter(pk__in=pks).update(updated_at=timezone.now())
+
 
 class Incoming(models.Model):
+    SUMMARY_DONE, SUMMARY_PENDING, SUMMARY_FAILED = 'done', 'pending', 'failed'
+    SUMMARY_STATUSES = [
+        (SUMMARY_DONE, 'Готово'),
+        (SUMMARY_PENDING, 'Предварительное'),  # Из текста письма, резюме модели ещё в очереди
+        (SUMMARY_FAILED, 'Модель не ответила'),  # Осталось предварительное
+    ]
+
     incoming_number = models.IntegerField(unique=True)
     incoming_date = models.DateField(default=timezone.now)
     applicant = models.CharField(max_length=255)
     summary = models.TextField()
+    summary_status = models.CharField(max_length=10, choices=SUMMARY_STATUSES, default=SUMMARY_DONE, editable=False)
     responsible = models.CharField(max_length=100)
     response_deadline = models.DateField()
+    dedup_key = models.CharField(max_length=64, db_index=True, editable=False, blank=True)
+    # Message-ID письма, из которого создана запись: уникальность исключает повторный импорт
+    message_id = models.CharField(max_length=255, unique=True, null=True, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)  # Лента изменений API (api.py)
+
+    objects = IncomingManager()
+    _loaded_number = None  # Номер при загрузке из БД: по нему save решает, нужен ли reserve
+
+    @staticmethod
+    def make_message_id(message_id, *headers):
+        """Ключ письма: Message-ID, а если его нет или он слишком длинный — хэш заголовков."""
+        message_id = (message_id or '').strip()
+        if message_id and len(message_id) <= 255:
+            return message_id
+        source = '\x1f'.join(str(header) for header in (message_id,) + headers)
+        return 'sha256:' + hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def make_dedup_key(applicant, incoming_date, summary):
+        """Хэш отправителя, даты и содержания: по нему импорт почты ищет дубликаты."""
+        source = f'{applicant}\x1f{incoming_date}\x1f{summary}'
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
 
     def save(self, *args, **kwargs):
-        if not self.incoming_number:
-            max_number = Incoming.objects.aggregate(Max('incoming_number'))['incoming_number__max']
-            self.incoming_number = (max_number or 0) + 1
-        super().save(*args, **kwargs)
+        self.dedup_key = self.make_dedup_key(self.applicant, self.incoming_date, self.summary)
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'dedup_key'}
+        with transaction.atomic():
+            if not self.incoming_number:
+                self.incoming_number = NumberCounter.objects.allocate()[0]
+            elif self._state.adding or self.incoming_number != self._loaded_number:
+                # Обычное редактирование номер не меняет и счётчик не трогает
+                NumberCounter.objects.reserve(self.incoming_number)
+            super().save(*args, **kwargs)
+        self._loaded_number = self.incoming_number
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'incoming_number' in field_names:
+            instance._loaded_number = values[field_names.index('incoming_number')]
+        return instance
 
     def __str__(self):
         return f"№{self.incoming_number} от {self.incoming_date}"
 
     class Meta:
         ordering = ['-incoming_date', '-incoming_number']
+        indexes = [
+            # Порядок по умолчанию и фильтр по дате поступления
+            models.Index(fields=['-incoming_date', '-incoming_number'], name='incoming_date_number_idx'),
+            # Фильтр по сроку ответа и сводка по срокам
+            models.Index(fields=['response_deadline', 'incoming_number'], name='incoming_deadline_idx'),
+            # Точный отбор по ответственному с диапазоном сроков
+            models.Index(fields=['responsible', 'response_deadline'], name='incoming_responsible_idx'),
+            # Курсор ленты изменений API: (updated_at, id)
+            models.Index(fields=['updated_at', 'id'], name='incoming_updated_idx'),
+        ]
 
 class Attachment(models.Model):
     incoming = models.ForeignKey(Incoming, on_delete=models.CASCADE, related_name='attachments')
-    file = models.FileField(upload_to='attachments/')
+    # Одинаковые файлы хранятся одним blob; индекс по file — счётчик ссылок на blob
+    file = models.FileField(upload_to='attachments/', storage=attachment_storage, db_index=True)
     filename = models.CharField(max_length=255, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True)
+
+    def save(self, *args, **kwargs):
+        if self.file and not self.file._committed:
+            # Файл сохраняется заранее (обычно это делает pre_save поля), чтобы знать имя blob
+            self.file.save(self.file.name, self.file.file, save=False)
+        self.sha256 = self.file.storage.digest(self.file.name or '') or self.sha256
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return self.filename or self.file.name
+
+
+class AttachmentContent(models.Model):
+    """Извлечённый текст и превью содержимого вложения.
+
+    Ключ — SHA-256 файла: одинаковые вложения разбираются один раз.
+    """
+    PENDING, PROCESSING, DONE, UNSUPPORTED, FAILED = 'pending', 'processing', 'done', 'unsupported', 'failed'
+    STATUSES = [
+        (PENDING, 'В очереди'),
+        (PROCESSING, 'Обрабатывается'),
+        (DONE, 'Готово'),
+        (UNSUPPORTED, 'Формат не поддерживается'),
+        (FAILED, 'Ошибка'),
+    ]
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    status = models.CharField(max_length=12, choices=STATUSES, default=PENDING, db_index=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    text = models.TextField(blank=True)
+    pages = models.PositiveIntegerField(null=True, blank=True)
+    preview = models.FileField(upload_to='previews/', blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]}… ({self.status})"
+
+
+class UploadSession(models.Model):
+    """Поэтапная загрузка файла: куски дописываются прямо в итоговый файл хранилища."""
+    UPLOADING, COMPLETE = 'uploading', 'complete'
+    STATUSES = [(UPLOADING, 'Загружается'), (COMPLETE, 'Загружен')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    incoming = models.ForeignKey(Incoming, on_delete=models.CASCADE, related_name='upload_sessions')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    file = models.FileField(upload_to='attachments/', max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True)
+    expected_sha256 = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=UPLOADING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.filename}: {self.received}/{self.size}"
+
+class LeaseManager(models.Manager):
+    """Аренда строки воркером: условный UPDATE вместо блокировки.
+
+    Строку может взять один владелец до lease_expires_at; если воркер
+    упал, аренда истекает и строку забирает другой.
+    """
+
+    def acquire(self, pk, owner, seconds):
+        now = timezone.now()
+        return bool(self.filter(pk=pk).filter(
+            models.Q(lease_owner='') | models.Q(lease_owner=owner) | models.Q(lease_expires_at__lt=now)
+        ).update(lease_owner=owner, lease_expires_at=now + timedelta(seconds=seconds)))
+
+    def release(self, pk, owner, **values):
+        """Снятие аренды с одновременной записью values; False, если аренду уже перехватили."""
+        return bool(self.filter(pk=pk, lease_owner=owner).update(lease_owner='', lease_expires_at=None, **values))
+
+
+class MailboxSyncState(models.Model):
+    """Состояние синхронизации почтового ящика по UID.
+
+    last_uid — граница уже разбитых на пачки писем (MailboxBatch); просмотр
+    ящика выполняет один воркер под арендой строки.
+    """
+    mailbox = models.CharField(max_length=255, unique=True)
+    uidvalidity = models.BigIntegerField(null=True, blank=True)
+    last_uid = models.BigIntegerField(default=0)
+    lease_owner = models.CharField(max_length=100, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    next_scan_at = models.DateTimeField(null=True, blank=True)  # раньше этого времени ящик не просматривается
+    overruns = models.PositiveSmallIntegerField(default=0)  # подряд пропущенных запусков, задаёт паузу
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = LeaseManager()
+
+    def __str__(self):
+        return f"{self.mailbox} (UIDVALIDITY {self.uidvalidity}, UID {self.last_uid})"
+
+
+class MailboxBatch(models.Model):
+    """Пачка UID писем ящика: единица работы одного воркера импорта."""
+    PENDING, DONE, SKIPPED = 'pending', 'done', 'skipped'
+    STATUSES = [
+        (PENDING, 'Ожидает'),
+        (DONE, 'Обработана'),
+        (SKIPPED, 'Пропущена'),  # UIDVALIDITY сменился, письма пересмотрит новый просмотр
+    ]
+
+    state = models.ForeignKey(MailboxSyncState, on_delete=models.CASCADE, related_name='batches')
+    uidvalidity = models.BigIntegerField()
+    uids = models.TextField()  # набор UID через запятую, как в UID FETCH
+    first_uid = models.BigIntegerField()
+    last_uid = models.BigIntegerField()
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    lease_owner = models.CharField(max_length=100, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = LeaseManager()
+
+    def uid_list(self):
+        return [int(uid) for uid in self.uids.split(',') if uid]
+
+    def __str__(self):
+        return f"{self.state.mailbox} UID {self.first_uid}–{self.last_uid} ({self.status})"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'lease_expires_at'], name='mailbox_batch_claim_idx'),
+        ]
+
+
+class IngestionRun(models.Model):
+    """Итог одного запуска импорта почты: счётчики и время по этапам в секундах."""
+    STAGES = ['scan', 'fetch', 'parse', 'summarize', 'dedup', 'attachments', 'db', 'mark_seen']
+
+    started_at = models.DateTimeField(db_index=True)
+    duration = models.FloatField()
+    worker = models.CharField(max_length=100)
+    mailboxes = models.CharField(max_length=255, blank=True)
+    batches = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    created = models.PositiveIntegerField(default=0)
+    queries = models.PositiveIntegerField(default=0)
+    query_seconds = models.FloatField(default=0)
+    scan = models.FloatField(default=0)  # UID SEARCH и раскладка по пачкам
+    fetch = models.FloatField(default=0)  # UID FETCH (при потоковом режиме — вместе с разбором заголовков)
+    parse = models.FloatField(default=0)
+    summarize = models.FloatField(default=0)
+    dedup = models.FloatField(default=0)
+    attachments = models.FloatField(default=0)
+    db = models.FloatField(default=0)  # Транзакция создания записей, поиск и сводка сроков
+    mark_seen = models.FloatField(default=0)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.started_at:%Y-%m-%d %H:%M:%S} {self.worker}: {self.processed} processed in {self.duration:.1f}s"
+
+
+class SummaryRequest(models.Model):
+    """Письмо в очереди на реферирование: текст хранится здесь до получения резюме."""
+    incoming = models.OneToOneField(Incoming, on_delete=models.CASCADE, related_name='summary_request')
+    text = models.TextField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    requested_at = models.DateTimeField(default=timezone.now, db_index=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.incoming} ({self.attempts} attempts)"
+
+
+class DeletedIncoming(models.Model):
+    """Отметка удаления записи из реестра для ленты изменений API.
+
+    Хранится API_TOMBSTONE_RETENTION_DAYS дней: клиент, не синхронизировавшийся
+    дольше, получает 410 и загружает реестр заново.
+    """
+    DELETED, ARCHIVED = 'deleted', 'archived'
+    REASONS = [(DELETED, 'Удалена'), (ARCHIVED, 'Перенесена в архив')]
+
+    incoming_id = models.BigIntegerField(db_index=True)
+    incoming_number = models.IntegerField()
+    reason = models.CharField(max_length=10, choices=REASONS, default=DELETED)
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"№{self.incoming_number}: {self.get_reason_display()} {self.deleted_at:%Y-%m-%d %H:%M}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'], name='deleted_incoming_cursor_idx'),
+        ]
+
+
+class ArchivedIncoming(models.Model):
+    """Закрытая запись, перенесённая из реестра в архив (archive.py); только для чтения.
+
+    id и номер сохраняются, поэтому ссылки на карточку записи продолжают работать.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    incoming_number = models.IntegerField(unique=True)
+    incoming_date = models.DateField()
+    applicant = models.CharField(max_length=255)
+    summary = models.TextField()
+    responsible = models.CharField(max_length=100)
+    response_deadline = models.DateField()
+    dedup_key = models.CharField(max_length=64, blank=True)
+    message_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"№{self.incoming_number} от {self.incoming_date} (архив)"
+
+    class Meta:
+        ordering = ['-incoming_date', '-incoming_number']
+        indexes = [
+            models.Index(fields=['-incoming_date', '-incoming_number'], name='archive_date_number_idx'),
+        ]
+
+
+class ArchivePack(models.Model):
+    """Месячный zip-пакет вложений архива; дописывает один владелец аренды."""
+    name = models.CharField(max_length=100, unique=True)  # Путь относительно ARCHIVE_ROOT: 2019/2019-03.zip
+    members = models.PositiveIntegerField(default=0)
+    size = models.BigIntegerField(default=0)  # Байт на диске
+    original_size = models.BigIntegerField(default=0)  # Байт до сжатия
+    lease_owner = models.CharField(max_length=100, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = LeaseManager()
+
+    def __str__(self):
+        return f"{self.name} ({self.members} files)"
+
+
+class ArchivedAttachment(models.Model):
+    """Вложение архивной записи: элемент пакета, читаемый по смещению без оглавления zip."""
+    incoming = models.ForeignKey(ArchivedIncoming, on_delete=models.CASCADE, related_name='attachments')
+    filename = models.CharField(max_length=255, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True)
+    pack = models.ForeignKey(ArchivePack, on_delete=models.PROTECT, null=True, blank=True)  # None — файла не было
+    offset = models.BigIntegerField(default=0)  # Локальный заголовок элемента в пакете
+    compressed_size = models.BigIntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+    method = models.PositiveSmallIntegerField(default=0)  # zipfile.ZIP_STORED или ZIP_DEFLATED
+
+    def __str__(self):
+        return self.filename or self.sha256
+
+
+class CachedSummary(models.Model):
+    """Кэш кратких содержаний по хэшу нормализованного текста запроса к модели."""
+    key = models.CharField(max_length=64, unique=True)
+    summary = models.TextField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.key[:12]}… ({self.hits} hits)"
+
+
+class DeadlineSummaryManager(models.Manager):
+    """Сводка «ответственный × срок ответа» для панели сроков.
+
+    Корзины зависят от текущей даты, поэтому сводка считается на день
+    (computed_on): в течение дня её поддерживают сигналы сохранения и
+    удаления Incoming, а со сменой дня она пересчитывается целиком —
+    ночной задачей или при первом обращении.
+    """
+
+    def bucket(self, deadline, today):
+        if deadline < today:
+            return DeadlineSummary.OVERDUE
+        if deadline == today:
+            return DeadlineSummary.TODAY
+        if deadline <= today + timedelta(days=DeadlineSummary.WEEK_DAYS):
+            return DeadlineSummary.WEEK
+        return DeadlineSummary.LATER
+
+    def rebuild(self, today=None):
+        """Пересчёт сводки одним GROUP BY по реестру; возвращает число строк сводки."""
+        today = today or timezone.localdate()
+        week_end = today + timedelta(days=DeadlineSummary.WEEK_DAYS)
+        bucket = Case(
+            When(response_deadline__lt=today, then=Value(DeadlineSummary.OVERDUE)),
+            When(response_deadline=today, then=Value(DeadlineSummary.TODAY)),
+            When(response_deadline__lte=week_end, then=Value(DeadlineSummary.WEEK)),
+            default=Value(DeadlineSummary.LATER),
+        )
+        groups = (
+            Incoming.objects.order_by()
+            .values('responsible', bucket_name=bucket)
+            .annotate(total=Count('pk'))
+        )
+        rows = [
+            DeadlineSummary(responsible=group['responsible'], bucket=group['bucket_name'],
+                            count=group['total'], computed_on=today)
+            for group in groups
+        ]
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(rows)
+        return len(rows)
+
+    def current(self, today=None):
+        """Строки сводки на сегодня; устаревшая или пустая сводка пересчитывается."""
+        today = today or timezone.localdate()
+        if self.exclude(computed_on=today).exists() or not self.exists():
+            self.rebuild(today)
+        return self.filter(computed_on=today)
+
+    def adjust(self, responsible, deadline, delta, today=None):
+        """Изменение счётчика корзины на delta; устаревшую сводку не трогает — её пересчитают."""
+        today = today or timezone.localdate()
+        deadline = Incoming._meta.get_field('response_deadline').to_python(deadline)
+        bucket = self.bucket(deadline, today)
+        if self.filter(responsible=responsible, bucket=bucket, computed_on=today).update(count=F('count') + delta):
+            return
+        if delta > 0 and self.filter(computed_on=today).exists():
+            try:
+                with transaction.atomic():
+                    self.create(responsible=responsible, bucket=bucket, count=delta, computed_on=today)
+            except IntegrityError:
+                # Строку одновременно создал другой процесс
+                self.filter(responsible=responsible, bucket=bucket, computed_on=today).update(count=F('count') + delta)
+
+    def add_records(self, records, today=None):
+        """Учёт записей, созданных bulk_create (сигналы для них не срабатывают)."""
+        today = today or timezone.localdate()
+        totals = {}
+        for incoming in records:
+            key = (incoming.responsible, incoming.response_deadline)
+            totals[key] = totals.get(key, 0) + 1
+        for (responsible, deadline), delta in totals.items():
+            self.adjust(responsible, deadline, delta, today)
+
+
+class DeadlineSummary(models.Model):
+    """Число записей реестра у ответственного в корзине по сроку ответа."""
+    OVERDUE, TODAY, WEEK, LATER = 'overdue', 'today', 'week', 'later'
+    BUCKETS = [
+        (OVERDUE, 'Просрочено'),
+        (TODAY, 'Сегодня'),
+        (WEEK, 'В ближайшие 7 дней'),
+        (LATER, 'Позже'),
+    ]
+    WEEK_DAYS = 7
+
+    responsible = models.CharField(max_length=100)
+    bucket = models.CharField(max_length=10, choices=BUCKETS)
+    count = models.PositiveIntegerField(default=0)
+    computed_on = models.DateField()
+
+    objects = DeadlineSummaryManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['responsible', 'bucket'], name='deadline_summary_unique'),
+        ]
 
     def __str__(self):
-        return self.filename or self.file.name
\ No newline at end of file
+        return f"{self.responsible}: {self.get_bucket_display()} — {self.count}"
@@ -0,0 +1,89 @@
+# registry/page_cache.py
+"""Кэш отрисованных страниц реестра.
+
+Ключ страницы — пользователь, нормализованные фильтры и курсор, а также
+версия реестра: счётчик в том же кэше, который увеличивается после
+фиксации любого изменения Incoming или Attachment. Старые страницы при
+этом не удаляются, а просто перестают находиться и вытесняются по TTL.
+
+Бэкенд задаётся алиасом REGISTER_CACHE_ALIAS: файловый кэш общий для
+веб-процессов и воркеров Celery на одной машине, локальная память
+годится только для одного процесса.
+"""
+import hashlib
+import time
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from .filters import get_filters
+
+VERSION_KEY = 'registry:version'
+CURSOR_PARAMS = ('after', 'before', 'page')
+
+
+def get_cache():
+    return caches[settings.REGISTER_CACHE_ALIAS]
+
+
+def register_version():
+    cache = get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Ключ вытеснен или кэш пуст: новая версия не должна совпасть ни с одной прежней
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def _bump():
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def bump_register_version():
+    """Инвалидация всех страниц после фиксации текущей транзакции.
+
+    До фиксации параллельный запрос ещё видит старые данные и закэшировал бы
+    их под новой версией.
+    """
+    transaction.on_commit(_bump)
+
+
+def versioned_key(prefix, parts):
+    """Ключ кэша с текущей версией реестра; parts — пары (имя, значение)."""
+    signature = '&'.join(f'{name}={value}' for name, value in sorted(parts))
+    digest = hashlib.sha256(signature.encode('utf-8')).hexdigest()
+    return f'registry:{prefix}:{register_version()}:{digest}'
+
+
+def page_key(request, user):
+    params = [(name, value) for name, value in get_filters(request.GET).items() if value]
+    params += [(name, request.GET[name]) for name in CURSOR_PARAMS if request.GET.get(name)]
+    params.append(('user', user.pk))
+    return versioned_key('page', params)
+
+
+def cache_register_page(view):
+    """Отдача страницы реестра из кэша для асинхронного представления; кэшируются только успешные GET-ответы."""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        timeout = settings.REGISTER_PAGE_CACHE_TTL
+        if request.method != 'GET' or not timeout:
+            return await view(request, *args, **kwargs)
+        # Версия реестра читается синхронными вызовами кэша — в потоке, не блокируя цикл событий
+        key = await sync_to_async(page_key)(request, await request.auser())
+        cached = await get_cache().aget(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+        response = await view(request, *args, **kwargs)
+        if response.status_code == 200 and not response.streaming:
+            await get_cache().aset(key, (response.content, response['Content-Type']), timeout)
+        return response
+    return wrapper
@@ -0,0 +1,108 @@
+# registry/pagination.py
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .page_cache import get_cache, versioned_key
+
+
+class KeysetPage:
+    """Страница реестра, выбранная по курсору номера вместо OFFSET.
+
+    Повторяет ту часть интерфейса django.core.paginator.Page, которую
+    использует шаблон: итерация, has_next, has_previous.
+    """
+
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    @property
+    def next_cursor(self):
+        """Курсор следующей страницы: номер последней строки."""
+        return self.object_list[-1].incoming_number if self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        """Курсор предыдущей страницы: номер первой строки."""
+        return self.object_list[0].incoming_number if self.object_list else None
+
+
+def parse_cursor(value):
+    try:
+        return int(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def keyset_query(queryset, after=None, before=None, per_page=10):
+    """Запрос строк страницы keyset_page: per_page + 1 строка по индексу номера."""
+    if before is not None:
+        return queryset.filter(incoming_number__gt=before).order_by('incoming_number')[:per_page + 1]
+    if after is not None:
+        queryset = queryset.filter(incoming_number__lt=after)
+    return queryset.order_by('-incoming_number')[:per_page + 1]
+
+
+def page_from_rows(rows, after=None, before=None, per_page=10):
+    if before is not None:
+        return KeysetPage(rows[:per_page][::-1], has_next=True, has_previous=len(rows) > per_page)
+    return KeysetPage(rows[:per_page], has_next=len(rows) > per_page, has_previous=after is not None)
+
+
+def keyset_page(queryset, after=None, before=None, per_page=10):
+    """Страница queryset, упорядоченного по убыванию incoming_number.
+
+    after — номер, после которого (то есть меньше которого) начинается страница,
+    before — номер, перед которым она заканчивается. Каждая страница — один
+    запрос по индексу номера с LIMIT per_page + 1, без COUNT и OFFSET.
+    """
+    rows = list(keyset_query(queryset, after, before, per_page))
+    return page_from_rows(rows, after, before, per_page)
+
+
+async def akeyset_page(queryset, after=None, before=None, per_page=10):
+    """keyset_page для асинхронных представлений."""
+    rows = [row async for row in keyset_query(queryset, after, before, per_page)]
+    return page_from_rows(rows, after, before, per_page)
+
+
+def cached_count(queryset, filters):
+    """Число записей под фильтром, закэшированное на REGISTER_COUNT_CACHE_TTL секунд.
+
+    COUNT(*) выполняется не на каждый переход, а один раз для набора фильтров
+    и версии реестра: любое изменение записей сбрасывает итоги.
+    """
+    if not settings.REGISTER_COUNT_CACHE_TTL:
+        return None
+    cache = get_cache()
+    key = versioned_key('count', filters.items())
+    total = cache.get(key)
+    if total is None:
+        total = queryset.count()
+        cache.set(key, total, settings.REGISTER_COUNT_CACHE_TTL)
+    return total
+
+
+async def acached_count(queryset, filters):
+    """cached_count для асинхронных представлений."""
+    if not settings.REGISTER_COUNT_CACHE_TTL:
+        return None
+    cache = get_cache()
+    key = await sync_to_async(versioned_key)('count', filters.items())
+    total = await cache.aget(key)
+    if total is None:
+        total = await queryset.acount()
+        await cache.aset(key, total, settings.REGISTER_COUNT_CACHE_TTL)
+    return total
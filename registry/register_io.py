@@ -0,0 +1,200 @@
+# registry/register_io.py
+"""Потоковые импорт и экспорт реестра в CSV и XLSX.
+
+Строки читаются и пишутся по одной, в базу записи попадают пачками
+через bulk_create, поэтому объём памяти не зависит от размера файла.
+"""
+import csv
+from datetime import date, datetime, timedelta
+from itertools import islice
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from .models import ArchivedIncoming, DeadlineSummary, Incoming, NumberCounter
+from .page_cache import bump_register_version
+from .search import index_many
+
+try:
+    import openpyxl
+except ImportError:  # XLSX необязателен, CSV работает без него
+    openpyxl = None
+
+COLUMNS = ('incoming_number', 'incoming_date', 'applicant', 'summary', 'responsible', 'response_deadline')
+EXPORT_COLUMNS = COLUMNS + ('attachment_count',)
+REQUIRED_COLUMNS = ('applicant', 'summary', 'responsible')
+DEFAULT_DEADLINE_DAYS = 10
+
+
+class ImportRowError(ValueError):
+    """Ошибка в строке файла; line — номер строки с учётом заголовка."""
+
+    def __init__(self, line, message):
+        super().__init__(f'line {line}: {message}')
+        self.line = line
+
+
+def require_openpyxl():
+    if openpyxl is None:
+        raise ImproperlyConfigured('XLSX import/export requires the openpyxl package.')
+    return openpyxl
+
+
+def file_format(path, default='csv'):
+    """Формат по расширению файла: csv или xlsx."""
+    return 'xlsx' if str(path).lower().endswith('.xlsx') else default
+
+
+# Чтение
+
+def read_csv(stream, delimiter=','):
+    """Строки CSV как словари; stream — текстовый файл."""
+    yield from csv.DictReader(stream, delimiter=delimiter)
+
+
+def read_xlsx(path):
+    """Строки первого листа XLSX как словари; первая строка — заголовок."""
+    workbook = require_openpyxl().load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(cell).strip() if cell is not None else '' for cell in next(rows, ())]
+        for row in rows:
+            yield dict(zip(header, row))
+    finally:
+        workbook.close()
+
+
+def parse_date(value):
+    """Дата из ячейки XLSX или строки в формате ГГГГ-ММ-ДД либо ДД.ММ.ГГГГ."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value, '%d.%m.%Y').date()
+    except ValueError:
+        raise ValueError(f'invalid date {value!r}') from None
+
+
+def build_incoming(row, line):
+    """Несохранённый Incoming из строки файла; номер 0 означает «выдать счётчиком»."""
+    values = {column: row.get(column) for column in COLUMNS}
+    values = {column: value.strip() if isinstance(value, str) else value for column, value in values.items()}
+    for column in REQUIRED_COLUMNS:
+        if not values[column]:
+            raise ImportRowError(line, f'{column} is required')
+    try:
+        number = int(values['incoming_number']) if values['incoming_number'] else 0
+        incoming_date = parse_date(values['incoming_date']) if values['incoming_date'] else date.today()
+        deadline = (parse_date(values['response_deadline']) if values['response_deadline']
+                    else incoming_date + timedelta(days=DEFAULT_DEADLINE_DAYS))
+    except (TypeError, ValueError) as error:
+        raise ImportRowError(line, str(error)) from error
+    if number < 0:
+        raise ImportRowError(line, 'incoming_number must be positive')
+    applicant, summary = str(values['applicant']), str(values['summary'])
+    return Incoming(
+        incoming_number=number,
+        incoming_date=incoming_date,
+        applicant=applicant,
+        summary=summary,
+        responsible=str(values['responsible']),
+        response_deadline=deadline,
+        dedup_key=Incoming.make_dedup_key(applicant, incoming_date, summary),
+    )
+
+
+def max_number(rows):
+    """Наибольший явный номер в файле — первый проход перед импортом."""
+    highest = 0
+    for row in rows:
+        try:
+            highest = max(highest, int(row.get('incoming_number') or 0))
+        except (TypeError, ValueError):
+            pass  # ошибку в строке сообщит основной проход
+    return highest
+
+
+def import_rows(rows, batch_size=1000, skip_existing=False):
+    """Загрузка строк в реестр пачками; генератор, после каждой пачки отдаёт (создано, пропущено).
+
+    Явные номера резервируются в счётчике, строкам без номера выделяется
+    один блок на пачку. Каждая пачка — отдельная транзакция. Чтобы номера
+    из счётчика не заняли явные номера следующих пачек, до импорта нужно
+    зарезервировать max_number() файла.
+    """
+    rows = enumerate(rows, start=2)
+    while True:
+        batch = [build_incoming(row, line) for line, row in islice(rows, batch_size)]
+        if not batch:
+            return
+        yield write_batch(batch, skip_existing)
+
+
+def write_batch(batch, skip_existing=False):
+    numbers = [incoming.incoming_number for incoming in batch if incoming.incoming_number]
+    if len(numbers) != len(set(numbers)):
+        raise ValueError('duplicate incoming_number values in the file')
+    # Номера архивных записей тоже заняты
+    existing = set()
+    for model in (Incoming, ArchivedIncoming):
+        existing.update(model.objects.filter(incoming_number__in=numbers).values_list('incoming_number', flat=True))
+    if existing and not skip_existing:
+        raise ValueError(f'incoming numbers already exist: {", ".join(map(str, sorted(existing)[:10]))}')
+    fresh = [incoming for incoming in batch if incoming.incoming_number not in existing]
+
+    with transaction.atomic():
+        if numbers:
+            NumberCounter.objects.reserve(max(numbers))
+        unnumbered = [incoming for incoming in fresh if not incoming.incoming_number]
+        for incoming, number in zip(unnumbered, NumberCounter.objects.allocate(len(unnumbered))):
+            incoming.incoming_number = number
+        records = Incoming.objects.bulk_create(fresh)
+        index_many(records)
+        DeadlineSummary.objects.add_records(records)
+        bump_register_version()
+    return len(records), len(batch) - len(fresh)
+
+
+# Запись
+
+def export_rows(queryset, chunk_size=2000):
+    """Строки реестра (списки значений EXPORT_COLUMNS) без загрузки всей выборки в память."""
+    for values in queryset.values_list(*EXPORT_COLUMNS).iterator(chunk_size=chunk_size):
+        yield list(values)
+
+
+class Echo:
+    """Псевдобуфер для csv.writer: возвращает записанную строку вместо накопления."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, delimiter=','):
+    """CSV построчно, с BOM, чтобы Excel распознал UTF-8."""
+    writer = csv.writer(Echo(), delimiter=delimiter)
+    yield '\ufeff' + writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writer.writerow(value.isoformat() if isinstance(value, date) else value for value in row)
+
+
+def write_csv(rows, stream, delimiter=','):
+    count = 0
+    for count, line in enumerate(csv_lines(rows, delimiter)):
+        stream.write(line)
+    return count
+
+
+def write_xlsx(rows, target):
+    """Запись в XLSX в режиме write_only: строки сразу уходят в файл; target — путь или файл."""
+    workbook = require_openpyxl().Workbook(write_only=True)
+    sheet = workbook.create_sheet('Входящие')
+    sheet.append(EXPORT_COLUMNS)
+    count = 0
+    for count, row in enumerate(rows, start=1):
+        sheet.append(row)
+    workbook.save(target)
+    return count
@@ -0,0 +1,253 @@
+# registry/search.py
+"""Полнотекстовый индекс реестра: FTS5 в SQLite, tsvector в PostgreSQL.
+
+Индекс хранит заявителя, краткое содержание, ответственного и текст
+вложений (имена файлов и извлечённое содержимое, см. extraction.py)
+каждой записи Incoming и обновляется сигналами при сохранении и удалении
+записей. Архивные записи (ArchivedIncoming, archive.py) индексируются
+в отдельной таблице того же устройства: поиск по queryset модели
+обращается к индексу этой модели.
+"""
+from django.db import connection
+from django.db.models import OuterRef, Q, Subquery
+from django.db.models.expressions import RawSQL
+from .models import Incoming, AttachmentContent
+from .stemmer import stem, stem_text, tokenize
+
+SEARCH_COLUMNS = ('applicant', 'summary', 'responsible', 'attachments')
+
+
+def attachment_documents(incoming_ids, model=Incoming):
+    """Текст вложений записей одним запросом: {incoming_id: [имя файла и содержимое, ...]}."""
+    content = AttachmentContent.objects.filter(
+        sha256=OuterRef('sha256'), status=AttachmentContent.DONE).values('text')[:1]
+    attachments = model._meta.get_field('attachments').related_model
+    documents = {}
+    for incoming_id, filename, text in attachments.objects.filter(incoming_id__in=incoming_ids).values_list(
+            'incoming_id', 'filename', Subquery(content)):
+        documents.setdefault(incoming_id, []).append(f'{filename} {text}' if text else filename)
+    return documents
+
+
+def document_for(incoming, attachments=None):
+    """Индексируемые поля записи; attachments — тексты вложений, если уже известны."""
+    if attachments is None:
+        attachments = attachment_documents([incoming.pk], type(incoming)).get(incoming.pk, [])
+    return {
+        'applicant': incoming.applicant,
+        'summary': incoming.summary,
+        'responsible': incoming.responsible,
+        'attachments': ' '.join(attachments),
+    }
+
+
+class SQLiteSearchBackend:
+    """FTS5 по основам слов: текст стеммируется в Python, поиск — по префиксам основ."""
+    suffix = '_fts'
+
+    def __init__(self, model=Incoming):
+        self.source = model._meta.db_table
+        self.table = self.source + self.suffix
+
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+            f"USING fts5({', '.join(SEARCH_COLUMNS)}, tokenize='unicode61 remove_diacritics 2')"
+        )
+
+    def drop(self, cursor):
+        cursor.execute(f'DROP TABLE IF EXISTS {self.table}')
+
+    def index(self, cursor, pk, document):
+        self.index_many(cursor, [(pk, document)])
+
+    def index_many(self, cursor, documents):
+        """Запись пачки (pk, document) одним executemany."""
+        cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s', [[pk] for pk, _ in documents])
+        cursor.executemany(
+            f"INSERT INTO {self.table} (rowid, {', '.join(SEARCH_COLUMNS)}) VALUES (%s, %s, %s, %s, %s)",
+            [[pk] + [stem_text(document[column]) for column in SEARCH_COLUMNS] for pk, document in documents],
+        )
+
+    def remove(self, cursor, pk):
+        cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [pk])
+
+    def match_expression(self, text, column=None):
+        terms = [f'"{stem(token)}"*' for token in tokenize(text)]
+        if not terms:
+            return None
+        expression = ' '.join(terms)
+        return f'{{{column}}} : ({expression})' if column else expression
+
+    def filter(self, queryset, text, column=None, rank=False):
+        expression = self.match_expression(text, column)
+        if expression is None:
+            return queryset
+        queryset = queryset.filter(pk__in=RawSQL(
+            f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s', [expression]
+        ))
+        if rank:
+            # bm25: чем меньше, тем релевантнее
+            queryset = queryset.annotate(search_rank=RawSQL(
+                f'SELECT bm25({self.table}) FROM {self.table} '
+                f'WHERE {self.table} MATCH %s AND rowid = {self.source}.id', [expression]
+            )).order_by('search_rank', '-incoming_number')
+        return queryset
+
+
+class PostgresSearchBackend:
+    """tsvector с русской конфигурацией и GIN-индексами; стемминг выполняет PostgreSQL."""
+    suffix = '_search'
+
+    def __init__(self, model=Incoming):
+        self.source = model._meta.db_table
+        self.table = self.source + self.suffix
+
+    def create(self, cursor):
+        columns = ', '.join(f'{column} tsvector' for column in SEARCH_COLUMNS)
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table} ('
+            f'incoming_id bigint PRIMARY KEY REFERENCES {self.source} (id) ON DELETE CASCADE, '
+            f'{columns}, document tsvector)'
+        )
+        for column in SEARCH_COLUMNS + ('document',):
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.table}_{column}_gin ON {self.table} USING gin ({column})'
+            )
+
+    def drop(self, cursor):
+        cursor.execute(f'DROP TABLE IF EXISTS {self.table}')
+
+    def index(self, cursor, pk, document):
+        self.index_many(cursor, [(pk, document)])
+
+    def index_many(self, cursor, documents):
+        weights = dict(zip(SEARCH_COLUMNS, 'ABCD'))
+        vectors = ', '.join(f"to_tsvector('russian', %s)" for _ in SEARCH_COLUMNS)
+        combined = ' || '.join(f"setweight(to_tsvector('russian', %s), '{weights[column]}')" for column in SEARCH_COLUMNS)
+        params = []
+        for pk, document in documents:
+            values = [document[column] or '' for column in SEARCH_COLUMNS]
+            params.append([pk] + values + values)
+        cursor.executemany(
+            f"INSERT INTO {self.table} (incoming_id, {', '.join(SEARCH_COLUMNS)}, document) "
+            f"VALUES (%s, {vectors}, {combined}) "
+            f"ON CONFLICT (incoming_id) DO UPDATE SET "
+            + ', '.join(f'{column} = EXCLUDED.{column}' for column in SEARCH_COLUMNS + ('document',)),
+            params,
+        )
+
+    def remove(self, cursor, pk):
+        cursor.execute(f'DELETE FROM {self.table} WHERE incoming_id = %s', [pk])
+
+    def query_expression(self, text):
+        terms = [f'{token}:*' for token in tokenize(text)]
+        return ' & '.join(terms) or None
+
+    def filter(self, queryset, text, column=None, rank=False):
+        expression = self.query_expression(text)
+        if expression is None:
+            return queryset
+        vector = column or 'document'
+        queryset = queryset.filter(pk__in=RawSQL(
+            f"SELECT incoming_id FROM {self.table} WHERE {vector} @@ to_tsquery('russian', %s)", [expression]
+        ))
+        if rank:
+            queryset = queryset.annotate(search_rank=RawSQL(
+                f"SELECT -ts_rank(document, to_tsquery('russian', %s)) FROM {self.table} "
+                f"WHERE incoming_id = {self.source}.id", [expression]
+            )).order_by('search_rank', '-incoming_number')
+        return queryset
+
+
+class FallbackSearchBackend:
+    """Для прочих СУБД: поиск подстроки без индекса."""
+
+    def __init__(self, model=Incoming):
+        pass
+
+    def create(self, cursor):
+        pass
+
+    def drop(self, cursor):
+        pass
+
+    def index(self, cursor, pk, document):
+        pass
+
+    def index_many(self, cursor, documents):
+        pass
+
+    def remove(self, cursor, pk):
+        pass
+
+    def filter(self, queryset, text, column=None, rank=False):
+        columns = [column] if column else ['applicant', 'summary', 'responsible', 'attachments']
+        condition = Q()
+        for name in columns:
+            if name == 'attachments':
+                texts = AttachmentContent.objects.filter(text__icontains=text).values('sha256')
+                condition |= Q(attachments__filename__icontains=text) | Q(attachments__sha256__in=texts)
+                continue
+            condition |= Q(**{f'{name}__icontains': text})
+        return queryset.filter(condition).distinct()
+
+
+def get_backend(vendor=None, model=Incoming):
+    """Индекс модели model (Incoming или ArchivedIncoming) для СУБД vendor."""
+    vendor = vendor or connection.vendor
+    if vendor == 'sqlite':
+        return SQLiteSearchBackend(model)
+    if vendor == 'postgresql':
+        return PostgresSearchBackend(model)
+    return FallbackSearchBackend(model)
+
+
+def index_incoming(incoming):
+    """Обновление записи в индексе."""
+    with connection.cursor() as cursor:
+        get_backend(model=type(incoming)).index(cursor, incoming.pk, document_for(incoming))
+
+
+def index_many(records):
+    """Индексация пачки записей одной модели (после bulk_create сигналы не срабатывают)."""
+    if not records:
+        return
+    model = type(records[0])
+    attachments = attachment_documents([incoming.pk for incoming in records], model)
+    with connection.cursor() as cursor:
+        get_backend(model=model).index_many(cursor, [
+            (incoming.pk, document_for(incoming, attachments.get(incoming.pk, []))) for incoming in records
+        ])
+
+
+def remove_incoming(pk, model=Incoming):
+    with connection.cursor() as cursor:
+        get_backend(model=model).remove(cursor, pk)
+
+
+def rebuild_index(batch_size=1000, model=Incoming):
+    """Полная перестройка индекса модели; возвращает число проиндексированных записей."""
+    backend = get_backend(model=model)
+    with connection.cursor() as cursor:
+        backend.drop(cursor)
+        backend.create(cursor)
+    total = 0
+    queryset = model.objects.order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return total
+        attachments = attachment_documents([incoming.pk for incoming in batch], model)
+        with connection.cursor() as cursor:
+            backend.index_many(cursor, [
+                (incoming.pk, document_for(incoming, attachments.get(incoming.pk, []))) for incoming in batch
+            ])
+        total += len(batch)
+        last_pk = batch[-1].pk
+
+
+def search(queryset, text, column=None, rank=False):
+    """Отбор записей queryset по индексу; rank=True упорядочивает по релевантности."""
+    return get_backend(model=queryset.model).filter(queryset, text, column=column, rank=rank)
@@ -0,0 +1,84 @@
+# registry/signals.py
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.db import transaction
+from django.dispatch import receiver
+from .models import Incoming, Attachment, DeadlineSummary, DeletedIncoming
+from . import metrics, search
+from .page_cache import bump_register_version
+
+
+@receiver(post_save, sender=Incoming)
+def index_saved_incoming(sender, instance, **kwargs):
+    search.index_incoming(instance)
+
+
+@receiver(post_delete, sender=Incoming)
+def unindex_deleted_incoming(sender, instance, **kwargs):
+    search.remove_incoming(instance.pk)
+
+
+@receiver(post_delete, sender=Incoming)
+def record_deleted_incoming(sender, instance, **kwargs):
+    # Лента изменений API сообщает клиентам об удалении
+    DeletedIncoming.objects.create(incoming_id=instance.pk, incoming_number=instance.incoming_number)
+
+
+@receiver(post_save, sender=Attachment)
+@receiver(post_delete, sender=Attachment)
+def touch_attachment_owner(sender, instance, **kwargs):
+    Incoming.objects.touch([instance.incoming_id])
+
+
+@receiver(post_save, sender=Attachment)
+@receiver(post_delete, sender=Attachment)
+def reindex_attachment_owner(sender, instance, **kwargs):
+    incoming = Incoming.objects.filter(pk=instance.incoming_id).first()
+    if incoming is not None:
+        search.index_incoming(incoming)
+
+
+@receiver(pre_save, sender=Incoming)
+def remember_deadline(sender, instance, **kwargs):
+    # Прежние ответственный и срок нужны, чтобы перенести запись между корзинами сводки
+    instance._deadline_before = None
+    if instance.pk:
+        instance._deadline_before = Incoming.objects.filter(pk=instance.pk).values_list(
+            'responsible', 'response_deadline').first()
+
+
+@receiver(post_save, sender=Incoming)
+def update_deadline_summary(sender, instance, created, **kwargs):
+    current = (instance.responsible, instance.response_deadline)
+    before = getattr(instance, '_deadline_before', None)
+    if before is not None and tuple(before) == current:
+        return
+    if before is not None:
+        DeadlineSummary.objects.adjust(*before, delta=-1)
+    DeadlineSummary.objects.adjust(*current, delta=1)
+
+
+@receiver(post_delete, sender=Incoming)
+def remove_from_deadline_summary(sender, instance, **kwargs):
+    DeadlineSummary.objects.adjust(instance.responsible, instance.response_deadline, delta=-1)
+
+
+@receiver(post_save, sender=Incoming)
+@receiver(post_delete, sender=Incoming)
+@receiver(post_save, sender=Attachment)
+@receiver(post_delete, sender=Attachment)
+def invalidate_register_pages(sender, **kwargs):
+    bump_register_version()
+
+
+@receiver(post_delete, sender=Attachment)
+def collect_attachment_file(sender, instance, **kwargs):
+    # Blob может быть общим для нескольких вложений: удаляется, только когда ссылок не осталось
+    name, storage = instance.file.name, instance.file.storage
+    transaction.on_commit(lambda: storage.collect(name))
+
+
+@receiver(connection_created)
+def count_queries(sender, connection, **kwargs):
+    # Число и время SQL-запросов для замеров metrics.collect()
+    metrics.install_query_wrapper(connection)
@@ -0,0 +1,114 @@
+# registry/stemmer.py
+"""Стеммер русского языка по алгоритму Snowball (snowballstem.org/algorithms/russian)."""
+import re
+from functools import lru_cache
+
+WORD_RE = re.compile(r'\w+')
+CYRILLIC_RE = re.compile(r'[а-я]')
+VOWELS = set('аеиоуыэюя')
+
+# (окончание, требуется ли перед ним «а» или «я»)
+PERFECTIVE_GERUND = [('в', True), ('вши', True), ('вшись', True),
+                     ('ив', False), ('ивши', False), ('ившись', False),
+                     ('ыв', False), ('ывши', False), ('ывшись', False)]
+ADJECTIVE = [(ending, False) for ending in (
+    'ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом',
+    'его', 'ого', 'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею')]
+PARTICIPLE = [('ем', True), ('нн', True), ('вш', True), ('ющ', True), ('щ', True),
+              ('ивш', False), ('ывш', False), ('ующ', False)]
+REFLEXIVE = [('ся', False), ('сь', False)]
+VERB = [(ending, True) for ending in (
+    'ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'ешь', 'нно')] + \
+       [(ending, False) for ending in (
+    'ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен',
+    'ило', 'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю')]
+NOUN = [(ending, False) for ending in (
+    'а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей', 'ой', 'ий', 'й',
+    'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия', 'ья', 'я')]
+
+for group in (PERFECTIVE_GERUND, ADJECTIVE, PARTICIPLE, REFLEXIVE, VERB, NOUN):
+    group.sort(key=lambda item: len(item[0]), reverse=True)
+
+
+def _regions(word):
+    """Начала областей RV и R2 (индексы в слове)."""
+    rv = r1 = r2 = len(word)
+    for index, char in enumerate(word):
+        if char in VOWELS:
+            rv = index + 1
+            break
+    for index in range(1, len(word)):
+        if word[index - 1] in VOWELS and word[index] not in VOWELS:
+            r1 = index + 1
+            break
+    for index in range(r1 + 1, len(word)):
+        if word[index - 1] in VOWELS and word[index] not in VOWELS:
+            r2 = index + 1
+            break
+    return rv, r2
+
+
+def _remove(word, rv, endings):
+    """Удаление самого длинного окончания группы в пределах RV; None, если не подошло."""
+    for ending, after_a in endings:
+        if word.endswith(ending) and len(word) - len(ending) >= rv:
+            stem = word[:-len(ending)]
+            if after_a and not (len(stem) > rv and stem[-1] in 'ая'):
+                return None
+            return stem
+    return None
+
+
+@lru_cache(maxsize=100000)
+def stem(word):
+    """Основа слова; некириллические слова возвращаются в нижнем регистре без изменений."""
+    word = word.lower().replace('ё', 'е')
+    if not CYRILLIC_RE.search(word):
+        return word
+    rv, r2 = _regions(word)
+
+    # Шаг 1
+    stemmed = _remove(word, rv, PERFECTIVE_GERUND)
+    if stemmed is None:
+        word = _remove(word, rv, REFLEXIVE) or word
+        adjective = _remove(word, rv, ADJECTIVE)
+        if adjective is not None:
+            stemmed = _remove(adjective, rv, PARTICIPLE) or adjective
+        else:
+            stemmed = _remove(word, rv, VERB)
+            if stemmed is None:
+                stemmed = _remove(word, rv, NOUN)
+    word = stemmed if stemmed is not None else word
+
+    # Шаг 2
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+
+    # Шаг 3: словообразовательные суффиксы в R2
+    for ending in ('ость', 'ост'):
+        if word.endswith(ending) and len(word) - len(ending) >= r2:
+            word = word[:-len(ending)]
+            break
+
+    # Шаг 4
+    superlative = False
+    for ending in ('ейше', 'ейш'):
+        if word.endswith(ending) and len(word) - len(ending) >= rv:
+            word = word[:-len(ending)]
+            superlative = True
+            break
+    if word.endswith('нн') and len(word) - 2 >= rv:
+        word = word[:-1]
+    elif not superlative and word.endswith('ь') and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Слова текста в нижнем регистре."""
+    return WORD_RE.findall(text.lower()) if text else []
+
+
+def stem_text(text):
+    """Текст из основ слов через пробел — в таком виде он попадает в индекс."""
+    return ' '.join(stem(token) for token in tokenize(text))
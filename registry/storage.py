@@ -0,0 +1,144 @@
+# registry/storage.py
+"""Хранилище вложений с адресацией по содержимому.
+
+Файл сохраняется под именем attachments/blobs/ab/cd/<sha256>, поэтому
+одинаковые вложения (рассылки, пересланные цепочки) хранятся один раз.
+Ссылки на blob — строки Attachment с этим именем файла: счётчиком ссылок
+служит индексированный запрос к таблице, который не расходится с данными
+при сбоях. Blob удаляется, когда на него не остаётся ссылок.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+BLOB_DIR = 'attachments/blobs'
+READ_SIZE = 64 * 1024
+
+
+def file_digest(file):
+    """SHA-256 открытого файла, читаемого кусками с начала."""
+    hasher = hashlib.sha256()
+    for block in iter(lambda: file.read(READ_SIZE), b''):
+        hasher.update(block)
+    return hasher.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage, который кладёт файлы по SHA-256 их содержимого."""
+
+    def blob_name(self, digest):
+        return f'{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}'
+
+    def is_blob(self, name):
+        return name.startswith(BLOB_DIR + '/')
+
+    def digest(self, name):
+        """SHA-256 по имени blob; для прочих файлов — пустая строка."""
+        return os.path.basename(name) if self.is_blob(name) else ''
+
+    def get_available_name(self, name, max_length=None):
+        # Итоговое имя определяется содержимым в _save, суффиксы не нужны
+        return name
+
+    def _touch(self, name):
+        # Свежее время изменения защищает blob от сборки мусора, пока ссылка на него не зафиксирована
+        os.utime(self.path(name))
+        return name
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek') and content.seekable():
+            # Повтор определяется до записи: для уже известного файла на диск ничего не пишется
+            content.seek(0)
+            blob = self.blob_name(file_digest(content))
+            if self.exists(blob):
+                return self._touch(blob)
+            content.seek(0)
+
+        blob_root = self.path(BLOB_DIR)
+        os.makedirs(blob_root, exist_ok=True)
+        hasher = hashlib.sha256()
+        descriptor, temporary = tempfile.mkstemp(dir=blob_root, prefix='.upload-')
+        try:
+            with os.fdopen(descriptor, 'wb') as target:
+                for chunk in content.chunks():
+                    hasher.update(chunk)
+                    target.write(chunk)
+            return self._place(temporary, hasher.hexdigest())
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def _place(self, source_path, digest, keep_source=False):
+        """Файл source_path на место blob; если такой blob уже есть, копия не нужна.
+
+        keep_source=True — blob становится жёсткой ссылкой на исходный файл,
+        который остаётся на месте (его удаляют после фиксации транзакции).
+        """
+        blob = self.blob_name(digest)
+        if self.exists(blob):
+            if not keep_source:
+                os.remove(source_path)
+            return self._touch(blob)
+        os.makedirs(os.path.dirname(self.path(blob)), exist_ok=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(source_path, self.file_permissions_mode)
+        if keep_source:
+            try:
+                os.link(source_path, self.path(blob))
+            except FileExistsError:
+                return self._touch(blob)
+        else:
+            # Одинаковое содержимое: одновременная замена другим процессом безопасна
+            os.replace(source_path, self.path(blob))
+        return blob
+
+    def adopt(self, name, digest=None, keep_source=False):
+        """Перевод файла name из-под MEDIA_ROOT в blob; digest — SHA-256, если уже известен."""
+        if self.is_blob(name):
+            return name
+        if not digest:
+            with self.open(name, 'rb') as source:
+                digest = file_digest(source)
+        return self._place(self.path(name), digest, keep_source)
+
+    def references(self, name):
+        from .models import Attachment
+        return Attachment.objects.filter(file=name).exists()
+
+    def collect(self, name, grace=None):
+        """Удаление файла, на который не ссылается ни одно вложение; True, если удалён.
+
+        Blob, изменённый (повторно использованный) менее grace секунд назад,
+        не трогается: ссылка на него может быть в ещё не зафиксированной транзакции.
+        """
+        grace = settings.ATTACHMENT_GC_GRACE if grace is None else grace
+        if not name or not self.exists(name) or self.references(name):
+            return False
+        if self.is_blob(name) and time.time() - os.path.getmtime(self.path(name)) < grace:
+            return False
+        self.delete(name)
+        return True
+
+    def unreferenced_blobs(self, grace=None):
+        """Имена blob без ссылок, старше grace секунд, — для периодической уборки."""
+        from .models import Attachment
+        grace = settings.ATTACHMENT_GC_GRACE if grace is None else grace
+        referenced = set(Attachment.objects.filter(file__startswith=BLOB_DIR + '/')
+                         .values_list('file', flat=True).iterator(chunk_size=5000))
+        cutoff = time.time() - grace
+        root = self.path(BLOB_DIR)
+        for directory, _, files in os.walk(root):
+            for filename in files:
+                if filename.startswith('.'):
+                    continue  # временный файл незавершённой записи
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, self.location).replace(os.sep, '/')
+                if name not in referenced and os.path.getmtime(path) < cutoff:
+                    yield name
+
+
+def attachment_storage():
+    return ContentAddressedStorage()
@@ -0,0 +1,149 @@
+# registry/summaries.py
+"""Отложенное реферирование писем.
+
+Импорт почты записывает Incoming сразу, с предварительным резюме из текста
+письма (summary_status=pending), а текст кладёт в SummaryRequest. Задачи
+summarize_incoming_task в отдельной очереди Celery (summaries) запрашивают
+модели пачками и заменяют резюме; при недоступности моделей задача
+повторяется с нарастающей паузой, после SUMMARY_MAX_RETRIES повторов
+запись остаётся с предварительным резюме (failed). Так задержка реестра
+относительно ящика зависит только от IMAP и БД.
+
+dedup_key записи не пересчитывается: он остаётся от предварительного
+резюме, которое однозначно определяется текстом, и повторное письмо
+с тем же текстом распознаётся как дубликат и после замены резюме.
+"""
+import asyncio
+import logging
+import random
+from datetime import timedelta
+import aiohttp
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from . import summarizers
+from .mail import chunked
+from .models import Incoming, SummaryRequest
+from .page_cache import bump_register_version
+from .search import index_many
+from .summary_cache import SummaryCache, cache_key
+
+logger = logging.getLogger(__name__)
+
+
+def models_configured():
+    """Есть ли в SUMMARIZER_BACKENDS модели, кроме extractive: иначе откладывать нечего."""
+    return any(name != 'extractive' for name in settings.SUMMARIZER_BACKENDS)
+
+
+def provisional_summary(body, subject):
+    """Резюме из самого письма, без сети: им запись создаётся сразу."""
+    return (summarizers.ExtractiveSummarizer().summarize_text(body) or body[:summarizers.MAX_LENGTH]
+            or subject[:summarizers.MAX_LENGTH])
+
+
+def dispatch(ids):
+    """Постановка записей в очередь summaries пачками по SUMMARIZER_BATCH_SIZE."""
+    from .tasks import summarize_incoming_task
+    ids = list(ids)
+    SummaryRequest.objects.filter(incoming_id__in=ids).update(requested_at=timezone.now())
+    for chunk in chunked(ids, max(1, settings.SUMMARIZER_BATCH_SIZE)):
+        summarize_incoming_task.delay(chunk)
+    return len(ids)
+
+
+def requeue_stale():
+    """Повторная постановка запросов, задачи которых потерялись (перезапуск брокера или воркера).
+
+    Запросы записей, резюме которых уже готово (например, исправлено вручную), удаляются.
+    """
+    SummaryRequest.objects.filter(incoming__summary_status=Incoming.SUMMARY_DONE).delete()
+    cutoff = timezone.now() - timedelta(seconds=settings.SUMMARY_REQUEUE_AFTER)
+    ids = list(SummaryRequest.objects.filter(
+        requested_at__lt=cutoff, incoming__summary_status=Incoming.SUMMARY_PENDING,
+    ).values_list('incoming_id', flat=True)[:1000])
+    return dispatch(ids) if ids else 0
+
+
+def retry_delay(retries):
+    """Пауза перед повтором задачи: удвоение от SUMMARY_RETRY_DELAY с разбросом, чтобы повторы не совпадали."""
+    delay = min(settings.SUMMARY_RETRY_MAX_DELAY, settings.SUMMARY_RETRY_DELAY * 2 ** retries)
+    return int(delay * random.uniform(0.8, 1.2))
+
+
+async def _summarize(chain, texts):
+    async with aiohttp.ClientSession() as session:
+        return await chain.summarize_many(texts, session, settings.EMAIL_SUMMARY_CONCURRENCY)
+
+
+def finish(request, summary):
+    """Замена предварительного резюме; запрос из очереди удаляется.
+
+    Резюме, исправленное сотрудником за это время (статус уже не pending), не трогается.
+    """
+    with transaction.atomic():
+        Incoming.objects.filter(pk=request.incoming_id, summary_status=Incoming.SUMMARY_PENDING).update(
+            summary=summary, summary_status=Incoming.SUMMARY_DONE, updated_at=timezone.now())
+        request.delete()
+
+
+def summarize_records(ids):
+    """Резюме моделей для записей ids; возвращает id, для которых модели не ответили."""
+    requests = list(SummaryRequest.objects.filter(
+        incoming_id__in=ids, incoming__summary_status=Incoming.SUMMARY_PENDING))
+    if not requests:
+        return []
+    summary_cache = SummaryCache()
+    keys = {request.incoming_id: cache_key(summarizers.build_prompt(request.text)) for request in requests}
+    cached = summary_cache.get_many(keys.values())
+    done, pending = [], []
+    for request in requests:
+        if keys[request.incoming_id] in cached:
+            finish(request, cached[keys[request.incoming_id]])
+            done.append(request.incoming_id)
+        else:
+            pending.append(request)
+
+    generated = {}
+    if pending:
+        chain = summarizers.build_chain(fallback=False)
+        results = asyncio.run(_summarize(chain, [request.text for request in pending]))
+        failed = []
+        for request, (summary, backend) in zip(pending, results):
+            if summary is None:
+                failed.append(request)
+                continue
+            finish(request, summary)
+            done.append(request.incoming_id)
+            if backend.cacheable:
+                generated[keys[request.incoming_id]] = summary
+        summary_cache.set_many(generated)
+        SummaryRequest.objects.filter(pk__in=[request.pk for request in failed]).update(
+            attempts=F('attempts') + 1, requested_at=timezone.now(), error='no summarizer returned a summary')
+        pending = failed
+
+    if done:
+        index_many(list(Incoming.objects.filter(pk__in=done)))
+        bump_register_version()
+        logger.info(f'Summarized {len(done)} records, {len(pending)} left for retry.')
+    return [request.incoming_id for request in pending]
+
+
+def give_up(ids):
+    """Повторы исчерпаны: запись остаётся с предварительным резюме, текст — для retry_failed."""
+    Incoming.objects.filter(pk__in=ids, summary_status=Incoming.SUMMARY_PENDING).update(
+        summary_status=Incoming.SUMMARY_FAILED, updated_at=timezone.now())
+    bump_register_version()
+    logger.warning(f'Gave up summarizing {len(ids)} records, provisional summaries are kept.')
+
+
+def retry_failed():
+    """Повторная постановка в очередь записей, оставшихся с предварительным резюме; возвращает их число."""
+    ids = list(SummaryRequest.objects.filter(
+        incoming__summary_status=Incoming.SUMMARY_FAILED).values_list('incoming_id', flat=True))
+    with transaction.atomic():
+        Incoming.objects.filter(pk__in=ids).update(summary_status=Incoming.SUMMARY_PENDING, updated_at=timezone.now())
+        SummaryRequest.objects.filter(incoming_id__in=ids).update(attempts=0, error='')
+        bump_register_version()
+    return dispatch(ids) if ids else 0
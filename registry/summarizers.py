@@ -0,0 +1,324 @@
+# registry/summarizers.py
+"""Краткое содержание писем: сменные модели, пакетные запросы и автомат отключения.
+
+Модели перечислены в SUMMARIZER_BACKENDS и опрашиваются по порядку: письма,
+для которых модель не вернула резюме, передаются следующей. Последней
+всегда стоит extractive — выбор предложений из самого письма без сети.
+Если модель ошиблась SUMMARIZER_BREAKER_FAILURES раз подряд, автомат
+(CircuitBreaker) не обращается к ней SUMMARIZER_BREAKER_RESET секунд,
+и при недоступном сервисе письмо реферируется за миллисекунды, а не
+ждёт таймаута. Модели, понимающие несколько писем в одном запросе
+(batch_size > 1), получают пачку писем одним запросом.
+"""
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+MAX_LENGTH = 200  # Символов в резюме
+MAX_TEXT = 10000  # Символов письма в запросе к модели
+BATCH_ITEM_TEXT = 4000  # Символов письма в пакетном запросе
+BATCH_LINE_RE = re.compile(r'^\s*(?:Письмо\s*)?(\d+)\s*[:.)]\s*(.+?)\s*$', re.M)
+
+
+class SummarizerError(Exception):
+    """Модель недоступна или вернула непригодный ответ."""
+
+
+def build_prompt(text):
+    """Запрос к модели по одному письму; он же ключ кэша резюме."""
+    return f"Перескажи краткое содержание этого письма на русском языке в пределах 200 символов:\n\n{text[:MAX_TEXT]}"
+
+
+def build_batch_prompt(texts):
+    letters = '\n\n'.join(f'Письмо {number}:\n{text[:BATCH_ITEM_TEXT]}' for number, text in enumerate(texts, 1))
+    return (
+        f'Перескажи краткое содержание каждого из {len(texts)} писем ниже на русском языке, '
+        'не больше 200 символов на письмо. Ответь строками вида «1: резюме», по одной на письмо, '
+        f'в том же порядке и без другого текста.\n\n{letters}'
+    )
+
+
+def parse_batch_response(response, count):
+    """Резюме из ответа на пакетный запрос; для писем без строки в ответе — None."""
+    summaries = [None] * count
+    for number, summary in BATCH_LINE_RE.findall(response or ''):
+        index = int(number) - 1
+        if 0 <= index < count and summaries[index] is None:
+            summaries[index] = summary
+    return summaries
+
+
+class CircuitBreaker:
+    """Автомат отключения модели: после failures ошибок подряд она пропускается
+    reset_after секунд, затем допускается одна пробная попытка."""
+
+    def __init__(self, failures=None, reset_after=None):
+        self.failures = failures or settings.SUMMARIZER_BREAKER_FAILURES
+        self.reset_after = reset_after if reset_after is not None else settings.SUMMARIZER_BREAKER_RESET
+        self.lock = threading.Lock()
+        self.errors = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.errors = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.errors += 1
+            self.probing = False
+            if self.opened_at is not None or self.errors >= self.failures:
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+breakers = {}  # модель -> CircuitBreaker, общий для запусков в одном процессе
+breakers_lock = threading.Lock()
+
+
+def breaker(name):
+    with breakers_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker()
+        return breakers[name]
+
+
+class Summarizer:
+    """Модель реферирования. Подклассы реализуют summarize; batch_size > 1 —
+    модель принимает несколько писем в одном запросе (summarize_batch)."""
+    name = None
+    batch_size = 1
+    cacheable = True  # Резюме сохраняются в CachedSummary
+    uses_breaker = True
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or settings.SUMMARIZER_TIMEOUT
+
+    async def summarize(self, text, session):
+        raise NotImplementedError
+
+    async def summarize_batch(self, texts, session):
+        if len(texts) == 1:
+            return [await self.summarize(texts[0], session)]
+        raise NotImplementedError
+
+
+class ChatSummarizer(Summarizer):
+    """Модель с интерфейсом чата: одно письмо или пачка писем в одном сообщении."""
+
+    def __init__(self, timeout=None, batch_size=None):
+        super().__init__(timeout)
+        self.batch_size = max(1, batch_size or settings.SUMMARIZER_BATCH_SIZE)
+
+    async def complete(self, prompt, session):
+        raise NotImplementedError
+
+    async def ask(self, prompt, session):
+        try:
+            response = await asyncio.wait_for(self.complete(prompt, session), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise SummarizerError(f'{self.name} timed out after {self.timeout}s')
+        except SummarizerError:
+            raise
+        except Exception as e:
+            raise SummarizerError(f'{self.name} failed: {e}')
+        if not response or not response.strip():
+            raise SummarizerError(f'{self.name} returned an empty response')
+        return response.strip()
+
+    async def summarize(self, text, session):
+        return await self.ask(build_prompt(text), session)
+
+    async def summarize_batch(self, texts, session):
+        if len(texts) == 1:
+            return [await self.summarize(texts[0], session)]
+        summaries = parse_batch_response(await self.ask(build_batch_prompt(texts), session), len(texts))
+        if not any(summaries):
+            raise SummarizerError(f'{self.name} returned an unparseable batch response')
+        return summaries
+
+
+class G4FSummarizer(ChatSummarizer):
+    """Модель через g4f (gpt-4o-mini по умолчанию)."""
+    name = 'g4f'
+
+    def __init__(self, model=None, **kwargs):
+        super().__init__(**kwargs)
+        self.model = model or settings.SUMMARIZER_G4F_MODEL
+
+    async def complete(self, prompt, session):
+        try:
+            import g4f
+        except ImportError:
+            raise SummarizerError('g4f is not installed')
+        response = await g4f.ChatCompletion.create_async(
+            model=self.model,
+            messages=[{'role': 'user', 'content': prompt}],
+            max_tokens=200 * self.batch_size,
+            session=session,
+        )
+        if isinstance(response, str):
+            return response
+        if getattr(response, 'choices', None):
+            return response.choices[0].message.content
+        raise SummarizerError('invalid response format from g4f')
+
+
+class OpenAICompatibleSummarizer(ChatSummarizer):
+    """Локальный или внешний сервер с API OpenAI (/v1/chat/completions): vLLM, llama.cpp, Ollama."""
+    name = 'openai'
+
+    def __init__(self, url=None, model=None, api_key=None, **kwargs):
+        super().__init__(**kwargs)
+        self.url = (url or settings.SUMMARIZER_OPENAI_URL).rstrip('/')
+        self.model = model or settings.SUMMARIZER_OPENAI_MODEL
+        self.api_key = api_key if api_key is not None else settings.SUMMARIZER_OPENAI_API_KEY
+        if not self.url:
+            raise ImproperlyConfigured('SUMMARIZER_OPENAI_URL is required for the openai summarizer')
+
+    async def complete(self, prompt, session):
+        headers = {'Authorization': f'Bearer {self.api_key}'} if self.api_key else {}
+        payload = {
+            'model': self.model,
+            'messages': [{'role': 'user', 'content': prompt}],
+            'max_tokens': 200 * self.batch_size,
+            'temperature': 0.2,
+        }
+        async with session.post(f'{self.url}/chat/completions', json=payload, headers=headers) as response:
+            if response.status != 200:
+                raise SummarizerError(f'{self.url} returned HTTP {response.status}')
+            data = await response.json(content_type=None)
+        try:
+            return data['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError):
+            raise SummarizerError(f'unexpected response from {self.url}')
+
+
+WORD_RE = re.compile(r'[а-яёa-z0-9]+', re.I)
+SENTENCE_RE = re.compile(r'(?<=[.!?…])\s+|\n{2,}')
+QUOTE_RE = re.compile(r'^\s*>.*$', re.M)
+
+
+class ExtractiveSummarizer(Summarizer):
+    """Резюме без сети: предложения письма с самыми частыми в нём словами,
+    в исходном порядке, в пределах MAX_LENGTH символов."""
+    name = 'extractive'
+    batch_size = 100
+    cacheable = False  # Резюме модели, полученное позже, должно заменить это
+    uses_breaker = False
+
+    def summarize_text(self, text):
+        text = QUOTE_RE.sub('', text or '')
+        sentences = [' '.join(sentence.split()) for sentence in SENTENCE_RE.split(text)]
+        sentences = [sentence for sentence in sentences if len(sentence) > 1]
+        if not sentences:
+            return None
+        words = Counter(word.lower() for word in WORD_RE.findall(text) if len(word) > 3)
+        scores = [
+            (sum(words[word.lower()] for word in WORD_RE.findall(sentence)) / (len(WORD_RE.findall(sentence)) or 1), index)
+            for index, sentence in enumerate(sentences)
+        ]
+        chosen, length = [], 0
+        for _, index in sorted(scores, key=lambda score: (-score[0], score[1])):
+            if length + len(sentences[index]) + 1 > MAX_LENGTH and chosen:
+                continue
+            chosen.append(index)
+            length += len(sentences[index]) + 1
+        return ' '.join(sentences[index] for index in sorted(chosen))[:MAX_LENGTH]
+
+    async def summarize(self, text, session):
+        return self.summarize_text(text)
+
+    async def summarize_batch(self, texts, session):
+        return [self.summarize_text(text) for text in texts]
+
+
+BACKENDS = {
+    'g4f': G4FSummarizer,
+    'openai': OpenAICompatibleSummarizer,
+    'extractive': ExtractiveSummarizer,
+}
+
+
+class SummarizerChain:
+    """Модели по порядку с отключением отказавших; extractive — всегда последняя,
+    если не задано fallback=False (только резюме моделей)."""
+
+    def __init__(self, backends, fallback=True):
+        self.backends = list(backends)
+        if not fallback:
+            self.backends = [backend for backend in self.backends if not isinstance(backend, ExtractiveSummarizer)]
+        elif not any(isinstance(backend, ExtractiveSummarizer) for backend in self.backends):
+            self.backends.append(ExtractiveSummarizer())
+
+    async def run_batch(self, backend, texts, session):
+        state = breaker(backend.name)
+        if backend.uses_breaker and not state.allow():
+            return [None] * len(texts)
+        try:
+            summaries = await backend.summarize_batch(texts, session)
+        except Exception as e:
+            if backend.uses_breaker and state.failure():
+                logger.warning(f'Summarizer {backend.name} is switched off for {state.reset_after}s: {e}')
+            else:
+                logger.warning(f'Summarizer {backend.name} failed: {e}')
+            return [None] * len(texts)
+        if backend.uses_breaker:
+            state.success()
+        return summaries
+
+    async def summarize_many(self, texts, session, concurrency=1):
+        """Резюме для каждого текста: список пар (резюме или None, модель или None)."""
+        results = [(None, None)] * len(texts)
+        pending = [index for index, text in enumerate(texts) if text]
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        for backend in self.backends:
+            if not pending:
+                break
+
+            async def run(indexes, backend=backend):
+                async with semaphore:
+                    return indexes, await self.run_batch(backend, [texts[index] for index in indexes], session)
+
+            size = max(1, backend.batch_size)
+            batches = [pending[start:start + size] for start in range(0, len(pending), size)]
+            for indexes, summaries in await asyncio.gather(*(run(indexes) for indexes in batches)):
+                for index, summary in zip(indexes, summaries):
+                    if summary and summary.strip():
+                        results[index] = (summary.strip()[:MAX_LENGTH], backend)
+            pending = [index for index in pending if results[index][0] is None]
+        return results
+
+
+def build_chain(names=None, fallback=True):
+    """Цепочка моделей из SUMMARIZER_BACKENDS (или names)."""
+    backends = []
+    for name in names or settings.SUMMARIZER_BACKENDS:
+        if name not in BACKENDS:
+            raise ImproperlyConfigured(f'Unknown summarizer {name!r}, expected one of: {", ".join(BACKENDS)}')
+        backends.append(BACKENDS[name]())
+    return SummarizerChain(backends, fallback)
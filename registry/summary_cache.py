@@ -0,0 +1,67 @@
+# registry/summary_cache.py
+import hashlib
+import re
+import unicodedata
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from .models import CachedSummary
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """Нормализация текста перед хэшированием: NFKC и схлопывание пробелов."""
+    return WHITESPACE_RE.sub(' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+def cache_key(prompt):
+    """SHA-256 нормализованного текста запроса."""
+    return hashlib.sha256(normalize_text(prompt).encode('utf-8')).hexdigest()
+
+
+class SummaryCache:
+    """Персистентный LRU-кэш кратких содержаний с ограничением по числу записей.
+
+    Счётчики hits/misses относятся к текущему экземпляру (одному запуску
+    импорта), поле CachedSummary.hits накапливает попадания за всё время.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries if max_entries is not None else settings.SUMMARY_CACHE_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        """Поиск резюме по набору ключей одним запросом, возвращает {key: summary}."""
+        keys = set(keys)
+        if not keys:
+            return {}
+        found = dict(CachedSummary.objects.filter(key__in=keys).values_list('key', 'summary'))
+        if found:
+            CachedSummary.objects.filter(key__in=found).update(
+                hits=F('hits') + 1, last_used_at=timezone.now()
+            )
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, summaries):
+        """Сохранение новых резюме {key: summary} с последующим вытеснением старых."""
+        if not summaries:
+            return
+        CachedSummary.objects.bulk_create(
+            [CachedSummary(key=key, summary=summary) for key, summary in summaries.items()],
+            ignore_conflicts=True,
+        )
+        self.evict()
+
+    def evict(self):
+        """Удаление давно не использованных записей сверх max_entries."""
+        stale = (
+            CachedSummary.objects.order_by('-last_used_at', '-pk')
+            .values_list('pk', flat=True)[self.max_entries:]
+        )
+        stale_ids = list(stale)
+        if stale_ids:
+            CachedSummary.objects.filter(pk__in=stale_ids).delete()
@@ -1,7 +1,87 @@
 # registry/tasks.py
 from celery import shared_task
+from datetime import timedelta
+from django.conf import settings
 from django.core.management import call_command
+from django.utils import timezone
+from .ingestion import claimable_batches
+from .models import Attachment, DeadlineSummary, DeletedIncoming, IngestionRun
+from . import archive, extraction, summaries
+from .uploads import cleanup_stale_uploads
 
 @shared_task
 def process_emails_task():
-    call_command('process_emails')
\ No newline at end of file
+    """Просмотр ящика и раздача найденных пачек писем свободным воркерам."""
+    try:
+        call_command('process_emails', max_batches=0)
+    finally:
+        # Пачки, брошенные упавшими воркерами, раздаются снова вместе с новыми
+        for _ in range(claimable_batches().count()):
+            process_email_batch_task.delay()
+
+@shared_task
+def process_email_batch_task():
+    call_command('process_emails', scan=False, max_batches=1)
+
+@shared_task(bind=True, rate_limit=settings.SUMMARY_RATE_LIMIT, max_retries=settings.SUMMARY_MAX_RETRIES, acks_late=True)
+def summarize_incoming_task(self, ids):
+    """Резюме моделей для записей ids вместо предварительных; при недоступных моделях — повтор с паузой."""
+    remaining = summaries.summarize_records(ids)
+    if not remaining:
+        return len(ids)
+    if self.request.retries >= self.max_retries:
+        summaries.give_up(remaining)
+        return len(ids) - len(remaining)
+    raise self.retry(args=[remaining], countdown=summaries.retry_delay(self.request.retries))
+
+@shared_task
+def requeue_summaries_task():
+    """Повторная постановка запросов на реферирование, задачи которых потерялись."""
+    return summaries.requeue_stale()
+
+@shared_task
+def rebuild_deadline_summary_task():
+    """Ночной пересчёт сводки по срокам: корзины сдвигаются со сменой дня."""
+    DeadlineSummary.objects.rebuild()
+
+@shared_task
+def cleanup_uploads_task():
+    """Удаление загрузок, не завершённых за UPLOAD_SESSION_TTL_HOURS."""
+    return cleanup_stale_uploads(timezone.now() - timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS))
+
+
+@shared_task
+def collect_attachment_garbage_task():
+    """Удаление blob вложений, на которые не осталось ссылок; возвращает их число."""
+    storage = Attachment._meta.get_field('file').storage
+    collected = 0
+    for name in storage.unreferenced_blobs():
+        storage.delete(name)
+        collected += 1
+    return collected
+
+
+@shared_task
+def extract_attachments_task():
+    """Извлечение текста и превью новых вложений; возвращает число разобранных файлов."""
+    return extraction.run()
+
+
+@shared_task
+def prune_ingestion_runs_task():
+    """Удаление итогов запусков импорта старше INGESTION_RUN_RETENTION_DAYS; возвращает их число."""
+    cutoff = timezone.now() - timedelta(days=settings.INGESTION_RUN_RETENTION_DAYS)
+    return IngestionRun.objects.filter(started_at__lt=cutoff).delete()[0]
+
+
+@shared_task
+def prune_tombstones_task():
+    """Удаление отметок об удалении старше API_TOMBSTONE_RETENTION_DAYS; возвращает их число."""
+    cutoff = timezone.now() - timedelta(days=settings.API_TOMBSTONE_RETENTION_DAYS)
+    return DeletedIncoming.objects.filter(deleted_at__lt=cutoff).delete()[0]
+
+
+@shared_task
+def archive_register_task():
+    """Перенос закрытой переписки старше ARCHIVE_AFTER_DAYS в архив."""
+    return archive.archive_records()
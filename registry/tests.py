@@ -1,3 +1,1509 @@
-from django.test import TestCase
+# registry/tests.py
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import quopri
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from email.message import EmailMessage
+from unittest import mock, skipUnless
+from datetime import date, timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import LiveServerTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from . import archive, benchmarks, extraction, imap, ingestion, loadtest, metrics, summaries, summarizers
+from .imap_standin import IMAPStandIn
+from .filters import filter_incoming, get_filters
+from .forms import IncomingForm
+from .mail import (
+    IMAPPartFile, IncomingEmail, TransferDecoder, chunked, fetch_messages, fetch_text_parts, parse_fetch_response,
+    walk_bodystructure,
+)
+from .management.commands.process_emails import Command as ProcessEmailsCommand
+from .models import (
+    ArchivedAttachment, ArchivedIncoming, ArchivePack, CachedSummary, Incoming, Attachment, AttachmentContent,
+    DeadlineSummary, IngestionRun, MailboxBatch, MailboxSyncState,
+    NumberCounter, SummaryRequest, UploadSession,
+)
+from . import uploads
+from .page_cache import get_cache
+from .summary_cache import SummaryCache, cache_key
+from .search import search
 
-# Create your tests here.
+# Запросов на страницу реестра: сессия, пользователь и сама страница;
+# COUNT для итога выполняется только при промахе кэша.
+LIST_QUERY_BUDGET = 3
+# Страница из кэша: только сессия и пользователь
+CACHED_PAGE_QUERIES = 2
+
+
+def create_incoming(count, attachments_every=0, start=date(2025, 1, 1)):
+    records = []
+    for index in range(count):
+        incoming = Incoming.objects.create(
+            incoming_date=start + timedelta(days=index),
+            applicant=f'Заявитель {index}',
+            summary=f'Содержание письма {index}',
+            responsible='Иванов',
+            response_deadline=start + timedelta(days=index + 10),
+        )
+        if attachments_every and index % attachments_every == 0:
+            for number in range(2):
+                Attachment.objects.create(incoming=incoming, file=f'attachments/{index}-{number}.pdf',
+                                          filename=f'{index}-{number}.pdf')
+        records.append(incoming)
+    return records
+
+
+class IncomingListQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('clerk', password='secret')
+        create_incoming(25, attachments_every=3)
+
+    def setUp(self):
+        get_cache().clear()
+        self.client.force_login(self.user)
+
+    def test_page_query_count_does_not_depend_on_rows(self):
+        with self.assertNumQueries(LIST_QUERY_BUDGET + 1):
+            response = self.client.get(reverse('incoming_list'))
+        self.assertEqual(len(response.context['page_obj']), 10)
+        with self.assertNumQueries(LIST_QUERY_BUDGET):
+            self.client.get(reverse('incoming_list'), {'after': 26})
+
+    def test_attachment_filter_query_count(self):
+        for value in ('yes', 'no'):
+            with self.subTest(attachment_filter=value), self.assertNumQueries(LIST_QUERY_BUDGET + 1):
+                self.client.get(reverse('incoming_list'), {'attachment_filter': value})
+
+    def test_deep_pages_cost_the_same_as_the_first(self):
+        response = self.client.get(reverse('incoming_list'))
+        seen = [row.incoming_number for row in response.context['page_obj']]
+        while response.context['page_obj'].has_next():
+            with self.assertNumQueries(LIST_QUERY_BUDGET):
+                response = self.client.get(reverse('incoming_list'), {'after': seen[-1]})
+            seen += [row.incoming_number for row in response.context['page_obj']]
+        self.assertEqual(seen, sorted(Incoming.objects.values_list('incoming_number', flat=True), reverse=True))
+        response = self.client.get(reverse('incoming_list'), {'before': seen[-5]})
+        self.assertEqual([row.incoming_number for row in response.context['page_obj']], seen[-15:-5])
+
+    def test_attachment_counts_are_annotated(self):
+        response = self.client.get(reverse('incoming_list'))
+        counts = {row.applicant: row.attachment_count for row in response.context['page_obj']}
+        self.assertEqual(counts['Заявитель 24'], 2)
+        self.assertEqual(counts['Заявитель 23'], 0)
+
+    def test_attachment_filter_without_duplicates(self):
+        with_files = self.client.get(reverse('incoming_list'), {'attachment_filter': 'yes'})
+        without_files = self.client.get(reverse('incoming_list'), {'attachment_filter': 'no'})
+        self.assertEqual(with_files.context['total'], 9)
+        self.assertEqual(without_files.context['total'], 16)
+
+
+class NumberCounterTests(TestCase):
+    def test_blocks_are_contiguous_and_do_not_overlap(self):
+        create_incoming(3)
+        first, second = NumberCounter.objects.allocate(4), NumberCounter.objects.allocate(2)
+        self.assertEqual((list(first), list(second)), ([4, 5, 6, 7], [8, 9]))
+        # Счётчика ещё нет (первый запуск): он продолжает уже выданные номера
+        NumberCounter.objects.all().delete()
+        self.assertEqual(list(NumberCounter.objects.allocate(2)), [4, 5])
+
+    def test_number_entered_by_hand_is_reserved(self):
+        create_incoming(2)
+        manual = create_incoming(1)[0]
+        manual.incoming_number = 50
+        manual.save()
+        self.assertEqual(create_incoming(1)[0].incoming_number, 51)
+        Incoming.objects.create(incoming_number=20, applicant='Заявитель', summary='Текст', responsible='Иванов',
+                                response_deadline=date(2025, 2, 1))
+        self.assertEqual(NumberCounter.objects.peek(), 52)
+
+    def test_editing_does_not_update_the_counter(self):
+        incoming = Incoming.objects.get(pk=create_incoming(1)[0].pk)
+        with mock.patch.object(NumberCounter.objects, 'reserve') as reserve:
+            incoming.summary = 'Исправленное содержание'
+            incoming.save()
+            reserve.assert_not_called()
+            incoming.incoming_number = 40
+            incoming.save()
+            reserve.assert_called_once_with(40)
+
+
+class IncomingSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.city = Incoming.objects.create(
+            applicant='Администрация города', summary='Просим предоставить документы о строительстве дороги',
+            responsible='Иванова', response_deadline=date(2025, 1, 10),
+        )
+        cls.company = Incoming.objects.create(
+            applicant='ООО Ромашка', summary='Документы, документами и документ о дорожном строительстве',
+            responsible='Петров', response_deadline=date(2025, 1, 10),
+        )
+
+    def search(self, **params):
+        return [row.applicant for row in filter_incoming(get_filters(params))]
+
+    def test_matches_word_forms_and_ranks_by_relevance(self):
+        self.assertEqual(self.search(search='документ'), ['ООО Ромашка', 'Администрация города'])
+
+    def test_column_filters_use_only_their_column(self):
+        self.assertEqual(self.search(q='админ'), ['Администрация города'])
+        self.assertEqual(self.search(summary_filter='Ромашка'), [])
+        self.assertEqual(self.search(responsible_filter='Иванов'), ['Администрация города'])
+
+    def test_index_follows_attachments_and_deletes(self):
+        Attachment.objects.create(incoming=self.city, file='attachments/contract.pdf', filename='Договор поставки.pdf')
+        self.assertEqual(self.search(search='договора'), ['Администрация города'])
+        self.company.delete()
+        self.assertEqual(self.search(search='документ'), ['Администрация города'])
+
+
+# Полный проход по таблице без индекса: «SCAN registry_incoming» без «USING ...»
+FULL_SCAN_RE = re.compile(r'\bSCAN registry_incoming\b(?! USING)')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'планы запросов проверяются на SQLite')
+class IncomingQueryPlanTests(TestCase):
+    """Регрессия планов: ни одна комбинация фильтров реестра не читает таблицу целиком."""
+    FILTER_CASES = {
+        'без фильтров': {},
+        'даты поступления': {'date_from': '2025-02-01', 'date_to': '2025-03-01'},
+        'сроки ответа': {'deadline_from': '2025-02-01', 'deadline_to': '2025-03-01'},
+        'дата и срок': {'date_from': '2025-02-01', 'deadline_to': '2025-03-01'},
+        'номер': {'number_filter': '42'},
+        'есть вложения': {'attachment_filter': 'yes'},
+        'нет вложений': {'attachment_filter': 'no'},
+        'заявитель': {'q': 'заявитель'},
+        'содержание': {'summary_filter': 'письма'},
+        'ответственный': {'responsible_filter': 'иванов'},
+        'общий поиск': {'search': 'письмо'},
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        create_incoming(60, attachments_every=4)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertUsesIndexes(self, queryset):
+        plan = queryset.explain()
+        self.assertIsNone(FULL_SCAN_RE.search(plan), plan)
+        return plan
+
+    def test_register_filters(self):
+        for name, params in self.FILTER_CASES.items():
+            with self.subTest(name):
+                self.assertUsesIndexes(filter_incoming(get_filters(params))[:11])
+
+    def test_unfiltered_page_is_read_in_index_order(self):
+        queryset = filter_incoming(get_filters({}))
+        for page in (queryset[:11], queryset.filter(incoming_number__lt=30)[:11]):
+            self.assertNotIn('TEMP B-TREE', self.assertUsesIndexes(page))
+
+    def test_default_ordering_by_date(self):
+        plan = self.assertUsesIndexes(Incoming.objects.filter(incoming_date__gte=date(2025, 2, 1))[:10])
+        self.assertIn('incoming_date_number_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_deadline_by_responsible(self):
+        plan = self.assertUsesIndexes(Incoming.objects.filter(
+            responsible='Иванов', response_deadline__lte=date(2025, 2, 1)).order_by('response_deadline'))
+        self.assertIn('incoming_responsible_idx', plan)
+
+    def test_duplicate_lookup(self):
+        key = Incoming.make_dedup_key('Заявитель 1', date(2025, 1, 2), 'Содержание письма 1')
+        self.assertTrue(Incoming.objects.filter(dedup_key=key).exists())
+        self.assertUsesIndexes(Incoming.objects.filter(dedup_key__in=[key]))
+
+
+class RegisterImportExportTests(TestCase):
+    HEADER = 'incoming_number,incoming_date,applicant,summary,responsible,response_deadline\n'
+    CSV = HEADER + (
+        ',01.03.2024,Администрация города,О ремонте дорог,Иванов,\n'
+        '7,2024-03-02,ООО Ромашка,Запрос документов,Петров,2024-03-20\n'
+        ',2024-03-03,Жилец,Жалоба на шум,Иванов,2024-03-13\n'
+    )
+
+    def import_csv(self, content, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', encoding='utf-8', delete=False) as source:
+            source.write(content)
+        self.addCleanup(os.remove, source.name)
+        call_command('import_register', source.name, *args, stdout=io.StringIO())
+
+    def test_import_numbers_rows_after_explicit_numbers(self):
+        create_incoming(2)
+        self.import_csv(self.CSV, '--batch-size', '1')
+        numbers = dict(Incoming.objects.values_list('applicant', 'incoming_number'))
+        self.assertEqual(numbers['ООО Ромашка'], 7)
+        self.assertEqual({numbers['Администрация города'], numbers['Жилец']}, {8, 9})
+        self.assertEqual(NumberCounter.objects.peek(), 10)
+        city = Incoming.objects.get(incoming_number=8)
+        self.assertEqual(city.response_deadline, date(2024, 3, 11))
+        self.assertEqual(city.dedup_key, Incoming.make_dedup_key(city.applicant, city.incoming_date, city.summary))
+        self.assertEqual([row.applicant for row in filter_incoming(get_filters({'search': 'дорога'}))],
+                         ['Администрация города'])
+
+    def test_existing_numbers_fail_unless_skipped(self):
+        self.import_csv(self.CSV)
+        with self.assertRaises(CommandError):
+            self.import_csv(self.CSV)
+        self.import_csv(self.HEADER + '7,2024-03-02,ООО Ромашка,Другой запрос,Петров,\n', '--skip-existing')
+        self.assertEqual(Incoming.objects.count(), 3)
+
+    def test_archived_numbers_count_as_existing(self):
+        ArchivedIncoming.objects.create(id=100, incoming_number=7, incoming_date=date(2020, 1, 1), applicant='Архив',
+                                        summary='Закрытое письмо', responsible='Иванов',
+                                        response_deadline=date(2020, 1, 11))
+        with self.assertRaises(CommandError):
+            self.import_csv(self.CSV)
+        self.import_csv(self.CSV, '--skip-existing')
+        self.assertFalse(Incoming.objects.filter(incoming_number=7).exists())
+        self.assertEqual(Incoming.objects.count(), 2)
+
+    def test_export_view_streams_filtered_csv(self):
+        self.import_csv(self.CSV)
+        user = User.objects.create_user('clerk', password='secret')
+        self.client.force_login(user)
+        response = self.client.get(reverse('incoming_export'), {'responsible_filter': 'Иванов'})
+        lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0], 'incoming_number,incoming_date,applicant,summary,responsible,response_deadline,attachment_count')
+        self.assertEqual([line.split(',')[2] for line in lines[1:]], ['Жилец', 'Администрация города'])
+
+
+class DeadlineSummaryTests(TestCase):
+    def setUp(self):
+        self.today = timezone.localdate()
+        for responsible, days in (('Иванов', -3), ('Иванов', 0), ('Петров', 2), ('Петров', 30)):
+            Incoming.objects.create(applicant='Заявитель', summary='Письмо', responsible=responsible,
+                                    response_deadline=self.today + timedelta(days=days))
+
+    def summary(self):
+        return {(row.responsible, row.bucket): row.count
+                for row in DeadlineSummary.objects.current(self.today) if row.count}
+
+    def assertMatchesRebuild(self):
+        incremental = self.summary()
+        DeadlineSummary.objects.rebuild(self.today)
+        self.assertEqual(incremental, self.summary())
+        return incremental
+
+    def test_signals_keep_summary_in_step_with_register(self):
+        self.assertEqual(self.summary(), {
+            ('Иванов', 'overdue'): 1, ('Иванов', 'today'): 1, ('Петров', 'week'): 1, ('Петров', 'later'): 1,
+        })
+        incoming = Incoming.objects.get(responsible='Иванов', response_deadline=self.today)
+        incoming.responsible = 'Петров'
+        incoming.response_deadline = self.today + timedelta(days=1)
+        incoming.save()
+        Incoming.objects.get(responsible='Петров', response_deadline=self.today + timedelta(days=30)).delete()
+        self.assertEqual(self.assertMatchesRebuild(), {('Иванов', 'overdue'): 1, ('Петров', 'week'): 2})
+
+    def test_stale_summary_is_rebuilt_for_the_new_day(self):
+        self.summary()
+        tomorrow = self.today + timedelta(days=1)
+        rows = DeadlineSummary.objects.current(tomorrow)
+        self.assertEqual({(row.responsible, row.bucket): row.count for row in rows}, {
+            ('Иванов', 'overdue'): 2, ('Петров', 'week'): 1, ('Петров', 'later'): 1,
+        })
+
+    def test_dashboard_reads_only_the_summary(self):
+        user = User.objects.create_user('clerk', password='secret')
+        self.client.force_login(user)
+        self.summary()
+        create_incoming(20, start=self.today - timedelta(days=10))
+        # Сессия, пользователь, проверка свежести сводки и её строки
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('deadline_dashboard'))
+        rows = {row['responsible']: [cell['count'] for cell in row['cells']] for row in response.context['rows']}
+        self.assertEqual(rows['Иванов'], [1, 2, 7, 12])
+
+
+@override_settings(API_TOKEN='sync-token', API_CHANGES_LAG=0)
+class ApiTests(TestCase):
+    AUTH = {'Authorization': 'Bearer sync-token'}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.records = create_incoming(5, attachments_every=2)
+
+    def setUp(self):
+        get_cache().clear()
+
+    def get(self, name, *args, headers=None, **params):
+        return self.client.get(reverse(name, args=args), params, headers={**self.AUTH, **(headers or {})})
+
+    def test_requires_token_or_login(self):
+        response = self.client.get(reverse('api_incoming_list'))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+        self.client.force_login(User.objects.create_user('clerk', password='secret'))
+        self.assertEqual(self.client.get(reverse('api_incoming_list')).status_code, 200)
+        self.assertEqual(self.client.post(reverse('api_incoming_list'), headers=self.AUTH).status_code, 405)
+
+    def test_list_pages_and_fields(self):
+        response = self.get('api_incoming_list', fields='incoming_number,attachments', limit=2)
+        data = response.json()
+        numbers = [incoming.incoming_number for incoming in sorted(self.records, key=lambda r: -r.incoming_number)]
+        self.assertEqual([item['incoming_number'] for item in data['results']], numbers[:2])
+        self.assertEqual(set(data['results'][0]), {'id', 'incoming_number', 'attachments'})
+        self.assertEqual(data['count'], 5)
+        rest = self.client.get(data['next'], headers=self.AUTH).json()
+        self.assertEqual([item['incoming_number'] for item in rest['results']], numbers[2:4])
+        attachment = next(item for item in data['results'] + rest['results'] if item['attachments'])['attachments'][0]
+        self.assertTrue(attachment['url'].startswith('http://testserver/attachments/'))
+        self.assertEqual(self.get('api_incoming_list', fields='password').status_code, 400)
+        self.assertEqual(self.get('api_incoming_list', date_from='вчера').status_code, 400)
+        filtered = self.get('api_incoming_list', q='Заявитель 3', attachment_filter='no').json()
+        self.assertEqual([item['applicant'] for item in filtered['results']], ['Заявитель 3'])
+
+    def test_conditional_requests(self):
+        response = self.get('api_incoming_list')
+        with self.assertNumQueries(0):
+            cached = self.get('api_incoming_list', headers={'If-None-Match': response['ETag']})
+        self.assertEqual(cached.status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            Incoming.objects.filter(pk=self.records[0].pk).delete()
+        self.assertEqual(self.get('api_incoming_list', headers={'If-None-Match': response['ETag']}).status_code, 200)
+
+        incoming = self.records[1]
+        detail = self.get('api_incoming_detail', incoming.pk)
+        self.assertEqual(detail.json()['applicant'], incoming.applicant)
+        self.assertIn('Last-Modified', detail)
+        self.assertEqual(self.get('api_incoming_detail', incoming.pk,
+                                  headers={'If-None-Match': detail['ETag']}).status_code, 304)
+        incoming.summary = 'Исправленное содержание'
+        incoming.save()
+        self.assertEqual(self.get('api_incoming_detail', incoming.pk,
+                                  headers={'If-None-Match': detail['ETag']}).status_code, 200)
+        self.assertEqual(self.get('api_incoming_detail', 999999).status_code, 404)
+
+    def test_changes_feed(self):
+        first = self.get('api_changes', fields='incoming_number', limit=3).json()
+        self.assertEqual(len(first['changed']), 3)
+        self.assertTrue(first['has_more'])
+        second = self.get('api_changes', fields='incoming_number', cursor=first['cursor']).json()
+        self.assertEqual(len(second['changed']), 2)
+        self.assertFalse(second['has_more'])
+        self.assertEqual({item['id'] for item in first['changed'] + second['changed']},
+                         {incoming.pk for incoming in self.records})
+
+        empty = self.get('api_changes', cursor=second['cursor']).json()
+        self.assertEqual((empty['changed'], empty['deleted']), ([], []))
+        edited, removed = self.records[0], self.records[1]
+        edited.summary = 'Исправленное содержание'
+        edited.save()
+        Attachment.objects.create(incoming=self.records[2], file='attachments/new.pdf', filename='new.pdf')
+        removed_pk = removed.pk
+        removed.delete()
+        delta = self.get('api_changes', cursor=empty['cursor']).json()
+        self.assertEqual([item['id'] for item in delta['changed']], [edited.pk, self.records[2].pk])
+        self.assertEqual([(item['id'], item['reason']) for item in delta['deleted']], [(removed_pk, 'deleted')])
+        self.assertEqual(self.get('api_changes', cursor='not-a-cursor').status_code, 400)
+        self.assertEqual(self.get('api_changes', since='2000-01-01T00:00:00Z').status_code, 410)
+
+    def test_quiet_register_cursor_outlives_retention(self):
+        page = self.get('api_changes').json()
+        while page['has_more']:
+            page = self.get('api_changes', cursor=page['cursor']).json()
+        # Клиент синхронизируется регулярно, удалений нет: позиция отметок идёт вместе с курсором
+        start, retention = timezone.now(), settings.API_TOMBSTONE_RETENTION_DAYS
+        for days in (retention // 2, retention + 1):
+            with mock.patch('registry.api.timezone.now', return_value=start + timedelta(days=days)):
+                response = self.get('api_changes', cursor=page['cursor'])
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertEqual((page['changed'], page['deleted']), ([], []))
+
+
+class RegisterPageCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.clerk = User.objects.create_user('clerk', password='secret')
+        cls.other = User.objects.create_user('other', password='secret')
+        cls.records = create_incoming(3)
+
+    def setUp(self):
+        get_cache().clear()
+        self.client.force_login(self.clerk)
+
+    def get(self, **params):
+        return self.client.get(reverse('incoming_list'), params)
+
+    def test_repeated_view_is_served_from_cache(self):
+        first = self.get(q=' Заявитель ')
+        with self.assertNumQueries(CACHED_PAGE_QUERIES):
+            cached = self.get(q='Заявитель')
+        self.assertEqual(cached.content, first.content)
+        # Другая страница того же фильтра: страница не в кэше, итог — в кэше
+        with self.assertNumQueries(LIST_QUERY_BUDGET):
+            self.get(q='Заявитель', after=3)
+
+    def test_pages_are_cached_per_user(self):
+        self.get()
+        self.client.force_login(self.other)
+        response = self.get()
+        self.assertIsNotNone(response.context)
+        self.assertContains(response, 'Привет, other!')
+
+    def test_changes_invalidate_cached_pages(self):
+        self.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            Incoming.objects.create(applicant='Новый заявитель', summary='Новое письмо', responsible='Петров',
+                                    response_deadline=date(2025, 2, 1))
+        self.assertContains(self.get(), 'Новый заявитель')
+        self.get(attachment_filter='yes')
+        with self.captureOnCommitCallbacks(execute=True):
+            Attachment.objects.create(incoming=self.records[0], file='attachments/a.pdf', filename='a.pdf')
+        response = self.get(attachment_filter='yes')
+        self.assertEqual(response.context['total'], 1)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), ATTACHMENT_SENDFILE='')
+class AttachmentDownloadTests(TestCase):
+    CONTENT = bytes(range(256)) * 40
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('clerk', password='secret')
+        incoming = create_incoming(1)[0]
+        cls.attachment = Attachment(incoming=incoming, filename='Скан письма.pdf')
+        cls.attachment.file.save('scan.pdf', ContentFile(cls.CONTENT))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.url = reverse('attachment_download', args=[self.attachment.pk])
+
+    def test_requires_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    async def test_asgi_download_streams_asynchronously(self):
+        # Под ASGI файл отдаётся асинхронным итератором, а не собирается в память целиком
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.url, headers={'Range': 'bytes=100-'})
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), self.CONTENT[100:])
+
+    def test_full_download_and_revalidation(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn("filename*=utf-8''", response['Content-Disposition'])
+        response = self.client.get(self.url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_byte_ranges(self):
+        for header, expected, content_range in (
+            ('bytes=100-199', self.CONTENT[100:200], 'bytes 100-199/10240'),
+            ('bytes=10000-', self.CONTENT[10000:], 'bytes 10000-10239/10240'),
+            ('bytes=-40', self.CONTENT[-40:], 'bytes 10200-10239/10240'),
+        ):
+            with self.subTest(header):
+                response = self.client.get(self.url, headers={'Range': header})
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response['Content-Range'], content_range)
+                self.assertEqual(b''.join(response.streaming_content), expected)
+        response = self.client.get(self.url, headers={'Range': 'bytes=20000-'})
+        self.assertEqual(response.status_code, 416)
+        # Файл изменился с момента первой загрузки: If-Range не совпадает, отдаётся весь файл
+        response = self.client.get(self.url, headers={'Range': 'bytes=0-9', 'If-Range': '"old"'})
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(ATTACHMENT_SENDFILE='x-accel-redirect', ATTACHMENT_ACCEL_PREFIX='/protected-media/')
+    def test_offload_to_web_server(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.attachment.file.name)
+        self.assertEqual(response.content, b'')
+        # У blob нет расширения: тип содержимого берётся из имени вложения
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), ARCHIVE_ROOT=tempfile.mkdtemp(), ATTACHMENT_GC_GRACE=0,
+                   ATTACHMENT_SENDFILE='', ATTACHMENT_CHUNK_SIZE=1000)
+class ArchiveTests(TestCase):
+    TEXT = 'Акт обследования кровли дома по улице Ленина. '.encode('utf-8') * 200
+    PHOTO = bytes(range(256)) * 20
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        shutil.rmtree(settings.ARCHIVE_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        # Пакеты на диске не откатываются вместе с транзакцией теста
+        self.addCleanup(shutil.rmtree, settings.ARCHIVE_ROOT, ignore_errors=True)
+        self.old, self.other_month, self.recent = (
+            create_incoming(1, start=date(2019, 1, 10))[0],
+            create_incoming(1, start=date(2019, 3, 5))[0],
+            create_incoming(1, start=date(2025, 1, 1))[0],
+        )
+        for filename, content in (('акт.txt', self.TEXT), ('фото.jpg', self.PHOTO)):
+            attachment = Attachment(incoming=self.old, filename=filename)
+            attachment.file.save(filename, ContentFile(content))
+        self.blob = attachment.file.name
+        user = User.objects.create_user('clerk', password='secret')
+        self.client.force_login(user)
+
+    def test_archived_record_is_read_transparently(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(archive.archive_records(cutoff=date(2020, 1, 1), batch_size=1), 2)
+        self.assertEqual(list(Incoming.objects.values_list('pk', flat=True)), [self.recent.pk])
+        self.assertEqual(ArchivedIncoming.objects.count(), 2)
+        pack = ArchivePack.objects.get(name='2019/2019-01.zip')
+        self.assertEqual(pack.members, 2)
+        self.assertLess(pack.size, len(self.TEXT))  # текст сжат
+        # Исходные blob удалены сборкой мусора: ссылок на них больше нет
+        self.assertFalse(Attachment._meta.get_field('file').storage.exists(self.blob))
+
+        response = self.client.get(reverse('incoming_detail', args=[self.old.pk]))
+        self.assertContains(response, 'в архиве с')
+        self.assertNotContains(response, reverse('incoming_update', args=[self.old.pk]))
+        attachments = response.context['attachments']
+        for attachment, content in zip(attachments, (self.TEXT, self.PHOTO)):
+            url = reverse('archived_attachment_download', args=[attachment.pk])
+            self.assertEqual(b''.join(self.client.get(url).streaming_content), content)
+            response = self.client.get(url, headers={'Range': 'bytes=3000-3999'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), content[3000:4000])
+
+        # Поиск по имени вложения: архивный индекс строится из ArchivedAttachment
+        response = self.client.get(reverse('incoming_list'), {'search': 'акт'})
+        self.assertEqual([incoming.pk for incoming in response.context['archived']], [self.old.pk])
+        self.assertEqual(response.context['archived'][0].attachment_count, 2)
+
+        restored = archive.restore(ArchivedIncoming.objects.get(pk=self.old.pk))
+        self.assertEqual(restored.incoming_number, self.old.incoming_number)
+        with restored.attachments.get(filename='акт.txt').file.open('rb') as file:
+            self.assertEqual(file.read(), self.TEXT)
+        self.assertEqual(ArchivedIncoming.objects.count(), 1)
+
+    @override_settings(API_TOKEN='sync-token')
+    def test_archived_attachment_through_api(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            archive.archive_records(cutoff=date(2020, 1, 1))
+        self.client.logout()
+        auth = {'Authorization': 'Bearer sync-token'}
+        record = self.client.get(reverse('api_incoming_detail', args=[self.old.pk]), headers=auth).json()
+        item = next(item for item in record['attachments'] if item['filename'] == 'фото.jpg')
+        self.assertTrue(item['archived'])
+        response = self.client.get(reverse('api_archived_attachment_detail', args=[item['id']]), headers=auth)
+        self.assertEqual(response.json(), item)
+        self.assertEqual(response['ETag'], f'"{item["sha256"]}"')
+        # id архивного вложения — из ArchivedAttachment, среди живых вложений его нет
+        live = self.client.get(reverse('api_attachment_detail', args=[item['id']]), headers=auth)
+        self.assertEqual(live.status_code, 404)
+        self.client.force_login(User.objects.get())
+        self.assertEqual(b''.join(self.client.get(item['url']).streaming_content), self.PHOTO)
+
+    def test_failed_pack_write_leaves_pack_intact(self):
+        archive.archive_records(cutoff=date(2020, 1, 1))
+        path = archive.pack_path('2019/2019-01.zip')
+        with open(path, 'rb') as pack:
+            before = pack.read()
+        late = create_incoming(1, start=date(2019, 1, 20))[0]
+        Attachment(incoming=late, filename='опись.txt').file.save('опись.txt', ContentFile(b'new member'))
+        # Остаток прошлой оборванной записи и сбой до замены пакета
+        with open(path + '.tmp', 'wb') as leftover:
+            leftover.write(b'PK\x03\x04 torn')
+        with mock.patch.object(archive.os, 'replace', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                archive.archive_records(cutoff=date(2020, 1, 1))
+        with open(path, 'rb') as pack:
+            self.assertEqual(pack.read(), before)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+        self.assertTrue(Incoming.objects.filter(pk=late.pk).exists())
+
+        self.assertEqual(archive.archive_records(cutoff=date(2020, 1, 1)), 1)
+        with zipfile.ZipFile(path) as pack:
+            self.assertIsNone(pack.testzip())
+            self.assertEqual(len(pack.infolist()), 3)
+        # Смещения элементов, записанных раньше, остались верными
+        text = ArchivedAttachment.objects.get(incoming_id=self.old.pk, filename='акт.txt')
+        with archive.open_member(text) as member:
+            self.assertEqual(member.read(), self.TEXT)
+
+    def test_pack_is_copied_once_per_run(self):
+        archive.archive_records(cutoff=date(2020, 1, 1))
+        for index, incoming in enumerate(create_incoming(3, start=date(2019, 1, 20))):
+            Attachment(incoming=incoming, filename=f'{index}.txt').file.save(f'{index}.txt', ContentFile(b'page %d' % index))
+        with mock.patch.object(archive.shutil, 'copyfile', wraps=shutil.copyfile) as copyfile:
+            self.assertEqual(archive.archive_records(cutoff=date(2020, 1, 1), batch_size=1), 3)
+        self.assertEqual(copyfile.call_count, 1)
+        self.assertEqual(ArchivePack.objects.get(name='2019/2019-01.zip').members, 5)
+        for attachment in ArchivedAttachment.objects.filter(filename__endswith='.txt').exclude(filename='акт.txt'):
+            with archive.open_member(attachment) as member:
+                self.assertEqual(member.read(), b'page ' + attachment.filename[0].encode())
+
+    def test_pending_summaries_and_uploads_stay_in_register(self):
+        Incoming.objects.filter(pk=self.old.pk).update(summary_status=Incoming.SUMMARY_PENDING)
+        # Файл загружен, но ещё не прикреплён к записи
+        uploaded = create_incoming(1, start=date(2019, 2, 1))[0]
+        session = uploads.start_upload(uploaded, User.objects.get(), 'empty.txt', 0)
+        self.assertEqual(session.status, UploadSession.COMPLETE)
+        self.assertEqual(archive.archive_records(cutoff=date(2020, 1, 1)), 1)
+        self.assertTrue(Incoming.objects.filter(pk=self.old.pk).exists())
+        self.assertTrue(UploadSession.objects.filter(pk=session.pk, incoming=uploaded).exists())
+        # Номер архивной записи не выдаётся повторно и не принимается формой
+        NumberCounter.objects.all().delete()
+        self.assertEqual(NumberCounter.objects.peek(), uploaded.incoming_number + 1)
+        form = IncomingForm(data={'incoming_number': self.other_month.incoming_number})
+        self.assertIn('incoming_number', form.errors)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), UPLOAD_CHUNK_SIZE=1000)
+class ChunkedUploadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('clerk', password='secret')
+        cls.incoming = create_incoming(1)[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def start(self, filename, content, **extra):
+        response = self.client.post(reverse('upload_start', args=[self.incoming.pk]),
+                                    {'filename': filename, 'size': len(content), **extra},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def put(self, upload_id, offset, data):
+        return self.client.put(reverse('upload_chunk', args=[upload_id]), data,
+                               content_type='application/octet-stream', headers={'Upload-Offset': str(offset)})
+
+    def upload(self, filename, content):
+        state = self.start(filename, content)
+        while state['status'] != 'complete':
+            state = self.put(state['id'], state['offset'], content[state['offset']:state['offset'] + 1000]).json()
+        return state
+
+    def test_resumable_upload_and_attach_in_one_transaction(self):
+        scan = bytes(range(256)) * 10
+        state = self.start('скан.pdf', scan)
+        self.put(state['id'], 0, scan[:1000])
+        # Повтор уже принятого куска после обрыва связи: сервер сообщает, с какого места продолжать
+        response = self.put(state['id'], 0, scan[:1000])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 1000)
+        self.assertEqual(self.client.get(reverse('upload_chunk', args=[state['id']])).json()['offset'], 1000)
+        uploads._hashers.clear()  # продолжение в другом процессе
+        self.put(state['id'], 1000, scan[1000:2000])
+        state = self.put(state['id'], 2000, scan[2000:]).json()
+        self.assertEqual(state['status'], 'complete')
+        self.assertEqual(state['sha256'], hashlib.sha256(scan).hexdigest())
+
+        note = self.upload('note.txt', b'hello')
+        response = self.client.post(reverse('upload_attach', args=[self.incoming.pk]),
+                                    {'uploads': [state['id'], note['id']]}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        attachments = {attachment.filename: attachment for attachment in self.incoming.attachments.all()}
+        self.assertEqual(set(attachments), {'скан.pdf', 'note.txt'})
+        with attachments['скан.pdf'].file.open('rb') as stored:
+            self.assertEqual(stored.read(), scan)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_unfinished_upload_is_not_attached(self):
+        done = self.upload('a.txt', b'a' * 10)
+        pending = self.start('b.txt', b'b' * 10)
+        response = self.client.post(reverse('upload_attach', args=[self.incoming.pk]),
+                                    {'uploads': [done['id'], pending['id']]}, content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(self.incoming.attachments.exists())
+
+    def test_checksum_mismatch_restarts_upload(self):
+        state = self.start('c.txt', b'abc', sha256='0' * 64)
+        response = self.put(state['id'], 0, b'abc')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.client.get(reverse('upload_chunk', args=[state['id']])).json()['offset'], 0)
+
+    def test_record_form_takes_several_files(self):
+        response = self.client.post(reverse('incoming_create'), {
+            'applicant': 'Заявитель', 'incoming_date': '2025-01-10', 'summary': 'Письмо с приложениями',
+            'responsible': 'Иванов', 'response_deadline': '2025-01-20',
+            'attachments': [SimpleUploadedFile('a.pdf', b'first'), SimpleUploadedFile('b.pdf', b'second')],
+        })
+        self.assertEqual(response.status_code, 302)
+        incoming = Incoming.objects.get(summary='Письмо с приложениями')
+        self.assertEqual(sorted(incoming.attachments.values_list('filename', flat=True)), ['a.pdf', 'b.pdf'])
+
+    def test_chunk_is_read_before_the_session_is_locked(self):
+        state = self.start('d.txt', b'0123456789')
+        outer = len(connection.atomic_blocks)
+        depths = []
+
+        class Stream(io.BytesIO):
+            def read(self, size=-1):
+                depths.append(len(connection.atomic_blocks))
+                return super().read(size)
+
+        session = uploads.append_chunk(state['id'], self.user, 0, Stream(b'01234'), 5)
+        self.assertEqual(session.received, 5)
+        self.assertEqual(set(depths), {outer})
+        # Оборванный кусок отвергается, принятая часть файла не меняется
+        with self.assertRaises(uploads.UploadError) as raised:
+            uploads.append_chunk(state['id'], self.user, 5, Stream(b'567'), 5)
+        self.assertEqual(raised.exception.offset, 5)
+        session.refresh_from_db()
+        self.assertEqual(session.received, 5)
+        with session.file.open('rb') as partial:
+            self.assertEqual(partial.read(), b'01234')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), ATTACHMENT_GC_GRACE=0)
+class ContentAddressedStorageTests(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.first, self.second = create_incoming(2)
+
+    def attach(self, incoming, filename, content):
+        attachment = Attachment(incoming=incoming, filename=filename)
+        attachment.file.save(filename, ContentFile(content))
+        return attachment
+
+    def test_same_content_is_stored_once_and_collected_with_last_reference(self):
+        one = self.attach(self.first, 'рассылка.pdf', b'%PDF mass mailing')
+        two = self.attach(self.second, 'fwd.pdf', b'%PDF mass mailing')
+        self.assertEqual(one.file.name, two.file.name)
+        self.assertEqual(one.sha256, hashlib.sha256(b'%PDF mass mailing').hexdigest())
+        storage = one.file.storage
+        with self.captureOnCommitCallbacks(execute=True):
+            one.delete()
+        self.assertTrue(storage.exists(two.file.name))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.second.delete()  # каскадное удаление вложения
+        self.assertFalse(storage.exists(two.file.name))
+
+    def test_dedupe_command_moves_legacy_files_into_blobs(self):
+        storage = Attachment._meta.get_field('file').storage
+        os.makedirs(storage.path('attachments'), exist_ok=True)
+        names = []
+        for index, incoming in enumerate((self.first, self.second)):
+            name = f'attachments/legacy-{index}.pdf'
+            with open(storage.path(name), 'wb') as legacy:
+                legacy.write(b'same scan')
+            Attachment.objects.create(incoming=incoming, file=name, filename=f'scan-{index}.pdf')
+            names.append(name)
+        call_command('dedupe_attachments', stdout=io.StringIO())
+        files = set(Attachment.objects.values_list('file', flat=True))
+        self.assertEqual(len(files), 1)
+        self.assertTrue(storage.exists(files.pop()))
+        self.assertFalse(any(storage.exists(name) for name in names))
+        self.assertEqual(set(Attachment.objects.values_list('sha256', flat=True)),
+                         {hashlib.sha256(b'same scan').hexdigest()})
+
+
+def docx_bytes(*paragraphs):
+    body = ''.join(f'<w:p><w:r><w:t>{text}</w:t></w:r></w:p>' for text in paragraphs)
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w') as archive:
+        archive.writestr('word/document.xml', (
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body>{body}</w:body></w:document>'
+        ))
+    return output.getvalue()
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), EXTRACTION_WORKERS=0)
+class AttachmentExtractionTests(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.first, self.second = create_incoming(2)
+
+    def attach(self, incoming, filename, content):
+        attachment = Attachment(incoming=incoming, filename=filename)
+        attachment.file.save(filename, ContentFile(content))
+        return attachment
+
+    def test_text_is_extracted_once_per_content_and_searchable(self):
+        self.attach(self.first, 'ответ.docx', docx_bytes('Разрешение на строительство', 'выдано'))
+        self.attach(self.first, 'заметка.txt', 'Межевание участка'.encode('cp1251'))
+        self.attach(self.second, 'копия.docx', docx_bytes('Разрешение на строительство', 'выдано'))
+
+        self.assertEqual(extraction.run(), 2)
+        self.assertEqual(extraction.run(), 0)  # повторный запуск ничего не разбирает
+        self.assertEqual(set(AttachmentContent.objects.values_list('status', flat=True)), {AttachmentContent.DONE})
+        self.assertIn('Межевание участка', AttachmentContent.objects.values_list('text', flat=True))
+
+        found = search(Incoming.objects.all(), 'строительства', column='attachments')
+        self.assertEqual(set(found), {self.first, self.second})
+        self.assertEqual(list(search(Incoming.objects.all(), 'межевания')), [self.first])
+
+    def test_detail_page_shows_extracted_text(self):
+        User.objects.create_user('clerk', password='secret')
+        self.client.login(username='clerk', password='secret')
+        self.attach(self.first, 'ответ.docx', docx_bytes('Согласование проекта'))
+        response = self.client.get(reverse('incoming_detail', args=[self.first.pk]))
+        self.assertContains(response, 'ещё обрабатывается')
+        extraction.run()
+        self.assertContains(self.client.get(reverse('incoming_detail', args=[self.first.pk])), 'Согласование проекта')
+
+    def test_attachments_committed_out_of_pk_order_are_queued(self):
+        later = Attachment(pk=10, incoming=self.second, filename='b.txt')
+        later.file.save('b.txt', ContentFile(b'second file'))
+        self.assertEqual(extraction.enqueue_new_attachments(), 1)
+        # Транзакция с меньшим pk зафиксирована после того, как очередь уже видела pk 10
+        earlier = Attachment(pk=5, incoming=self.first, filename='a.txt')
+        earlier.file.save('a.txt', ContentFile(b'first file'))
+        self.assertEqual(extraction.enqueue_new_attachments(), 1)
+        self.assertEqual(extraction.enqueue_new_attachments(), 0)
+        self.assertEqual(set(AttachmentContent.objects.values_list('sha256', flat=True)),
+                         {later.sha256, earlier.sha256})
+        self.assertFalse(NumberCounter.objects.filter(name='attachment_extraction').exists())
+
+    def test_unknown_format_and_stale_claims(self):
+        self.attach(self.first, 'archive.bin', b'\x00\x01binary')
+        extraction.run()
+        content = AttachmentContent.objects.get()
+        self.assertEqual(content.status, AttachmentContent.UNSUPPORTED)
+        # Обработчик упал посреди разбора: файл возвращается в очередь
+        AttachmentContent.objects.update(status=AttachmentContent.PROCESSING, updated_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(extraction.release_stale(timedelta(hours=1)), 1)
+        self.assertEqual(AttachmentContent.objects.get().status, AttachmentContent.PENDING)
+
+
+class LoadTestHarnessTests(LiveServerTestCase):
+    def test_logs_in_and_reports_latency_percentiles(self):
+        User.objects.create_user('clerk', password='secret')
+        create_incoming(3)
+        cookie = loadtest.login(self.live_server_url, 'clerk', 'secret')
+        summary = loadtest.run([self.live_server_url + '/incoming/?search=письма'], users=2, duration=0.5, cookie=cookie)
+        self.assertGreater(summary['requests'], 0)
+        self.assertEqual(summary['errors'], 0)
+        self.assertLessEqual(summary['p50_ms'], summary['p95_ms'])
+
+
+class MailIngestionTests(TestCase):
+    def setUp(self):
+        self.state = MailboxSyncState.objects.create(mailbox='clerk@example.com/INBOX')
+
+    def test_workers_claim_disjoint_batches_and_take_over_expired_leases(self):
+        ingestion.schedule_batches(self.state, 7, list(range(1, 26)), uidnext=30, size=10)
+        self.assertEqual(MailboxSyncState.objects.get().last_uid, 29)
+        claimed = [ingestion.claim_batch(f'worker-{index}') for index in range(3)]
+        self.assertEqual([batch.uid_list()[0] for batch in claimed], [1, 11, 21])
+        self.assertIsNone(ingestion.claim_batch('worker-3'))
+
+        # worker-0 завис: после истечения аренды пачку забирает другой, а старый владелец её теряет
+        MailboxBatch.objects.filter(pk=claimed[0].pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(ingestion.claim_batch('worker-3').pk, claimed[0].pk)
+        with self.assertRaises(ingestion.LeaseLost):
+            ingestion.renew_batch(claimed[0], 'worker-0')
+
+    def test_overlapping_scan_backs_off(self):
+        self.assertTrue(MailboxSyncState.objects.acquire(self.state.pk, 'scanner-1', 600))
+        self.assertFalse(MailboxSyncState.objects.acquire(self.state.pk, 'scanner-2', 600))
+        ingestion.note_overrun(self.state)
+        state = MailboxSyncState.objects.get()
+        self.assertEqual(state.overruns, 1)
+        self.assertFalse(ingestion.scan_due(state))
+        self.assertFalse(ingestion.scan_due(state, timezone.now() + timedelta(seconds=settings.EMAIL_POLL_INTERVAL)))
+
+        ingestion.finish_scan(state, 'scanner-1', overran=False)
+        state = MailboxSyncState.objects.get()
+        self.assertEqual((state.lease_owner, state.overruns), ('', 0))
+        self.assertTrue(ingestion.scan_due(state))
+
+    def test_batched_fetch_response_is_split_by_uid(self):
+        imap_server = mock.Mock()
+        # UID может прийти и до литерала с текстом письма, и после него
+        imap_server.uid.return_value = ('OK', [
+            (b'1 (UID 5 RFC822 {3}', b'abc'), b')',
+            (b'2 (RFC822 {3}', b'def'), b' UID 7)',
+            b'3 (UID 9 FLAGS (\\Seen))',
+        ])
+        self.assertEqual(fetch_messages(imap_server, [5, 7, 9]), [(5, b'abc'), (7, b'def')])
+        imap_server.uid.assert_called_once_with('fetch', '5,7,9', '(RFC822)')
+        self.assertEqual(list(chunked([1, 2, 3, 4, 5], 2)), [[1, 2], [3, 4], [5]])
+
+    def test_message_id_makes_import_idempotent(self):
+        command = ProcessEmailsCommand(stdout=io.StringIO())
+
+        def email(uid):
+            return IncomingEmail(uid=uid, message_id='<1@example.com>', applicant='Заявитель', subject='Тема',
+                                 incoming_date=date(2025, 1, 1), summary=f'Текст {uid}')
+
+        self.assertEqual(len(command.write_batch([email(1)])), 1)
+        self.assertEqual(command.write_batch([email(2)]), [])  # повтор пачки другим воркером
+        # Гонка: другой воркер записал письмо после проверки — вставку отклоняет уникальный индекс
+        with mock.patch.object(command, 'filter_duplicates', side_effect=lambda emails: emails):
+            with self.assertRaises(IntegrityError):
+                command.write_batch([email(3)])
+        self.assertEqual(Incoming.objects.count(), 1)
+
+
+def raw_email(message_id, subject, body, sender='Заявитель <applicant@example.com>'):
+    message = EmailMessage()
+    message['From'] = sender
+    message['Subject'] = subject
+    message['Date'] = 'Mon, 06 Jan 2025 10:00:00 +0300'
+    message['Message-ID'] = message_id
+    message.set_content(body)
+    return message.as_bytes()
+
+
+class IMAPStandInTests(TestCase):
+    def setUp(self):
+        self.server = IMAPStandIn().start()
+        self.mailbox = {'name': 'standin', 'host': '127.0.0.1', 'port': self.server.port, 'ssl': False,
+                        'username': 'clerk', 'password': 'secret'}
+        # Внешняя модель в тестах не вызывается: резюме — предложения самого письма
+        settings_override = override_settings(MAILBOXES=[self.mailbox], SUMMARIZER_BACKENDS=['extractive'])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.server.stop)
+        self.addCleanup(imap.pool.close_all)
+
+    def test_process_emails_imports_over_pooled_connection(self):
+        self.server.deliver(raw_email('<1@example.com>', 'Запрос', 'Просим выдать справку'))
+        self.server.deliver(raw_email('<2@example.com>', 'Жалоба', 'Не вывезен мусор'))
+        call_command('process_emails', stdout=io.StringIO())
+        self.assertEqual(sorted(Incoming.objects.values_list('message_id', flat=True)),
+                         ['<1@example.com>', '<2@example.com>'])
+        self.assertTrue(all('\\Seen' in message['flags'] for message in self.server.messages))
+        self.assertEqual(set(MailboxBatch.objects.values_list('status', flat=True)), {MailboxBatch.DONE})
+
+        # Сервер оборвал соединения: пул замечает это по NOOP и переподключается
+        self.server.drop_connections()
+        self.server.deliver(raw_email('<3@example.com>', 'Запрос', 'Просим провести проверку'))
+        with mock.patch.object(imap, 'NOOP_AFTER', 0):
+            call_command('process_emails', immediate=True, stdout=io.StringIO())
+        self.assertEqual(Incoming.objects.count(), 3)
+
+    def test_batches_are_fetched_with_one_command_and_duplicates_stay_unread(self):
+        for number in range(1, 5):
+            self.server.deliver(raw_email(f'<{number}@example.com>', 'Запрос', f'Просим выдать справку № {number}'))
+        duplicate = self.server.deliver(raw_email('<5@example.com>', 'Запрос', 'Просим выдать справку № 1'))
+        call_command('process_emails', batch_size=2, stdout=io.StringIO())
+        fetches = [arguments for command, arguments in self.server.commands if command == 'UID FETCH']
+        self.assertEqual(fetches, ['1,2 (RFC822)', '3,4 (RFC822)', '5 (RFC822)'])
+        self.assertEqual(Incoming.objects.count(), 4)
+        unread = [message['uid'] for message in self.server.messages if '\\Seen' not in message['flags']]
+        self.assertEqual(unread, [duplicate])
+
+    def test_sync_state_follows_uidnext_and_uidvalidity(self):
+        self.server.deliver(raw_email('<1@example.com>', 'Запрос', 'Просим выдать справку'))
+        self.server.deliver(raw_email('<2@example.com>', 'Жалоба', 'Не вывезен мусор'))
+        call_command('process_emails', stdout=io.StringIO())
+        state = MailboxSyncState.objects.get()
+        self.assertEqual((state.uidvalidity, state.last_uid), (1, 2))
+
+        def searches():
+            found = [arguments for command, arguments in self.server.commands if command == 'UID SEARCH']
+            self.server.commands.clear()
+            return found
+
+        # С прошлого UIDNEXT ничего не пришло: 'UID 3:*' возвращает последнее письмо, пачек нет
+        searches()
+        call_command('process_emails', immediate=True, stdout=io.StringIO())
+        self.assertEqual(searches(), ['UID 3:*'])
+        self.assertEqual(MailboxBatch.objects.count(), 1)
+        self.assertEqual(MailboxSyncState.objects.get().last_uid, 2)
+
+        # Новое письмо: отметка сдвигается, разбирается только оно
+        self.server.deliver(raw_email('<3@example.com>', 'Запрос', 'Просим провести проверку'))
+        call_command('process_emails', immediate=True, stdout=io.StringIO())
+        self.assertEqual(searches(), ['UID 3:*'])
+        self.assertEqual(MailboxSyncState.objects.get().last_uid, 3)
+        self.assertEqual(Incoming.objects.count(), 3)
+
+        # Папку пересоздали: весь ящик пересматривается, импортированные письма отсеиваются по Message-ID
+        self.server.renumber(uidvalidity=2)
+        self.server.deliver(raw_email('<4@example.com>', 'Жалоба', 'Не работает освещение'))
+        call_command('process_emails', immediate=True, stdout=io.StringIO())
+        self.assertEqual(searches(), ['ALL'])
+        state = MailboxSyncState.objects.get()
+        self.assertEqual((state.uidvalidity, state.last_uid), (2, self.server.uidnext - 1))
+        self.assertEqual(sorted(Incoming.objects.values_list('message_id', flat=True)),
+                         [f'<{number}@example.com>' for number in range(1, 5)])
+
+    def test_run_summary_records_stage_timings(self):
+        self.server.deliver(raw_email('<5@example.com>', 'Запрос', 'Просим выдать справку'))
+        output = io.StringIO()
+        call_command('process_emails', stdout=output)
+        run = IngestionRun.objects.get()
+        self.assertEqual((run.mailboxes, run.batches, run.processed, run.created), ('standin', 1, 1, 1))
+        self.assertGreater(run.queries, 0)
+        for name in ['scan', 'fetch', 'parse', 'summarize', 'dedup', 'db', 'mark_seen']:
+            self.assertGreater(getattr(run, name), 0, name)
+        self.assertIn('Stages: scan', output.getvalue())
+        # Пустой запуск без просмотра (ящик отложен, пачек нет) не оставляет строки
+        call_command('process_emails', scan=False, stdout=io.StringIO())
+        self.assertEqual(IngestionRun.objects.count(), 1)
+
+    def test_idle_reports_new_mail(self):
+        config = imap.mailboxes()[0]
+        connection = imap.open_connection(config)
+        self.addCleanup(imap.close_connection, connection)
+        connection.select(config.folder, readonly=True)
+        self.assertFalse(imap.idle(connection, timeout=0.2))
+        threading.Timer(0.2, self.server.deliver, [raw_email('<4@example.com>', 'Тема', 'Текст')]).start()
+        started = time.monotonic()
+        self.assertTrue(imap.idle(connection, timeout=10))
+        self.assertLess(time.monotonic() - started, 5)
+
+
+STREAMED_PDF = bytes(range(256)) * 12
+STREAMED_NOTES = 'Заметки к акту: проверка проведена, замечаний нет. ' * 8
+
+
+def multipart_email(message_id='<stream@example.com>'):
+    """Письмо с вложенными частями: текст и HTML, PDF с именем по RFC 2231, .txt и пересланное письмо."""
+    pdf = base64.encodebytes(STREAMED_PDF).replace(b'\n', b'\r\n')
+    notes = quopri.encodestring(STREAMED_NOTES.encode('utf-8')).replace(b'\n', b'\r\n')
+    body = quopri.encodestring('Просим выдать акт проверки.\nС уважением, заявитель.'.encode('utf-8'))
+    return b'\r\n'.join([
+        b'From: =?utf-8?b?0JfQsNGP0LLQuNGC0LXQu9GM?= <applicant@example.com>',
+        b'Subject: =?utf-8?b?0JDQutGCINC/0YDQvtCy0LXRgNC60Lg=?=',
+        b'Date: Mon, 06 Jan 2025 10:00:00 +0300',
+        b'Message-ID: ' + message_id.encode(),
+        b'MIME-Version: 1.0',
+        b'Content-Type: multipart/mixed; boundary="outer"',
+        b'',
+        b'--outer',
+        b'Content-Type: multipart/alternative; boundary="inner"',
+        b'',
+        b'--inner',
+        b'Content-Type: text/plain; charset=utf-8',
+        b'Content-Transfer-Encoding: quoted-printable',
+        b'',
+        body.replace(b'\n', b'\r\n'),
+        b'--inner',
+        b'Content-Type: text/html; charset=utf-8',
+        b'',
+        '<p>Просим выдать акт проверки.</p>'.encode('utf-8'),
+        b'--inner--',
+        b'--outer',
+        b'Content-Type: application/pdf',
+        b"Content-Disposition: attachment;\r\n filename*0*=utf-8''%D0%90%D0%BA%D1%82;\r\n filename*1*=%20%E2%84%96%205.pdf",
+        b'Content-Transfer-Encoding: base64',
+        b'',
+        pdf,
+        b'--outer',
+        b'Content-Type: text/plain; charset=utf-8; name="notes.txt"',
+        b'Content-Disposition: attachment; filename="notes.txt"',
+        b'Content-Transfer-Encoding: quoted-printable',
+        b'',
+        notes,
+        b'--outer',
+        b'Content-Type: message/rfc822',
+        b"Content-Disposition: attachment; filename*=utf-8''%D0%9F%D0%B8%D1%81%D1%8C%D0%BC%D0%BE.eml",
+        b'',
+        b'From: office@example.com',
+        b'Subject: Forwarded',
+        b'',
+        b'Forwarded text',
+        b'--outer--',
+        b'',
+    ])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class StreamingMailTests(TestCase):
+    def setUp(self):
+        self.server = IMAPStandIn().start()
+        mailbox = {'name': 'standin', 'host': '127.0.0.1', 'port': self.server.port, 'ssl': False,
+                   'username': 'clerk', 'password': 'secret'}
+        # Куски частичного FETCH не кратны ни 4 (base64), ни строкам quoted-printable
+        settings_override = override_settings(MAILBOXES=[mailbox], SUMMARIZER_BACKENDS=['extractive'],
+                                              EMAIL_STREAM_CHUNK_SIZE=57)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.server.stop)
+        self.addCleanup(imap.pool.close_all)
+
+    def test_bodystructure_of_nested_parts(self):
+        uid = self.server.deliver(multipart_email())
+        config = imap.mailboxes()[0]
+        connection = imap.open_connection(config)
+        self.addCleanup(imap.close_connection, connection)
+        connection.select(config.folder)
+        typ, data = connection.uid('fetch', str(uid), '(UID BODYSTRUCTURE BODY.PEEK[HEADER])')
+        self.assertEqual(typ, 'OK')
+        [items] = parse_fetch_response(data)
+        self.assertIn(b'Message-ID: <stream@example.com>', items['BODY[HEADER]'])
+        parts = walk_bodystructure(items['BODYSTRUCTURE'])
+        self.assertEqual([(part.section, part.content_type, part.disposition, part.filename) for part in parts], [
+            ('1.1', 'text/plain', None, None),
+            ('1.2', 'text/html', None, None),
+            ('2', 'application/pdf', 'attachment', 'Акт № 5.pdf'),
+            ('3', 'text/plain', 'attachment', 'notes.txt'),
+            ('4', 'message/rfc822', 'attachment', 'Письмо.eml'),
+        ])
+        self.assertEqual((parts[0].encoding, parts[0].charset), ('quoted-printable', 'utf-8'))
+        self.assertEqual(fetch_text_parts(connection, [(uid, parts[0])]),
+                         {uid: 'Просим выдать акт проверки.\r\nС уважением, заявитель.'})
+        pdf = IMAPPartFile(connection, uid, parts[2], chunk_size=57)
+        self.assertEqual(b''.join(pdf.chunks()), STREAMED_PDF)
+
+    def test_transfer_decoder_across_chunk_boundaries(self):
+        encoded = {
+            'base64': (base64.encodebytes(STREAMED_PDF).replace(b'\n', b'\r\n'), STREAMED_PDF),
+            'quoted-printable': (quopri.encodestring(STREAMED_NOTES.encode('utf-8')), STREAMED_NOTES.encode('utf-8')),
+        }
+        for encoding, (data, expected) in encoded.items():
+            for size in (1, 3, 57, len(data)):
+                decoder = TransferDecoder(encoding)
+                decoded = b''.join(decoder.feed(data[start:start + size]) for start in range(0, len(data), size))
+                self.assertEqual(decoded + decoder.flush(), expected, (encoding, size))
+
+    def test_streaming_import_keeps_text_attachments(self):
+        self.server.deliver(multipart_email())
+        # Письмо только с HTML: .txt во вложении — вложение, а не текст письма
+        self.server.deliver(b'\r\n'.join([
+            b'From: office@example.com',
+            b'Subject: Notes',
+            b'Date: Mon, 06 Jan 2025 11:00:00 +0300',
+            b'Message-ID: <html@example.com>',
+            b'Content-Type: multipart/mixed; boundary="b"',
+            b'',
+            b'--b',
+            b'Content-Type: text/html; charset=utf-8',
+            b'',
+            b'<p>See the notes</p>',
+            b'--b',
+            b'Content-Type: text/plain; charset=utf-8',
+            b'Content-Disposition: attachment; filename="notes.txt"',
+            b'',
+            b'Attached notes',
+            b'--b--',
+            b'',
+        ]))
+        call_command('process_emails', streaming=True, stdout=io.StringIO())
+
+        incoming = Incoming.objects.get(message_id='<stream@example.com>')
+        self.assertEqual(incoming.summary, 'Просим выдать акт проверки. С уважением, заявитель.')
+        files = {attachment.filename: attachment.file.read() for attachment in incoming.attachments.all()}
+        self.assertEqual(set(files), {'Акт № 5.pdf', 'notes.txt', 'Письмо.eml'})
+        self.assertEqual(files['Акт № 5.pdf'], STREAMED_PDF)
+        self.assertEqual(files['notes.txt'].decode('utf-8'), STREAMED_NOTES)
+        self.assertIn(b'Forwarded text', files['Письмо.eml'])
+
+        html_only = Incoming.objects.get(message_id='<html@example.com>')
+        self.assertEqual(html_only.summary, 'Notes')
+        self.assertEqual([(attachment.filename, attachment.file.read()) for attachment in html_only.attachments.all()],
+                         [('notes.txt', b'Attached notes')])
+
+    def test_inline_images_are_not_attachments_in_either_mode(self):
+        raw = b'\r\n'.join([
+            b'From: office@example.com',
+            b'Subject: Newsletter',
+            b'Date: Mon, 06 Jan 2025 12:00:00 +0300',
+            b'Message-ID: <inline@example.com>',
+            b'Content-Type: multipart/mixed; boundary="outer"',
+            b'',
+            b'--outer',
+            b'Content-Type: multipart/related; boundary="related"',
+            b'',
+            b'--related',
+            b'Content-Type: text/html; charset=utf-8',
+            b'',
+            b'<p>Report</p><img src="cid:logo">',
+            b'--related',
+            b'Content-Type: image/png; name="logo.png"',
+            b'Content-Disposition: inline; filename="logo.png"',
+            b'Content-ID: <logo>',
+            b'Content-Transfer-Encoding: base64',
+            b'',
+            base64.b64encode(b'\x89PNG logo'),
+            b'--related--',
+            b'--outer',
+            b'Content-Type: application/pdf; name="report.pdf"',
+            b'Content-Disposition: attachment; filename="report.pdf"',
+            b'Content-Transfer-Encoding: base64',
+            b'',
+            base64.b64encode(STREAMED_PDF),
+            b'--outer--',
+            b'',
+        ])
+        parsed = ProcessEmailsCommand().parse_email(1, raw)
+        self.assertEqual([filename for filename, _ in parsed.attachments], ['report.pdf'])
+
+        self.server.deliver(raw)
+        call_command('process_emails', streaming=True, stdout=io.StringIO())
+        incoming = Incoming.objects.get(message_id='<inline@example.com>')
+        self.assertEqual([attachment.filename for attachment in incoming.attachments.all()], ['report.pdf'])
+
+
+@override_settings(METRICS_TOKEN='scrape-token')
+class MetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.clerk = User.objects.create_user('clerk', password='secret')
+        cls.admin = User.objects.create_user('admin', password='secret', is_staff=True)
+        create_incoming(3)
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_stage_timer_counts_queries(self):
+        with metrics.collect() as timer:
+            with metrics.stage('db'):
+                list(Incoming.objects.all())
+                Incoming.objects.count()
+        self.assertEqual(timer.queries, 2)
+        self.assertGreater(timer.seconds['db'], 0)
+        self.assertGreaterEqual(timer.elapsed, timer.seconds['db'])
+        # Вне замера запросы не учитываются
+        Incoming.objects.count()
+        self.assertEqual(timer.queries, 2)
+
+    def test_endpoint_requires_token_or_staff(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.client.force_login(self.clerk)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer scrape-token'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.client.force_login(self.admin)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    def test_list_view_and_ingestion_metrics(self):
+        IngestionRun.objects.create(started_at=timezone.now(), duration=2.5, worker='w1', processed=4, created=3,
+                                    fetch=1.25, db=0.5)
+        self.client.force_login(self.clerk)
+        before = metrics.VIEW_QUERIES.values.get(('incoming_list',), ([0], 0.0))[1]
+        self.client.get(reverse('incoming_list'))
+        _, queries = metrics.VIEW_QUERIES.values[('incoming_list',)]
+        # Замер охватывает и запросы, выполненные sync_to_async в другом потоке; итог ещё не в кэше — плюс COUNT
+        self.assertEqual(queries - before, LIST_QUERY_BUDGET + 1)
+
+        self.client.force_login(self.admin)
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('registry_view_queries_count{view="incoming_list"}', body)
+        self.assertRegex(body, r'registry_view_render_seconds_total\{view="incoming_list"\} [0-9.e-]+')
+        self.assertIn('registry_ingestion_window_total{window="3600s",value="processed"} 4', body)
+        self.assertIn('registry_ingestion_stage_seconds{window="3600s",stage="fetch"} 1.25', body)
+        self.assertIn('registry_ingestion_last_run{value="duration_seconds"} 2.5', body)
+
+
+class BenchmarkTests(TestCase):
+    def test_synthetic_register_is_reproducible(self):
+        self.assertEqual(benchmarks.generate_register(30, attachments_every=5, seed=7), 30)
+        first = list(Incoming.objects.order_by('pk').values_list('applicant', 'summary'))
+        self.assertEqual(Attachment.objects.count(), 12)
+        self.assertTrue(all(re.search('[а-яё]', summary) for _, summary in first))
+        Incoming.objects.all().delete()
+        benchmarks.generate_register(30, attachments_every=5, seed=7)
+        self.assertEqual(list(Incoming.objects.order_by('pk').values_list('applicant', 'summary')), first)
+        # Записи проиндексированы и учтены в сводке сроков, как при импорте
+        self.assertTrue(search(Incoming.objects.all(), first[0][1].split()[-2]).exists())
+        self.assertEqual(sum(DeadlineSummary.objects.current().values_list('count', flat=True)), 30)
+
+    def test_runner_reports_percentiles_and_regressions(self):
+        benchmarks.generate_register(20, attachments_every=0)
+        results = benchmarks.run(['list_first_page', 'form_save', 'process_emails'], repeat=3, warmup=1, emails=2)
+        self.assertEqual(Incoming.objects.filter(message_id__startswith='<bench-').count(), 8)
+        for row in results.values():
+            self.assertEqual(row['repeat'], 3)
+            self.assertLessEqual(row['p50_ms'], row['p99_ms'])
+            self.assertGreater(row['queries'], 0)
+        self.assertIsNotNone(results['process_emails']['items_per_second'])
+
+        slower = {name: {**row, 'p95_ms': row['p95_ms'] * 2 + 10} for name, row in results.items()}
+        self.assertEqual(benchmarks.compare(results, slower), [])
+        regressions = benchmarks.compare(slower, results)
+        self.assertEqual(len(regressions), 3)
+        more_queries = {'form_save': {**results['form_save'], 'queries': results['form_save']['queries'] + 1}}
+        self.assertIn('queries', benchmarks.compare(more_queries, results)[0])
+
+
+class ScriptedSummarizer(summarizers.ChatSummarizer):
+    """Модель для тестов: отвечает заданными ответами или ошибкой и запоминает запросы."""
+    name = 'scripted'
+
+    def __init__(self, responses, **kwargs):
+        super().__init__(**kwargs)
+        self.responses = list(responses)
+        self.prompts = []
+
+    async def complete(self, prompt, session):
+        self.prompts.append(prompt)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@override_settings(SUMMARIZER_BATCH_SIZE=3, SUMMARIZER_BREAKER_FAILURES=2, SUMMARIZER_BREAKER_RESET=60)
+class SummarizerTests(TestCase):
+    LETTER = ('Уважаемые коллеги! Просим провести ремонт кровли дома по улице Ленина, 15. '
+              'Кровля протекает уже третий месяц, ремонт кровли обещали в прошлом году. '
+              'С уважением, жильцы.')
+
+    def setUp(self):
+        summarizers.breakers.clear()
+        self.addCleanup(summarizers.breakers.clear)
+
+    def summarize(self, backend, texts):
+        chain = summarizers.SummarizerChain([backend])
+        return asyncio.run(chain.summarize_many(texts, session=None, concurrency=2))
+
+    def test_extractive_summary_keeps_the_main_sentences(self):
+        summary = summarizers.ExtractiveSummarizer().summarize_text(self.LETTER * 3)
+        self.assertLessEqual(len(summary), summarizers.MAX_LENGTH)
+        self.assertIn('ремонт кровли', summary)
+        self.assertIsNone(summarizers.ExtractiveSummarizer().summarize_text('  '))
+
+    def test_batch_prompt_and_fallback_for_missing_letters(self):
+        backend = ScriptedSummarizer(['1: Ремонт кровли\n3: Вывоз мусора'])
+        results = self.summarize(backend, [self.LETTER, 'Прошу выдать справку о составе семьи.', 'Не вывезен мусор.'])
+        self.assertEqual(len(backend.prompts), 1)
+        self.assertIn('Письмо 3:', backend.prompts[0])
+        self.assertEqual([(summary, source.name) for summary, source in results], [
+            ('Ремонт кровли', 'scripted'),
+            ('Прошу выдать справку о составе семьи.', 'extractive'),
+            ('Вывоз мусора', 'scripted'),
+        ])
+        self.assertFalse(results[1][1].cacheable)
+
+    def test_breaker_skips_failing_backend(self):
+        backend = ScriptedSummarizer([summarizers.SummarizerError('down')] * 2 + ['Снова работает'])
+        for _ in range(2):
+            results = self.summarize(backend, [self.LETTER])
+            self.assertEqual(results[0][1].name, 'extractive')
+        # Автомат разомкнут: модель не вызывается, резюме — сразу из текста
+        started = time.monotonic()
+        self.summarize(backend, [self.LETTER] * 5)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(len(backend.prompts), 2)
+        self.assertTrue(summarizers.breaker('scripted').is_open)
+
+        # По истечении паузы — одна пробная попытка, успех замыкает автомат
+        summarizers.breaker('scripted').opened_at -= 61
+        results = self.summarize(backend, [self.LETTER])
+        self.assertEqual(results[0], ('Снова работает', backend))
+        self.assertFalse(summarizers.breaker('scripted').is_open)
+
+
+class SummaryCacheTests(TestCase):
+    def test_hits_and_misses(self):
+        cache = SummaryCache()
+        cache.set_many({'a': 'Резюме A'})
+        self.assertEqual(cache.get_many(['a', 'b']), {'a': 'Резюме A'})
+        self.assertEqual(cache.get_many([]), {})
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(CachedSummary.objects.get(key='a').hits, 1)
+
+    def test_normalized_texts_share_a_key(self):
+        self.assertEqual(cache_key('Просим\u00a0выдать  справку\n'), cache_key(' Просим выдать справку'))
+        self.assertEqual(cache_key('ﬁle №１'), cache_key('file №1'))  # NFKC
+        self.assertNotEqual(cache_key('Просим выдать справку'), cache_key('Просим выдать справки'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = SummaryCache(max_entries=2)
+        cache.set_many({'old': 'Старое', 'used': 'Используемое'})
+        CachedSummary.objects.update(last_used_at=timezone.now() - timedelta(days=1))
+        cache.get_many(['used'])  # попадание обновляет last_used_at
+        cache.set_many({'new': 'Новое'})
+        self.assertEqual(set(CachedSummary.objects.values_list('key', flat=True)), {'used', 'new'})
+
+
+@override_settings(SUMMARIZER_BACKENDS=['scripted'], SUMMARIZER_BATCH_SIZE=5)
+class DeferredSummaryTests(TestCase):
+    def setUp(self):
+        self.server = IMAPStandIn().start()
+        mailbox = {'name': 'standin', 'host': '127.0.0.1', 'port': self.server.port, 'ssl': False,
+                   'username': 'clerk', 'password': 'secret'}
+        self.backend = ScriptedSummarizer([])
+        settings_override = override_settings(MAILBOXES=[mailbox])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Очередь Celery в тестах не нужна: задачи вызываются напрямую через summarize_records
+        for patcher in [mock.patch.dict(summarizers.BACKENDS, scripted=lambda: self.backend),
+                        mock.patch.object(summaries, 'dispatch', side_effect=len)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        summarizers.breakers.clear()
+        self.addCleanup(summarizers.breakers.clear)
+        self.addCleanup(self.server.stop)
+        self.addCleanup(imap.pool.close_all)
+
+    def test_records_are_created_before_the_model_answers(self):
+        self.server.deliver(raw_email('<1@example.com>', 'Запрос', 'Просим выдать справку о составе семьи.'))
+        self.server.deliver(raw_email('<2@example.com>', 'Жалоба', 'Не вывезен мусор во дворе.'))
+        call_command('process_emails', deferred_summaries=True, stdout=io.StringIO())
+        # Модель при импорте не вызывалась, записи созданы с резюме из текста письма
+        self.assertEqual(self.backend.prompts, [])
+        records = list(Incoming.objects.order_by('message_id'))
+        self.assertEqual([incoming.summary_status for incoming in records], [Incoming.SUMMARY_PENDING] * 2)
+        self.assertEqual(records[0].summary, 'Просим выдать справку о составе семьи.')
+        self.assertEqual(SummaryRequest.objects.count(), 2)
+        ids = [incoming.pk for incoming in records]
+        summaries.dispatch.assert_called_once_with(ids)
+
+        # Модель недоступна: записи ждут повтора, после исчерпания повторов — failed
+        self.backend.responses = [summarizers.SummarizerError('down')]
+        self.assertEqual(summaries.summarize_records(ids), ids)
+        self.assertEqual(SummaryRequest.objects.get(incoming=records[0]).attempts, 1)
+        summaries.give_up(ids)
+        self.assertEqual(Incoming.objects.get(pk=ids[0]).summary_status, Incoming.SUMMARY_FAILED)
+
+        self.assertEqual(summaries.retry_failed(), 2)
+        self.backend.responses = ['1: Справка о составе семьи\n2: Вывоз мусора']
+        self.assertEqual(summaries.summarize_records(ids), [])
+        updated = Incoming.objects.get(pk=ids[0])
+        self.assertEqual((updated.summary, updated.summary_status), ('Справка о составе семьи', Incoming.SUMMARY_DONE))
+        self.assertEqual(updated.dedup_key, records[0].dedup_key)
+        self.assertFalse(SummaryRequest.objects.exists())
+
+    def test_summary_edited_by_clerk_is_not_replaced(self):
+        self.server.deliver(raw_email('<3@example.com>', 'Запрос', 'Просим провести проверку.'))
+        call_command('process_emails', deferred_summaries=True, stdout=io.StringIO())
+        incoming = Incoming.objects.get()
+        form = IncomingForm(instance=incoming, data={
+            'incoming_number': incoming.incoming_number, 'applicant': incoming.applicant,
+            'incoming_date': incoming.incoming_date, 'summary': 'Проверка по обращению',
+            'responsible': 'Иванов', 'response_deadline': date(2025, 2, 1),
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.assertFalse(SummaryRequest.objects.exists())  # текст письма больше не хранится
+        self.backend.responses = ['Резюме модели']
+        summaries.summarize_records([incoming.pk])
+        incoming.refresh_from_db()
+        self.assertEqual((incoming.summary, incoming.summary_status), ('Проверка по обращению', Incoming.SUMMARY_DONE))
+
+    def test_requests_of_finished_records_are_purged(self):
+        self.server.deliver(raw_email('<4@example.com>', 'Запрос', 'Просим выдать справку.'))
+        call_command('process_emails', deferred_summaries=True, stdout=io.StringIO())
+        # Резюме записи готово, а её запрос в очереди остался
+        Incoming.objects.update(summary_status=Incoming.SUMMARY_DONE)
+        self.assertEqual(summaries.requeue_stale(), 0)
+        self.assertFalse(SummaryRequest.objects.exists())
@@ -0,0 +1,193 @@
+# registry/uploads.py
+"""Возобновляемая загрузка вложений кусками.
+
+Клиент открывает сессию (имя и размер файла), затем отправляет куски
+по порядку; каждый кусок читается из запроса во временный буфер
+и дописывается в итоговый файл хранилища, SHA-256 считается по ходу.
+Прерванную загрузку клиент продолжает с offset, который возвращает
+сервер. Готовые файлы прикрепляются к записи все вместе одной транзакцией.
+"""
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from .models import Attachment, Incoming, UploadSession
+from .page_cache import bump_register_version
+from .search import index_incoming
+
+READ_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024  # Кусок больше этого буферизуется на диске
+MAX_HASHERS = 256
+
+# Состояние SHA-256 незавершённых загрузок этого процесса: {id: (offset, hasher)}.
+# hashlib не сериализуется, поэтому при возобновлении в другом процессе
+# состояние восстанавливается чтением уже принятой части файла.
+_hashers = OrderedDict()
+
+
+class UploadError(Exception):
+    """Ошибка загрузки; status — HTTP-код ответа."""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def start_upload(incoming, user, filename, size, expected_sha256=''):
+    """Новая сессия загрузки с пустым файлом под итоговым именем в хранилище."""
+    filename = os.path.basename(filename or '').strip()
+    if not filename:
+        raise UploadError('filename is required')
+    if size < 0 or size > settings.UPLOAD_MAX_FILE_SIZE:
+        raise UploadError(f'size must be between 0 and {settings.UPLOAD_MAX_FILE_SIZE} bytes', status=413)
+    session = UploadSession(incoming=incoming, user=user, filename=filename, size=size,
+                            expected_sha256=expected_sha256.lower())
+    # Имя резервируется в хранилище сразу: дальше куски дописываются в этот файл
+    session.file.save(filename, ContentFile(b''), save=False)
+    if size == 0 and not _finish(session, hashlib.sha256()):
+        session.file.delete(save=False)
+        raise UploadError('checksum mismatch', status=422)
+    session.save()
+    return session
+
+
+def _hasher(session):
+    cached = _hashers.pop(session.pk, None)
+    if cached is not None and cached[0] == session.received:
+        hasher = cached[1]
+    else:
+        hasher = hashlib.sha256()
+        with open(session.file.path, 'rb') as partial:
+            remaining = session.received
+            while remaining:
+                block = partial.read(min(READ_SIZE, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+    return hasher
+
+
+def _remember(session, hasher):
+    _hashers[session.pk] = (session.received, hasher)
+    while len(_hashers) > MAX_HASHERS:
+        _hashers.popitem(last=False)
+
+
+def _finish(session, hasher):
+    """Завершение загрузки; при несовпадении контрольной суммы файл обнуляется и возвращается False."""
+    sha256 = hasher.hexdigest()
+    if session.expected_sha256 and session.expected_sha256 != sha256:
+        session.received = 0
+        with open(session.file.path, 'r+b') as target:
+            target.truncate(0)
+        return False
+    session.sha256 = sha256
+    session.status = UploadSession.COMPLETE
+    return True
+
+
+def _check_chunk(session, offset, length):
+    if session is None:
+        raise UploadError('upload not found', status=404)
+    if session.status != UploadSession.UPLOADING:
+        raise UploadError('upload is already complete', status=409, offset=session.received)
+    if offset != session.received:
+        raise UploadError('unexpected offset', status=409, offset=session.received)
+    if length <= 0 or offset + length > session.size:
+        raise UploadError('chunk does not fit the declared size', status=416, offset=session.received)
+
+
+def _receive(stream, length, buffer):
+    """Чтение куска из stream в buffer; False, если клиент прислал меньше length."""
+    received = 0
+    while received < length:
+        block = stream.read(min(READ_SIZE, length - received))
+        if not block:
+            break
+        buffer.write(block)
+        received += len(block)
+    buffer.seek(0)
+    return received == length
+
+
+def append_chunk(session_id, user, offset, stream, length):
+    """Дописывание куска длиной length из stream с позиции offset; возвращает сессию.
+
+    offset должен совпадать с уже принятым объёмом, иначе UploadError 409
+    с правильным offset — клиент продолжает с него. Кусок сначала целиком
+    читается из запроса во временный буфер, и только потом сессия
+    блокируется: медленный клиент не держит транзакцию и блокировку строки.
+    """
+    # Предварительная проверка без блокировки: кусок, который всё равно будет отвергнут, не читается
+    _check_chunk(UploadSession.objects.filter(pk=session_id, user=user).first(), offset, length)
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as buffer:
+        if not _receive(stream, length, buffer):
+            raise UploadError('chunk was truncated', offset=offset)
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().filter(pk=session_id, user=user).first()
+            _check_chunk(session, offset, length)
+            hasher = _hasher(session)
+            with open(session.file.path, 'r+b') as target:
+                # Хвост от оборванной записи отбрасывается: файл всегда равен принятому объёму
+                target.seek(offset)
+                target.truncate()
+                while block := buffer.read(READ_SIZE):
+                    target.write(block)
+                    hasher.update(block)
+
+            session.received += length
+            verified = True
+            if session.received == session.size:
+                verified = _finish(session, hasher)
+            else:
+                _remember(session, hasher)
+            session.save()
+    if not verified:
+        raise UploadError('checksum mismatch, upload the file again', status=422, offset=0)
+    return session
+
+
+def attach_uploads(incoming, user, session_ids):
+    """Прикрепление завершённых загрузок к записи одной транзакцией; возвращает вложения."""
+    with transaction.atomic():
+        sessions = list(UploadSession.objects.select_for_update().filter(
+            pk__in=session_ids, incoming=incoming, user=user))
+        if len(sessions) != len(set(session_ids)):
+            raise UploadError('upload not found', status=404)
+        unfinished = [session.filename for session in sessions if session.status != UploadSession.COMPLETE]
+        if unfinished:
+            raise UploadError(f'uploads are not complete: {", ".join(unfinished)}', status=409)
+        storage = Attachment._meta.get_field('file').storage
+        attachments = Attachment.objects.bulk_create([
+            Attachment(incoming=incoming, filename=session.filename, sha256=session.sha256,
+                       file=storage.adopt(session.file.name, session.sha256, keep_source=True))
+            for session in sessions
+        ])
+        UploadSession.objects.filter(pk__in=[session.pk for session in sessions]).delete()
+        # Принятые файлы уже связаны с blob; исходники удаляются, только если транзакция зафиксирована
+        uploaded = [session.file for session in sessions]
+        transaction.on_commit(lambda: [file.delete(save=False) for file in uploaded])
+        # bulk_create не вызывает сигналы вложений
+        Incoming.objects.touch([incoming.pk])
+        index_incoming(incoming)
+        bump_register_version()
+    return attachments
+
+
+def discard_upload(session):
+    _hashers.pop(session.pk, None)
+    session.file.delete(save=False)
+    session.delete()
+
+
+def cleanup_stale_uploads(older_than):
+    """Удаление брошенных загрузок вместе с их файлами; возвращает число сессий."""
+    stale = list(UploadSession.objects.filter(updated_at__lt=older_than))
+    for session in stale:
+        discard_upload(session)
+    return len(stale)
@@ -1,10 +1,7 @@
 # correspondence/urls.py
-from django.urls import path, re_path
+from django.urls import path
 from django.shortcuts import redirect
-from django.views.static import serve
-from registry import views
-from django.conf import settings
-from django.conf.urls.static import static
+from registry import api, views
 
 def redirect_to_incoming(request):
     return redirect('incoming_list')
@@ -14,16 +11,27 @@ def redirect_to_create(request):
 
 urlpatterns = [
     path('incoming/', views.incoming_list, name='incoming_list'),
+    path('incoming/deadlines/', views.deadline_dashboard, name='deadline_dashboard'),
+    path('incoming/export/', views.incoming_export, name='incoming_export'),
     path('incoming/<int:pk>/', views.incoming_detail, name='incoming_detail'),
     path('incoming/create/', views.incoming_create, name='incoming_create'),
     path('create/', redirect_to_create),
     path('incoming/<int:pk>/update/', views.incoming_update, name='incoming_update'),
     path('incoming/<int:pk>/delete/', views.incoming_delete, name='incoming_delete'),
+    path('incoming/<int:pk>/uploads/', views.upload_start, name='upload_start'),
+    path('incoming/<int:pk>/uploads/attach/', views.upload_attach, name='upload_attach'),
+    path('uploads/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('attachments/<int:pk>/', views.attachment_download, name='attachment_download'),
+    path('attachments/<int:pk>/preview/', views.attachment_preview, name='attachment_preview'),
+    path('archive/attachments/<int:pk>/', views.archived_attachment_download, name='archived_attachment_download'),
+    path('archive/attachments/<int:pk>/preview/', views.archived_attachment_preview, name='archived_attachment_preview'),
+    path('api/v1/incoming/', api.incoming_list, name='api_incoming_list'),
+    path('api/v1/incoming/<int:pk>/', api.incoming_detail, name='api_incoming_detail'),
+    path('api/v1/attachments/<int:pk>/', api.attachment_detail, name='api_attachment_detail'),
+    path('api/v1/archive/attachments/<int:pk>/', api.archived_attachment_detail, name='api_archived_attachment_detail'),
+    path('api/v1/changes/', api.changes, name='api_changes'),
+    path('metrics/', views.metrics_view, name='metrics'),
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
     path('', redirect_to_incoming),
-    re_path(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT}),
-]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+]
\ No newline at end of file
@@ -1,70 +1,307 @@
 # registry/views.py
-from django.shortcuts import render, get_object_or_404, redirect
+import hmac
+import json
+import os
+import tempfile
+import uuid
+from datetime import timedelta
+from django.shortcuts import aget_object_or_404, render, get_object_or_404, redirect
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_http_methods, require_POST
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.forms import AuthenticationForm
-from .models import Incoming
+from .models import (
+    ArchivedAttachment, ArchivedIncoming, Attachment, AttachmentContent, DeadlineSummary, Incoming, UploadSession,
+)
 from .forms import IncomingForm
+from . import archive, metrics
+from .downloads import serve_archived, serve_attachment, serve_file
+from .filters import ARCHIVE_PARAMS, get_filters, filter_incoming
+from .page_cache import cache_register_page
+from .pagination import acached_count, akeyset_page, parse_cursor
+from .register_io import csv_lines, export_rows, write_xlsx
+from .uploads import UploadError, append_chunk, attach_uploads, discard_upload, start_upload
+from django.conf import settings
 from django.core.paginator import Paginator
-import unicodedata
+from django.utils import timezone
+from urllib.parse import urlencode
 
+async def load_user(request):
+    """Пользователь для асинхронного представления загружается заранее:
+    контекст шаблона (auth) обращается к request.user, а ленивая загрузка
+    в цикле событий запрещена."""
+    request.user = await request.auser()
+
+def page_url(filter_query, cursor_query=''):
+    """Ссылка на страницу списка с текущими фильтрами."""
+    return '?' + '&'.join(part for part in (filter_query, cursor_query) if part)
+
+@metrics.instrument_view('incoming_list')
 @login_required
-def incoming_list(request):
-    query = unicodedata.normalize('NFKC', request.GET.get('q', '').strip())
-    date_from = request.GET.get('date_from', '')
-    date_to = request.GET.get('date_to', '')
-    responsible_filter = unicodedata.normalize('NFKC', request.GET.get('responsible_filter', '').strip())
-    number_filter = request.GET.get('number_filter', '')
-    summary_filter = unicodedata.normalize('NFKC', request.GET.get('summary_filter', '').strip())
-    deadline_from = request.GET.get('deadline_from', '')
-    deadline_to = request.GET.get('deadline_to', '')
-    attachment_filter = request.GET.get('attachment_filter', '')
-
-    incoming = Incoming.objects.all().order_by('-incoming_number')
-
-    if query:
-        incoming = incoming.filter(applicant__icontains=query)
-    if date_from:
-        incoming = incoming.filter(incoming_date__gte=date_from)
-    if date_to:
-        incoming = incoming.filter(incoming_date__lte=date_to)
-    if responsible_filter:
-        incoming = incoming.filter(responsible__icontains=responsible_filter)
-    if number_filter:
-        incoming = incoming.filter(incoming_number=number_filter)
-    if summary_filter:
-        incoming = incoming.filter(summary__icontains=summary_filter)
-    if deadline_from:
-        incoming = incoming.filter(response_deadline__gte=deadline_from)
-    if deadline_to:
-        incoming = incoming.filter(response_deadline__lte=deadline_to)
-    if attachment_filter == 'yes':
-        incoming = incoming.filter(attachments__isnull=False).distinct()
-    elif attachment_filter == 'no':
-        incoming = incoming.filter(attachments__isnull=True)
-
-    paginator = Paginator(incoming, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-
-    return render(request, 'registry/incoming_list.html', {
-        'page_obj': page_obj,
-        'query': query,
-        'date_from': date_from,
-        'date_to': date_to,
-        'responsible_filter': responsible_filter,
-        'number_filter': number_filter,
-        'summary_filter': summary_filter,
-        'deadline_from': deadline_from,
-        'deadline_to': deadline_to,
-        'attachment_filter': attachment_filter,
+@cache_register_page
+async def incoming_list(request):
+    await load_user(request)
+    filters = get_filters(request.GET)
+    incoming = filter_incoming(filters)
+    filter_query = urlencode({name: value for name, value in filters.items() if value})
+
+    if filters['search']:
+        # Результаты поиска упорядочены по релевантности, курсор по номеру к ним неприменим
+        paginator = Paginator(incoming, settings.REGISTER_PAGE_SIZE)
+        # Paginator синхронный: итог и строки страницы загружаются асинхронно заранее
+        paginator.count = await incoming.acount()
+        page_obj = paginator.get_page(request.GET.get('page'))
+        page_obj.object_list = [row async for row in page_obj.object_list]
+        total = paginator.count
+        previous_query = page_obj.has_previous() and f'page={page_obj.previous_page_number()}'
+        next_query = page_obj.has_next() and f'page={page_obj.next_page_number()}'
+    else:
+        page_obj = await akeyset_page(
+            incoming,
+            after=parse_cursor(request.GET.get('after')),
+            before=parse_cursor(request.GET.get('before')),
+            per_page=settings.REGISTER_PAGE_SIZE,
+        )
+        total = await acached_count(incoming, filters)
+        previous_query = page_obj.has_previous() and f'before={page_obj.previous_cursor}'
+        next_query = page_obj.has_next() and f'after={page_obj.next_cursor}'
+
+    archived = []
+    if any(filters[name] for name in ARCHIVE_PARAMS) and not page_obj.has_previous():
+        # Закрытая переписка показывается, только когда письмо ищут: по тексту, заявителю или номеру
+        archived = filter_incoming(filters, ArchivedIncoming.objects.all())[:settings.ARCHIVE_SEARCH_LIMIT]
+        archived = [row async for row in archived]
+
+    with metrics.stage('render'):
+        return render(request, 'registry/incoming_list.html', {
+            'page_obj': page_obj,
+            'total': total,
+            'first_url': page_url(filter_query),
+            'export_csv_url': reverse('incoming_export') + page_url(filter_query),
+            'export_xlsx_url': reverse('incoming_export') + page_url(filter_query, 'format=xlsx'),
+            'previous_url': page_url(filter_query, previous_query),
+            'next_url': page_url(filter_query, next_query),
+            'search': filters['search'],
+            'query': filters['q'],
+            'date_from': filters['date_from'],
+            'date_to': filters['date_to'],
+            'responsible_filter': filters['responsible_filter'],
+            'number_filter': filters['number_filter'],
+            'summary_filter': filters['summary_filter'],
+            'deadline_from': filters['deadline_from'],
+            'deadline_to': filters['deadline_to'],
+            'attachment_filter': filters['attachment_filter'],
+            'archived': archived,
+            'archive_limit': settings.ARCHIVE_SEARCH_LIMIT,
+        })
+
+@login_required
+def incoming_export(request):
+    """Выгрузка реестра с текущими фильтрами списка; строки формируются по мере отправки."""
+    incoming = filter_incoming(get_filters(request.GET))
+    if request.GET.get('format') == 'xlsx':
+        # XLSX — zip-архив, его нельзя отдавать по частям: пишем во временный файл на диске
+        target = tempfile.TemporaryFile()
+        write_xlsx(export_rows(incoming), target)
+        target.seek(0)
+        return FileResponse(target, as_attachment=True, filename='incoming.xlsx')
+    response = StreamingHttpResponse(csv_lines(export_rows(incoming)), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="incoming.csv"'
+    return response
+
+def bucket_ranges(today):
+    """Границы сроков ответа для каждой корзины: (deadline_from, deadline_to)."""
+    week_end = today + timedelta(days=DeadlineSummary.WEEK_DAYS)
+    return {
+        DeadlineSummary.OVERDUE: (None, today - timedelta(days=1)),
+        DeadlineSummary.TODAY: (today, today),
+        DeadlineSummary.WEEK: (today + timedelta(days=1), week_end),
+        DeadlineSummary.LATER: (week_end + timedelta(days=1), None),
+    }
+
+@login_required
+def deadline_dashboard(request):
+    """Сроки ответа по ответственным — из сводной таблицы, без обхода реестра."""
+    today = timezone.localdate()
+    ranges = bucket_ranges(today)
+    buckets = [bucket for bucket, _ in DeadlineSummary.BUCKETS]
+    counts = {}
+    for row in DeadlineSummary.objects.current(today).filter(count__gt=0):
+        counts.setdefault(row.responsible, dict.fromkeys(buckets, 0))[row.bucket] = row.count
+
+    def cell(responsible, bucket, count):
+        deadline_from, deadline_to = ranges[bucket]
+        query = {'responsible_filter': responsible, 'deadline_from': deadline_from, 'deadline_to': deadline_to}
+        return {
+            'count': count,
+            'url': reverse('incoming_list') + '?' + urlencode({name: value for name, value in query.items() if value}),
+        }
+
+    rows = [
+        {'responsible': responsible, 'cells': [cell(responsible, bucket, values[bucket]) for bucket in buckets]}
+        for responsible, values in sorted(counts.items(), key=lambda item: (-item[1][DeadlineSummary.OVERDUE], item[0]))
+    ]
+    totals = [sum(values[bucket] for values in counts.values()) for bucket in buckets]
+    return render(request, 'registry/deadline_dashboard.html', {
+        'today': today,
+        'headers': [label for _, label in DeadlineSummary.BUCKETS],
+        'rows': rows,
+        'totals': totals,
     })
 
+@metrics.instrument_view('incoming_detail')
+@login_required
+async def incoming_detail(request, pk):
+    await load_user(request)
+    incoming = await Incoming.objects.filter(pk=pk).afirst()
+    archived = incoming is None
+    if archived:
+        # Закрытая запись перенесена в архив под тем же id
+        incoming = await aget_object_or_404(ArchivedIncoming, pk=pk)
+    attachments = [attachment async for attachment in incoming.attachments.all()]
+    # Текст и превью разобраны заранее (extraction.py); все вложения — одним запросом
+    contents = await AttachmentContent.objects.ain_bulk(
+        [attachment.sha256 for attachment in attachments if attachment.sha256], field_name='sha256')
+    for attachment in attachments:
+        attachment.content = contents.get(attachment.sha256)
+    with metrics.stage('render'):
+        return render(request, 'registry/incoming_detail.html', {
+            'incoming': incoming,
+            'attachments': attachments,
+            'archived': archived,
+            'download_url': 'archived_attachment_download' if archived else 'attachment_download',
+            'preview_url': 'archived_attachment_preview' if archived else 'attachment_preview',
+        })
+
+@login_required
+async def attachment_download(request, pk):
+    attachment = await aget_object_or_404(Attachment, pk=pk)
+    if not attachment.file or not attachment.file.storage.exists(attachment.file.name):
+        raise Http404('Файл вложения не найден')
+    return serve_attachment(request, attachment)
+
+@login_required
+async def archived_attachment_download(request, pk):
+    attachment = await aget_object_or_404(ArchivedAttachment.objects.select_related('incoming', 'pack'), pk=pk)
+    if attachment.pack is None or not os.path.exists(archive.pack_path(attachment.pack.name)):
+        raise Http404('Файл вложения не найден')
+    return serve_archived(request, attachment)
+
+@login_required
+async def attachment_preview(request, pk):
+    return await preview_response(request, await aget_object_or_404(Attachment, pk=pk))
+
+@login_required
+async def archived_attachment_preview(request, pk):
+    # Превью хранятся по SHA-256 и при переносе в архив остаются на месте
+    return await preview_response(request, await aget_object_or_404(ArchivedAttachment, pk=pk))
+
+async def preview_response(request, attachment):
+    content = await AttachmentContent.objects.filter(sha256=attachment.sha256).exclude(preview='').afirst()
+    if not attachment.sha256 or content is None or not content.preview.storage.exists(content.preview.name):
+        raise Http404('Превью вложения не найдено')
+    return serve_file(request, content.preview, f'{attachment.filename}.png')
+
+def metrics_view(request):
+    """Метрики в формате Prometheus: по токену METRICS_TOKEN (Authorization: Bearer) или сотруднику."""
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get('Authorization', '')
+    allowed = bool(token) and hmac.compare_digest(authorization, f'Bearer {token}')
+    if not allowed and not request.user.is_staff:
+        return HttpResponse('Forbidden\n', status=403, content_type='text/plain')
+    body = metrics.render_metrics(metrics.VIEW_METRICS + metrics.ingestion_metrics(settings.METRICS_INGESTION_WINDOW))
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def upload_state(session):
+    return {
+        'id': str(session.pk),
+        'filename': session.filename,
+        'size': session.size,
+        'offset': session.received,
+        'status': session.status,
+        'sha256': session.sha256,
+        'chunk_size': settings.UPLOAD_CHUNK_SIZE,
+    }
+
+def upload_error(error):
+    payload = {'error': str(error)}
+    if error.offset is not None:
+        payload['offset'] = error.offset
+    return JsonResponse(payload, status=error.status)
+
+def json_body(request):
+    try:
+        return json.loads(request.body or b'{}')
+    except ValueError:
+        raise UploadError('invalid JSON body')
+
+@login_required
+@require_POST
+def upload_start(request, pk):
+    """Открытие сессии загрузки: {"filename", "size", "sha256"?} → id и offset."""
+    incoming = get_object_or_404(Incoming, pk=pk)
+    try:
+        data = json_body(request)
+        try:
+            size = int(data.get('size'))
+        except (TypeError, ValueError):
+            raise UploadError('size is required')
+        session = start_upload(incoming, request.user, data.get('filename'), size, data.get('sha256') or '')
+    except UploadError as error:
+        return upload_error(error)
+    return JsonResponse(upload_state(session), status=201)
+
+@login_required
+@require_http_methods(['GET', 'PUT', 'DELETE'])
+def upload_chunk(request, upload_id):
+    """GET — сколько принято; PUT — следующий кусок (заголовок Upload-Offset); DELETE — отмена."""
+    if request.method == 'PUT':
+        try:
+            length = int(request.headers.get('Content-Length') or 0)
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return JsonResponse({'error': 'Upload-Offset header is required'}, status=400)
+        if length > settings.UPLOAD_CHUNK_SIZE:
+            return JsonResponse({'error': f'chunks are limited to {settings.UPLOAD_CHUNK_SIZE} bytes'}, status=413)
+        try:
+            session = append_chunk(upload_id, request.user, offset, request, length)
+        except UploadError as error:
+            return upload_error(error)
+        return JsonResponse(upload_state(session))
+
+    session = get_object_or_404(UploadSession, pk=upload_id, user=request.user)
+    if request.method == 'DELETE':
+        discard_upload(session)
+        return JsonResponse({'id': str(upload_id), 'status': 'deleted'})
+    return JsonResponse(upload_state(session))
+
 @login_required
-def incoming_detail(request, pk):
+@require_POST
+def upload_attach(request, pk):
+    """Прикрепление загруженных файлов к записи: {"uploads": [id, ...]}."""
     incoming = get_object_or_404(Incoming, pk=pk)
-    return render(request, 'registry/incoming_detail.html', {'incoming': incoming})
+    try:
+        ids = json_body(request).get('uploads') or []
+        try:
+            ids = [uuid.UUID(str(value)) for value in ids]
+        except ValueError:
+            raise UploadError('invalid upload id')
+        if not ids:
+            raise UploadError('uploads are required')
+        attachments = attach_uploads(incoming, request.user, ids)
+    except UploadError as error:
+        return upload_error(error)
+    return JsonResponse({'attachments': [
+        {
+            'id': attachment.pk,
+            'filename': attachment.filename,
+            'sha256': attachment.sha256,
+            'url': reverse('attachment_download', args=[attachment.pk]),
+        }
+        for attachment in attachments
+    ]}, status=201)
 
 @login_required
 def incoming_create(request):
@@ -0,0 +1,91 @@
+// static/js/chunked_upload.js
+// Загрузка вложений кусками с возобновлением: id незавершённых загрузок хранится в localStorage,
+// после обрыва загрузка продолжается с offset, который сообщает сервер.
+(function () {
+    const form = document.getElementById('chunked-upload');
+    if (!form) {
+        return;
+    }
+    const input = form.querySelector('input[type=file]');
+    const progress = form.querySelector('.upload-progress');
+    const csrfToken = form.querySelector('input[name=csrfmiddlewaretoken]').value;
+
+    function storageKey(file) {
+        return ['upload', form.dataset.incoming, file.name, file.size, file.lastModified].join(':');
+    }
+
+    async function request(url, options) {
+        const response = await fetch(url, {
+            credentials: 'same-origin',
+            ...options,
+            headers: {'X-CSRFToken': csrfToken, ...(options && options.headers)},
+        });
+        const data = await response.json();
+        return {ok: response.ok, status: response.status, data: data};
+    }
+
+    async function openSession(file) {
+        const saved = localStorage.getItem(storageKey(file));
+        if (saved) {
+            const state = await request(form.dataset.chunkUrl.replace('00000000-0000-0000-0000-000000000000', saved));
+            if (state.ok) {
+                return state.data;
+            }
+        }
+        const started = await request(form.dataset.startUrl, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({filename: file.name, size: file.size}),
+        });
+        if (!started.ok) {
+            throw new Error(started.data.error);
+        }
+        localStorage.setItem(storageKey(file), started.data.id);
+        return started.data;
+    }
+
+    async function upload(file, report) {
+        let state = await openSession(file);
+        const url = form.dataset.chunkUrl.replace('00000000-0000-0000-0000-000000000000', state.id);
+        const chunkSize = state.chunk_size;
+        while (state.status !== 'complete') {
+            const chunk = file.slice(state.offset, state.offset + chunkSize);
+            const sent = await request(url, {
+                method: 'PUT',
+                headers: {'Upload-Offset': String(state.offset), 'Content-Type': 'application/octet-stream'},
+                body: chunk,
+            });
+            if (!sent.ok && sent.data.offset === undefined) {
+                throw new Error(sent.data.error);
+            }
+            state = {...state, ...sent.data};
+            report(state.offset / file.size);
+        }
+        return state.id;
+    }
+
+    form.addEventListener('submit', async function (event) {
+        event.preventDefault();
+        const files = Array.from(input.files);
+        const ids = [];
+        try {
+            for (const [index, file] of files.entries()) {
+                ids.push(await upload(file, function (share) {
+                    progress.textContent = `${file.name}: ${Math.round(share * 100)}% (${index + 1}/${files.length})`;
+                }));
+            }
+            const attached = await request(form.dataset.attachUrl, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({uploads: ids}),
+            });
+            if (!attached.ok) {
+                throw new Error(attached.data.error);
+            }
+            files.forEach(function (file) { localStorage.removeItem(storageKey(file)); });
+            window.location.reload();
+        } catch (error) {
+            progress.textContent = `Ошибка загрузки: ${error.message}. Выберите те же файлы, чтобы продолжить.`;
+        }
+    });
+})();